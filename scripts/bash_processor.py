@@ -2,33 +2,255 @@
 
 import os
 import sys
+import time
+import signal
+import resource
+import selectors
 import subprocess
-from anthropic import Anthropic
+from typing import Optional
+import httpx
+from anthropic import Anthropic, DefaultHttpxClient
 
-def run_bash_command(command: str) -> tuple[str, str]:
-    """Run a bash command and return its output."""
+# Wall-clock and CPU limits (seconds) for each command; CPU is unlimited by default
+COMMAND_TIMEOUT = float(os.getenv('BASH_COMMAND_TIMEOUT', '30'))
+COMMAND_CPU_LIMIT = os.getenv('BASH_COMMAND_CPU_LIMIT')
+
+# Wall-clock and CPU budgets (seconds) shared by all the commands of a session
+# (one request, or a whole interactive session); unlimited by default
+SESSION_TIMEOUT = os.getenv('BASH_SESSION_TIMEOUT')
+SESSION_CPU_LIMIT = os.getenv('BASH_SESSION_CPU_LIMIT')
+
+# How often a CPU-limited command's process group is sampled: first after
+# FIRST_SAMPLE_INTERVAL, then at twice the previous interval, up to CPU_POLL_INTERVAL
+FIRST_SAMPLE_INTERVAL = 0.05
+CPU_POLL_INTERVAL = 0.5
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+# Seconds to keep reading output after a kill; processes that left the
+# process group (setsid, daemons) can hold the pipes open forever
+KILL_DRAIN_TIMEOUT = 0.5
+
+class SessionBudget:
+    """Wall-clock and CPU seconds used so far by the commands of one session."""
+
+    def __init__(self, timeout: Optional[float] = None, cpu_limit: Optional[float] = None):
+        if timeout is None and SESSION_TIMEOUT:
+            timeout = float(SESSION_TIMEOUT)
+        if cpu_limit is None and SESSION_CPU_LIMIT:
+            cpu_limit = float(SESSION_CPU_LIMIT)
+        self.timeout = timeout
+        self.cpu_limit = cpu_limit
+        self.wall_used = 0.0
+        self.cpu_used = 0.0
+
+    def limits(self) -> tuple[Optional[float], Optional[float]]:
+        """(timeout, cpu_limit) for the next command, bounded by what is left."""
+        timeout = COMMAND_TIMEOUT
+        if self.timeout is not None:
+            timeout = min(timeout, self.timeout - self.wall_used)
+        cpu_limit = float(COMMAND_CPU_LIMIT) if COMMAND_CPU_LIMIT else None
+        if self.cpu_limit is not None:
+            remaining = self.cpu_limit - self.cpu_used
+            cpu_limit = remaining if cpu_limit is None else min(cpu_limit, remaining)
+        return timeout, cpu_limit
+
+    def charge(self, usage: Optional[dict]):
+        if usage:
+            self.wall_used += usage["wall_seconds"]
+            self.cpu_used += usage["cpu_seconds"]
+
+def _proc_children(pid: str) -> list[str]:
+    """Child pids of every thread of a process."""
+    children = []
+    try:
+        tasks = os.listdir(f"/proc/{pid}/task")
+    except OSError:
+        return children
+    for task in tasks:
+        try:
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children.extend(f.read().split())
+        except OSError:
+            pass
+    return children
+
+def group_cpu_seconds(pgid: int) -> Optional[float]:
+    """CPU time (user + sys, including reaped children) of a process group, from /proc.
+
+    Walks the leader's descendants and counts those still in the group.
+    Returns None where /proc (or its task children lists) is not available.
+    """
+    if not os.path.exists(f"/proc/{pgid}/task/{pgid}/children"):
+        return None
+    ticks = 0
+    pending = [str(pgid)]
+    while pending:
+        pid = pending.pop()
+        try:
+            with open(f"/proc/{pid}/stat", "rb") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # Fields after the parenthesised command name, from `state`
+        fields = stat[stat.rfind(b")") + 2:].split()
+        if int(fields[2]) == pgid:
+            ticks += sum(int(value) for value in fields[11:15])
+        pending.extend(_proc_children(pid))
+    return ticks / CLOCK_TICKS
+
+def _limit_cpu(cpu_limit: Optional[float]):
+    """Return a preexec_fn that caps the CPU time of each of the command's processes.
+
+    Only a backstop, and the limit where /proc is missing: _read_output()
+    enforces the limit on the whole process group.
+    """
+    def set_limit():
+        if cpu_limit is not None:
+            seconds = max(1, int(cpu_limit))
+            resource.setrlimit(resource.RLIMIT_CPU, (seconds, seconds + 1))
+    return set_limit
+
+def _read_output(
+    process: subprocess.Popen, timeout: Optional[float], cpu_limit: Optional[float] = None
+) -> tuple[bytes, bytes, bool, Optional[float]]:
+    """Read stdout and stderr to the end, killing the process group when over a limit.
+
+    The CPU limit covers the whole process group, sampled from /proc, so a
+    command can't multiply it by forking workers. Also returns the group's
+    CPU seconds at the last sample (None if never sampled): processes killed
+    here are never waited for, so wait4() does not count their CPU time.
+    """
+    chunks = {process.stdout: [], process.stderr: []}
+    started = time.monotonic()
+    deadline = started + timeout if timeout is not None else None
+    cpu_start = group_cpu_seconds(process.pid)
+    cpu_used = None
+    interval = FIRST_SAMPLE_INTERVAL
+    sampling = cpu_start is not None and cpu_limit is not None
+    next_sample = started + interval if sampling else None
+    timed_out = False
+    with selectors.DefaultSelector() as selector:
+        for stream in chunks:
+            selector.register(stream, selectors.EVENT_READ)
+        while selector.get_map():
+            times = [t for t in (deadline, next_sample) if t is not None]
+            wait = max(0.0, min(times) - time.monotonic()) if times else None
+            events = selector.select(wait)
+            now = time.monotonic()
+            if timed_out:
+                if now >= deadline:
+                    break
+            else:
+                over = deadline is not None and now >= deadline
+                if over or (next_sample is not None and now >= next_sample):
+                    interval = min(interval * 2, CPU_POLL_INTERVAL)
+                    next_sample = now + interval if sampling else None
+                    cpu = group_cpu_seconds(process.pid) if cpu_start is not None else None
+                    if cpu is not None:
+                        cpu_used = cpu - cpu_start
+                        over = over or (cpu_limit is not None and cpu_used > cpu_limit)
+                if over:
+                    try:
+                        os.killpg(process.pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+                    # Keep reading what was written before the kill, for a while
+                    timed_out = True
+                    deadline = now + KILL_DRAIN_TIMEOUT
+                    next_sample = None
+            for key, _ in events:
+                data = os.read(key.fd, 64 * 1024)
+                if data:
+                    chunks[key.fileobj].append(data)
+                else:
+                    selector.unregister(key.fileobj)
+    stdout, stderr = b"".join(chunks[process.stdout]), b"".join(chunks[process.stderr])
+    return stdout, stderr, timed_out, cpu_used
+
+def _usage(rusage, wall_seconds: float, own_maxrss: int, sampled_cpu: Optional[float]) -> dict:
+    """Resources used by the command and the children it waited for, from wait4().
+
+    `cpu_seconds` is the larger of their CPU time and `sampled_cpu`, the
+    process group's CPU time sampled from /proc, which includes processes
+    killed before anyone waited for them.
+    """
+    # Linux counts the memory a process had before exec() in its peak RSS,
+    # so a peak no higher than ours is our own and the command's is unknown
+    peak_rss = rusage.ru_maxrss if rusage.ru_maxrss > own_maxrss else None
+    # ru_maxrss is in KiB on Linux and in bytes on macOS; blocks are 512 bytes
+    rss_unit = 1 if sys.platform == 'darwin' else 1024
+    cpu_seconds = max(sampled_cpu or 0.0, rusage.ru_utime + rusage.ru_stime)
+    return {
+        "wall_seconds": round(wall_seconds, 3),
+        "cpu_seconds": round(cpu_seconds, 3),
+        "user_seconds": round(rusage.ru_utime, 3),
+        "sys_seconds": round(rusage.ru_stime, 3),
+        "peak_rss_bytes": peak_rss * rss_unit if peak_rss is not None else None,
+        "read_bytes": rusage.ru_inblock * 512,
+        "write_bytes": rusage.ru_oublock * 512,
+    }
+
+def run_bash_command(
+    command: str,
+    timeout: Optional[float] = COMMAND_TIMEOUT,
+    cpu_limit: Optional[float] = None,
+) -> dict:
+    """Run a bash command and return its output.
+
+    The command runs in its own process group. When it runs out of wall-clock
+    or CPU time the whole group is killed, so grandchildren do not outlive
+    it, and the output captured so far is returned with `timed_out` set. The
+    process is reaped with wait4(), so the result also has its resource
+    `usage`.
+    """
+    if cpu_limit is None and COMMAND_CPU_LIMIT:
+        cpu_limit = float(COMMAND_CPU_LIMIT)
+    own_maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.monotonic()
     try:
-        result = subprocess.run(
+        process = subprocess.Popen(
             command,
             shell=True,
-            capture_output=True,
-            text=True,
-            timeout=30,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True,
+            preexec_fn=_limit_cpu(cpu_limit),
         )
-        return result.stdout, result.stderr
     except Exception as e:
-        return "", str(e)
+        return {"stdout": "", "stderr": str(e), "returncode": None, "timed_out": False, "usage": None}
 
-def process_bash_command(command: str) -> int:
-    api_key = os.getenv('ANTHROPIC_API_KEY')
-    if not api_key:
-        print("Error: ANTHROPIC_API_KEY environment variable not set", file=sys.stderr)
-        sys.exit(1)
+    with process:
+        stdout, stderr, timed_out, sampled_cpu = _read_output(process, timeout, cpu_limit)
+        _, status, rusage = os.wait4(process.pid, 0)
+        # Tell Popen the process is reaped so it doesn't wait for it again
+        process.returncode = os.waitstatus_to_exitcode(status)
 
-    client = Anthropic(api_key=api_key)
+    # SIGXCPU means the CPU limit was hit
+    if process.returncode in (-signal.SIGXCPU, 128 + signal.SIGXCPU):
+        timed_out = True
 
-    try:
-        system_message = """You are a bash command assistant that executes commands through the bash tool.
+    return {
+        "stdout": stdout.decode(errors='replace'),
+        "stderr": stderr.decode(errors='replace'),
+        "returncode": process.returncode,
+        "timed_out": timed_out,
+        "usage": _usage(rusage, time.monotonic() - started, own_maxrss, sampled_cpu),
+    }
+
+def format_usage(usage: dict) -> str:
+    """One line summary of a command's resource usage."""
+    parts = [
+        f"wall {usage['wall_seconds']:.2f}s",
+        f"cpu {usage['cpu_seconds']:.2f}s "
+        f"(user {usage['user_seconds']:.2f}s, sys {usage['sys_seconds']:.2f}s waited for)",
+    ]
+    if usage["peak_rss_bytes"] is not None:
+        parts.append(f"peak RSS {usage['peak_rss_bytes'] / 2**20:.1f} MiB")
+    parts.append(f"read {usage['read_bytes']} B, written {usage['write_bytes']} B")
+    return ", ".join(parts)
+
+SYSTEM_MESSAGE = """You are a bash command assistant that executes commands through the bash tool.
 
 For SQLite database queries:
 1. When asked to show/list/display tables in app.db, you MUST execute: sqlite3 app.db .tables
@@ -39,42 +261,149 @@ Guidelines:
 - ALWAYS use the bash tool to execute commands
 - For SQLite queries, use EXACTLY the commands above
 - Do not modify or parse database names - use them exactly as given
-- Do not try to explain what you will do - just execute the command"""
-
-        response = client.beta.messages.create(
-            model="claude-3-5-sonnet-20241022",
-            max_tokens=1024,
-            system=system_message,
-            tools=[{
-                "type": "bash_20241022",
-                "name": "bash"
-            }],
-            messages=[{
-                "role": "user", 
-                "content": command
-            }],
-            tool_choice={"type": "tool", "name": "bash"},
-            betas=["computer-use-2024-10-22"]
-        )
+- Do not try to explain what you will do - just execute the command
+- When a command fails, fix it and run it again; when you are done, answer in one short sentence"""
 
-        # Process tool calls
-        for content in response.content:
-            if content.type == 'text':
-                print("\nClaude:", content.text)
-            elif content.type == 'tool_use':
-                if content.name == 'bash':
-                    cmd = content.input.get('command')
-                    if cmd:
-                        print(f"\nExecuting: {cmd}")
-                        stdout, stderr = run_bash_command(cmd)
-                        if stdout:
-                            print("\nOutput:", stdout)
-                        if stderr:
-                            print("\nErrors:", stderr, file=sys.stderr)
-                        return 0
-
-        print("\nNo bash command was executed. Please try rephrasing your request.")
-        return 1
+# Model turns allowed for one request before giving up
+MAX_TURNS = int(os.getenv('BASH_MAX_TURNS', '10'))
+
+# Idle connections to the API kept open between requests, and for how long (seconds)
+KEEPALIVE_CONNECTIONS = 4
+KEEPALIVE_EXPIRY = 300.0
+
+def make_client(api_key: str) -> Anthropic:
+    """Create a client whose connection pool is reused by every request it sends.
+
+    Close it (or use it as a context manager) to close the pooled connections.
+    """
+    limits = httpx.Limits(
+        max_keepalive_connections=KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=KEEPALIVE_EXPIRY,
+    )
+    # DefaultHttpxClient keeps the SDK's own timeout and transport settings
+    return Anthropic(api_key=api_key, http_client=DefaultHttpxClient(limits=limits))
+
+def _get_api_key() -> str:
+    api_key = os.getenv('ANTHROPIC_API_KEY')
+    if not api_key:
+        print("Error: ANTHROPIC_API_KEY environment variable not set", file=sys.stderr)
+        sys.exit(1)
+    return api_key
+
+def _tool_result(tool_use_id: str, result: dict) -> dict:
+    """Turn a run_bash_command() result into a tool_result block for the model."""
+    parts = []
+    if result["stdout"]:
+        parts.append(result["stdout"])
+    if result["stderr"]:
+        parts.append(f"stderr:\n{result['stderr']}")
+    if result["timed_out"]:
+        parts.append("Command exceeded its time limit and was killed.")
+    elif result["returncode"]:
+        parts.append(f"Exit code: {result['returncode']}")
+    return {
+        "type": "tool_result",
+        "tool_use_id": tool_use_id,
+        "content": [{"type": "text", "text": "\n".join(parts) or "(no output)"}],
+        "is_error": result["timed_out"] or result["returncode"] != 0,
+    }
+
+def process_bash_command(
+    command: str, client: Optional[Anthropic] = None, budget: Optional[SessionBudget] = None
+) -> int:
+    """Let the model run bash commands for a request until it stops asking to.
+
+    Each command's output is sent back as a tool result so the model can
+    correct a failed command or go on with the next step. Pass a long-lived
+    `client` to reuse its connections across requests; without one, a
+    client is created and closed for this request only. Likewise, the
+    commands share `budget`, or a new SessionBudget for this request.
+    """
+    if client is None:
+        with make_client(_get_api_key()) as client:
+            return process_bash_command(command, client, budget)
+    if budget is None:
+        budget = SessionBudget()
+
+    messages = [{"role": "user", "content": command}]
+    commands_run = 0
+    timed_out = False
+
+    try:
+        for _ in range(MAX_TURNS):
+            response = client.beta.messages.create(
+                model="claude-3-5-sonnet-20241022",
+                max_tokens=1024,
+                system=SYSTEM_MESSAGE,
+                tools=[{
+                    "type": "bash_20241022",
+                    "name": "bash"
+                }],
+                messages=messages,
+                betas=["computer-use-2024-10-22"]
+            )
+
+            assistant_content = []
+            tool_results = []
+            for content in response.content:
+                if content.type == 'text':
+                    print("\nClaude:", content.text)
+                    assistant_content.append({"type": "text", "text": content.text})
+                elif content.type == 'tool_use':
+                    assistant_content.append(content.model_dump())
+                    cmd = content.input.get('command') if content.name == 'bash' else None
+                    if not cmd:
+                        # Every command runs in a fresh shell, so a restart is a no-op
+                        restarted = content.input.get('restart')
+                        tool_results.append({
+                            "type": "tool_result",
+                            "tool_use_id": content.id,
+                            "content": [{
+                                "type": "text",
+                                "text": "Bash session restarted." if restarted else "No command given.",
+                            }],
+                            "is_error": not restarted,
+                        })
+                        continue
+                    timeout, cpu_limit = budget.limits()
+                    if timeout <= 0 or (cpu_limit is not None and cpu_limit <= 0):
+                        message = "Session time budget exhausted, command did not run."
+                        print(f"\n{message}", file=sys.stderr)
+                        tool_results.append({
+                            "type": "tool_result",
+                            "tool_use_id": content.id,
+                            "content": [{"type": "text", "text": message}],
+                            "is_error": True,
+                        })
+                        continue
+                    print(f"\nExecuting: {cmd}")
+                    result = run_bash_command(cmd, timeout, cpu_limit)
+                    budget.charge(result["usage"])
+                    commands_run += 1
+                    if result["stdout"]:
+                        print("\nOutput:", result["stdout"])
+                    if result["stderr"]:
+                        print("\nErrors:", result["stderr"], file=sys.stderr)
+                    if result["usage"]:
+                        print("\nResources:", format_usage(result["usage"]), file=sys.stderr)
+                    if result["timed_out"]:
+                        timed_out = True
+                        print("\nCommand exceeded its time limit and was killed "
+                              "(partial output shown above).", file=sys.stderr)
+                    tool_results.append(_tool_result(content.id, result))
+
+            messages.append({"role": "assistant", "content": assistant_content})
+            if not tool_results:
+                break
+            messages.append({"role": "user", "content": tool_results})
+        else:
+            print(f"\nStopped after {MAX_TURNS} turns without a final answer.", file=sys.stderr)
+            return 1
+
+        if not commands_run:
+            print("\nNo bash command was executed. Please try rephrasing your request.")
+            return 1
+        return 1 if timed_out else 0
 
     except Exception as e:
         print(f"Error: {str(e)}", file=sys.stderr)
@@ -84,26 +413,30 @@ def interactive_mode():
     print("Interactive Bash Command Mode")
     print("Enter your commands in natural language (type 'exit' to quit)")
     print("----------------------------------------")
-    
-    while True:
-        try:
-            command = input("\n> ").strip()
-            
-            if command.lower() in ['exit', 'quit']:
-                print("Exiting...")
+
+    # One client for the whole session, so requests reuse open connections,
+    # and one budget for all of its commands
+    budget = SessionBudget()
+    with make_client(_get_api_key()) as client:
+        while True:
+            try:
+                command = input("\n> ").strip()
+
+                if command.lower() in ['exit', 'quit']:
+                    print("Exiting...")
+                    break
+
+                if not command:
+                    continue
+
+                process_bash_command(command, client, budget)
+
+            except KeyboardInterrupt:
+                print("\nExiting...")
+                break
+            except EOFError:
+                print("\nExiting...")
                 break
-                
-            if not command:
-                continue
-                
-            process_bash_command(command)
-            
-        except KeyboardInterrupt:
-            print("\nExiting...")
-            break
-        except EOFError:
-            print("\nExiting...")
-            break
 
 if __name__ == "__main__":
     if len(sys.argv) == 1:
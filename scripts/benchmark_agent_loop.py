@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""Benchmark the client-side hot path of the agent loop against a mock API.
+
+Replays recorded session logs (or a synthetic conversation) through
+EditorSession / BashSession with MockAnthropicServer standing in for the
+Messages API, and reports where each turn's time goes:
+
+- api: the messages.create call, including SDK serialization and the local
+  HTTP round trip
+- request: building the request arguments (cache breakpoints etc.)
+- history: recording the response and tool results, and compaction
+- tools: executing the tool calls
+- logging: time spent inside logging calls (overlaps the phases above)
+
+Usage:
+    benchmark_agent_loop.py [--log sessions/<id>.jsonl ...] [--mode editor|bash]
+                            [--turns 20] [--runs 5] [--execute]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, List
+
+import anthropic
+
+from anthropic_computer_use.main import BashSession, EditorSession, SessionLogger
+from anthropic_computer_use.mock_server import MockAnthropicServer, load_session_log
+
+PHASES = ["api", "request", "history", "tools", "logging"]
+
+
+def _message(content: List[Dict[str, Any]], stop_reason: str, index: int) -> Dict[str, Any]:
+    return {
+        "id": f"msg_bench_{index}",
+        "type": "message",
+        "role": "assistant",
+        "model": "claude-3-5-sonnet-20241022",
+        "content": content,
+        "stop_reason": stop_reason,
+        "stop_sequence": None,
+        "usage": {"input_tokens": 1000 + 200 * index, "output_tokens": 50},
+    }
+
+
+def _tool_use(index: int, name: str, tool_input: Dict[str, Any]) -> Dict[str, Any]:
+    return {"type": "tool_use", "id": f"toolu_bench_{index}", "name": name, "input": tool_input}
+
+
+def synthetic_responses(mode: str, turns: int) -> List[Dict[str, Any]]:
+    """A conversation of `turns` responses that exercises the usual tool calls"""
+    responses = []
+    if mode == "editor":
+        file_text = "".join(f"line {i:05d}\n" for i in range(2000))
+        calls = [{"command": "create", "path": "bench.txt", "file_text": file_text}]
+        for i in range(turns - 2):
+            if i % 2:
+                calls.append(
+                    {
+                        "command": "str_replace",
+                        "path": "bench.txt",
+                        "old_str": f"line {i:05d}\n",
+                        "new_str": f"LINE {i:05d}\n",
+                    }
+                )
+            else:
+                calls.append({"command": "view", "path": "bench.txt"})
+        name = "str_replace_editor"
+    else:
+        commands = ["ls -la", "echo $RANDOM", "seq 1 10000 | tail -1", "pwd"]
+        calls = [{"command": commands[i % len(commands)]} for i in range(turns - 1)]
+        name = "bash"
+
+    for index, tool_input in enumerate(calls):
+        responses.append(_message([_tool_use(index, name, tool_input)], "tool_use", index))
+    responses.append(_message([{"type": "text", "text": "Done."}], "end_turn", len(calls)))
+    return responses
+
+
+def _detect_mode(responses: List[Dict[str, Any]]) -> str:
+    for response in responses:
+        for block in response.get("content", []):
+            if block.get("type") == "tool_use":
+                return "bash" if block.get("name") == "bash" else "editor"
+    return "editor"
+
+
+class Recorder:
+    """Collects phase timings per turn; a turn starts with each API call"""
+
+    def __init__(self):
+        self.turn = -1
+        self.timings: List[Dict[str, float]] = []
+
+    def wrap(self, name: str, fn: Callable) -> Callable:
+        def timed(*args, **kwargs):
+            if name == "api":
+                self.turn += 1
+                self.timings.append(defaultdict(float))
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                if self.turn >= 0:
+                    self.timings[self.turn][name] += time.perf_counter() - start
+
+        return timed
+
+
+def run_once(
+    server: MockAnthropicServer, mode: str, prompt: str, workdir: str, execute: bool
+) -> List[Dict[str, float]]:
+    """Run one replay of the conversation and return per-turn phase timings"""
+    server.reset()
+    if mode == "editor":
+        session = EditorSession()
+        session.editor_dir = workdir
+    else:
+        session = BashSession(no_agi=not execute)
+
+    session_logger = SessionLogger(session.session_id, workdir, console=False)
+    session.set_logger(session_logger)
+    session.client = anthropic.Anthropic(api_key="benchmark", base_url=server.url)
+
+    recorder = Recorder()
+    create = session.client.beta.messages.create
+    session.client.beta.messages.create = recorder.wrap("api", create)
+    session._request_params = recorder.wrap("request", session._request_params)
+    for method in ("_handle_response", "_add_tool_results", "_compact_history"):
+        setattr(session, method, recorder.wrap("history", getattr(session, method)))
+    session.process_tool_calls = recorder.wrap("tools", session.process_tool_calls)
+    session_logger.logger.handle = recorder.wrap("logging", session_logger.logger.handle)
+
+    # The final response is printed; keep the report readable
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        if mode == "editor":
+            session.process_edit(prompt)
+        else:
+            session.process_bash_command(prompt)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        session.close()
+        session_logger.close()
+    return recorder.timings
+
+
+def report(name: str, timings: List[Dict[str, float]]) -> None:
+    print(f"\n{name}: {len(timings)} turns")
+    print(f"{'phase':<10}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'total ms':>11}")
+    for phase in PHASES:
+        values = sorted(turn.get(phase, 0.0) * 1000 for turn in timings)
+        if not values:
+            continue
+        p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+        print(
+            f"{phase:<10}{statistics.mean(values):>10.3f}{statistics.median(values):>10.3f}"
+            f"{p95:>10.3f}{sum(values):>11.1f}"
+        )
+    client_side = [
+        sum(turn.get(phase, 0.0) for phase in ("request", "history", "tools")) * 1000
+        for turn in timings
+    ]
+    print(f"client-side overhead per turn (excl. api): {statistics.mean(client_side):.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the agent loop against a mock API")
+    parser.add_argument("--log", action="append", default=[], help="Session log(s) to replay")
+    parser.add_argument("--mode", choices=["editor", "bash"], default="editor")
+    parser.add_argument("--turns", type=int, default=20, help="Turns in the synthetic conversation")
+    parser.add_argument("--runs", type=int, default=5, help="Replays of each conversation")
+    parser.add_argument(
+        "--execute", action="store_true", help="Really run bash commands instead of --no-agi"
+    )
+    args = parser.parse_args()
+
+    conversations = []
+    for log_path in args.log:
+        recorded = load_session_log(log_path)
+        mode = _detect_mode(recorded["responses"])
+        conversations.append((log_path, mode, recorded["prompt"] or "", recorded["responses"]))
+    if not conversations:
+        responses = synthetic_responses(args.mode, args.turns)
+        conversations.append((f"synthetic {args.mode}", args.mode, "benchmark", responses))
+
+    for name, mode, prompt, responses in conversations:
+        timings = []
+        with MockAnthropicServer(responses) as server, tempfile.TemporaryDirectory() as workdir:
+            for _ in range(args.runs):
+                timings.extend(run_once(server, mode, prompt, workdir, args.execute))
+        report(name, timings)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+"""Memoized results of read-only bash commands.
+
+Agents re-run the same inspection commands (`ls -la`, `cat config`, `git
+status`) many times in a session. A command is only served from the cache
+if it is read-only (see shell.is_read_only_command) and nothing it could
+have read has changed since it ran: its result is stored with the stat
+stamps of the paths it names, the directories those paths live in and,
+for recursive commands, every file under them. Results are kept per
+working directory and environment. Commands with parameter or command
+substitutions, and commands reading /proc, /sys or /dev, whose contents
+change without their stamps changing, are never cached. Any mutating
+command run by the session clears the whole cache, since its effects
+can't be known.
+"""
+
+import glob
+import os
+import stat
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .shell import CommandResult, has_expansions, is_read_only_command, split_command
+
+# Commands whose results are kept
+COMMAND_CACHE_MAX_ENTRIES = int(os.environ.get("BASH_COMMAND_CACHE_MAX_ENTRIES", 256))
+
+# Commands depending on more paths than this are not cached; checking them
+# would cost about as much as running the command
+MAX_WATCHED_PATHS = 2000
+
+# Read-only programs whose output changes without any file changing
+VOLATILE_PROGRAMS = {"date", "df", "sleep", "stat"}
+
+# Programs that read whole directory trees, and the flags that make
+# `grep` and `ls` do so
+RECURSIVE_PROGRAMS = {"du", "find", "git", "rg", "tree"}
+RECURSIVE_FLAGS = {"grep": ("r", "R"), "ls": ("R",)}
+
+# Pseudo-filesystems whose contents change without their stat stamps changing
+VOLATILE_PATHS = ("/proc", "/sys", "/dev")
+
+# Paths inside a git directory that git status, log and diff depend on
+GIT_STATE_PATHS = ["HEAD", "index", "packed-refs", "refs/heads"]
+
+# (mtime_ns, ctime_ns, size, ino), followed by the same for the target of a
+# symlink, or None for a missing path
+Stamp = Optional[Tuple[int, ...]]
+
+# (command, working directory, environment changes) of a cached result
+Key = Tuple[str, str, Tuple[Tuple[str, Optional[str]], ...]]
+
+
+def _stat_stamp(st: os.stat_result) -> Tuple[int, ...]:
+    return (st.st_mtime_ns, st.st_ctime_ns, st.st_size, st.st_ino)
+
+
+def path_stamp(path: str) -> Stamp:
+    """Stamp of a path and, for a symlink, of its target.
+
+    ctime covers chmod and hard links that leave mtime alone. The target's
+    stamp catches writes through the link and the link being repointed
+    further down a chain.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    stamp = _stat_stamp(st)
+    if stat.S_ISLNK(st.st_mode):
+        try:
+            stamp += _stat_stamp(os.stat(path))
+        except OSError:
+            # Dangling; the stamp grows once the target appears
+            pass
+    return stamp
+
+
+def _is_volatile(path: str) -> bool:
+    real = os.path.realpath(path)
+    return any(real == root or real.startswith(root + os.sep) for root in VOLATILE_PATHS)
+
+
+def _is_recursive(program: str, words: List[str]) -> bool:
+    if program in RECURSIVE_PROGRAMS:
+        return True
+    letters = RECURSIVE_FLAGS.get(program, ())
+    for word in words[1:]:
+        if word == "--recursive" or word == "--dereference-recursive":
+            return True
+        if word.startswith("-") and not word.startswith("--"):
+            if any(letter in word for letter in letters):
+                return True
+    return False
+
+
+def _git_root(directory: str) -> Optional[str]:
+    while True:
+        if os.path.exists(os.path.join(directory, ".git")):
+            return directory
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+
+def _key(command: str, cwd: str, env: Dict[str, Optional[str]]) -> Key:
+    return (command, cwd, tuple(sorted(env.items())))
+
+
+class _Watch:
+    """Stamps of the paths a command depends on, up to a limit"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.stamps: Dict[str, Stamp] = {}
+
+    @property
+    def full(self) -> bool:
+        return len(self.stamps) > self.limit
+
+    def add(self, path: str) -> None:
+        if path not in self.stamps:
+            self.stamps[path] = path_stamp(path)
+
+    def add_named(self, path: str) -> None:
+        """A path named by the command: it, its entries if a directory, else its directory"""
+        self.add(path)
+        if os.path.isdir(path):
+            self.add_tree(path, recursive=False)
+        else:
+            # Catches the path being created, or a glob matching more files
+            self.add(os.path.dirname(path))
+
+    def add_tree(self, root: str, recursive: bool, skip: Iterable[str] = ()) -> None:
+        """A directory and its entries, all the way down if `recursive`"""
+        self.add(root)
+        pending = [root]
+        while pending and not self.full:
+            try:
+                entries = list(os.scandir(pending.pop()))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.name in skip:
+                    continue
+                self.add(entry.path)
+                if recursive and entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+
+    def changed(self) -> bool:
+        return any(path_stamp(path) != stamp for path, stamp in self.stamps.items())
+
+
+class CachedCommand:
+    """A command's result and the stamps taken just before it ran"""
+
+    def __init__(self, result: CommandResult, watch: _Watch):
+        self.result = result
+        self.watch = watch
+
+
+class CommandCache:
+    """LRU of read-only command results keyed by (command, working directory, environment)"""
+
+    def __init__(
+        self, max_entries: int = COMMAND_CACHE_MAX_ENTRIES, max_watched_paths: int = MAX_WATCHED_PATHS
+    ):
+        self.max_entries = max_entries
+        self.max_watched_paths = max_watched_paths
+        self.entries: "OrderedDict[Key, CachedCommand]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def watch(self, command: str, cwd: str) -> Optional[_Watch]:
+        """Stamp what a command depends on before it runs; None if it can't be cached"""
+        if not is_read_only_command(command) or has_expansions(command, globs=False):
+            return None
+        if _is_volatile(cwd):
+            return None
+        watch = _Watch(self.max_watched_paths)
+        watch.add_tree(cwd, recursive=False)
+        for words in split_command(command):
+            program = os.path.basename(words[0])
+            if program in VOLATILE_PROGRAMS:
+                return None
+            recursive = _is_recursive(program, words)
+            if program == "git":
+                root = _git_root(cwd)
+                if root is None:
+                    continue
+                git_dir = os.path.join(root, ".git")
+                for name in GIT_STATE_PATHS:
+                    watch.add_named(os.path.join(git_dir, name))
+                watch.add_tree(root, recursive=True, skip=(".git",))
+                continue
+
+            named = []
+            for word in words[1:]:
+                if word.startswith("-"):
+                    continue
+                path = os.path.join(cwd, os.path.expanduser(word))
+                if glob.has_magic(word):
+                    named.extend(glob.glob(path))
+                    named.append(os.path.dirname(path))
+                else:
+                    named.append(path)
+            if any(_is_volatile(path) for path in named):
+                return None
+            for path in named:
+                if recursive and os.path.isdir(path):
+                    watch.add_tree(path, recursive=True)
+                else:
+                    watch.add_named(path)
+            if recursive and not any(os.path.isdir(path) for path in named):
+                # find, rg, tree and du default to the working directory
+                watch.add_tree(cwd, recursive=True)
+            if watch.full:
+                return None
+        return watch
+
+    def get(
+        self, command: str, cwd: str, env: Dict[str, Optional[str]]
+    ) -> Optional[CommandResult]:
+        """The stored result of a command, if nothing it depends on has changed.
+
+        `env` is the shell's ShellState.env_changes.
+        """
+        key = _key(command, cwd, env)
+        with self.lock:
+            cached = self.entries.get(key)
+        if cached is None:
+            return None
+        if cached.watch.changed():
+            with self.lock:
+                if self.entries.get(key) is cached:
+                    del self.entries[key]
+            return None
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+        result = cached.result
+        # A cached result took no time, so it doesn't count against budgets
+        return CommandResult(result.stdout, result.stderr, result.returncode, 0.0)
+
+    def record(
+        self,
+        command: str,
+        cwd: str,
+        env: Dict[str, Optional[str]],
+        watch: Optional[_Watch],
+        result: CommandResult,
+    ) -> None:
+        """Store a finished command's result, or clear the cache if it may have changed state"""
+        with self.lock:
+            if not is_read_only_command(command):
+                self.entries.clear()
+                return
+            if watch is None or result.timed_out:
+                return
+            key = _key(command, cwd, env)
+            self.entries[key] = CachedCommand(result, watch)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,179 @@
+"""Keep the conversation history of long sessions under a token budget.
+
+Every turn re-sends the whole history, and most of it is tool output: full
+file views and command output that later turns have made stale. Compaction
+replaces old tool payloads with a short summary (line count, size and hash)
+while leaving the most recent messages verbatim.
+"""
+
+import hashlib
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+# Rough size of a token, good enough to decide when to compact
+CHARS_PER_TOKEN = 4
+
+# Messages at the end of the history that are never compacted
+KEEP_RECENT_MESSAGES = 6
+
+# Payloads smaller than this are not worth replacing with a summary
+MIN_COMPACT_CHARS = 400
+
+# Compact down to this fraction of the budget, so compaction (which
+# invalidates the prompt cache from the first changed message) is rare
+COMPACTION_TARGET_RATIO = 0.75
+
+COMPACTED_MARKER = "[compacted"
+
+# Editor commands whose result or input holds file content
+FILE_CONTENT_COMMANDS = ("view", "create", "str_replace", "insert", "undo_edit")
+
+
+def _text_size(block: Dict[str, Any]) -> int:
+    if block.get("type") == "text":
+        return len(block.get("text", ""))
+    if block.get("type") == "tool_result":
+        content = block.get("content", "")
+        if isinstance(content, str):
+            return len(content)
+        return sum(_text_size(item) for item in content)
+    if block.get("type") == "tool_use":
+        return len(json.dumps(block.get("input", {})))
+    return 0
+
+
+def estimate_tokens(messages: List[Dict[str, Any]]) -> int:
+    """Approximate the number of input tokens the messages will cost"""
+    chars = 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            chars += len(content)
+        else:
+            chars += sum(_text_size(block) for block in content)
+    return chars // CHARS_PER_TOKEN
+
+
+def summarize_text(text: str, label: str) -> str:
+    """A short stand-in for a compacted payload"""
+    digest = hashlib.sha256(text.encode(errors="replace")).hexdigest()[:12]
+    lines = text.count("\n") + 1 if text else 0
+    return (
+        f"{COMPACTED_MARKER} {label}: {lines} lines, {len(text)} chars, "
+        f"sha256 {digest}]"
+    )
+
+
+def _result_text(block: Dict[str, Any]) -> Optional[str]:
+    content = block.get("content")
+    if isinstance(content, str):
+        return content
+    if content and all(item.get("type") == "text" for item in content):
+        return "\n".join(item["text"] for item in content)
+    return None
+
+
+def _tool_uses(messages: List[Dict[str, Any]]) -> Dict[str, Tuple[int, Dict[str, Any]]]:
+    """Map tool_use ids to (message index, tool_use block)"""
+    uses = {}
+    for index, message in enumerate(messages):
+        if message["role"] != "assistant" or isinstance(message["content"], str):
+            continue
+        for block in message["content"]:
+            if block.get("type") == "tool_use":
+                uses[block["id"]] = (index, block)
+    return uses
+
+
+def _candidates(
+    messages: List[Dict[str, Any]], keep_recent: int
+) -> List[Tuple[int, int, int, str]]:
+    """List compactable payloads as (priority, message index, block index, label).
+
+    Priority 0 is file content that a later call touched again (stale views
+    and superseded `create` texts); priority 1 is any other old payload.
+    """
+    uses = _tool_uses(messages)
+    last_touch: Dict[str, int] = {}
+    for index, block in uses.values():
+        path = block.get("input", {}).get("path")
+        if path and block["input"].get("command") in FILE_CONTENT_COMMANDS:
+            last_touch[path] = max(last_touch.get(path, -1), index)
+
+    candidates = []
+    for index, message in enumerate(messages[: max(0, len(messages) - keep_recent)]):
+        if isinstance(message["content"], str):
+            continue
+        for block_index, block in enumerate(message["content"]):
+            if block.get("type") == "tool_result":
+                use_index, use = uses.get(block.get("tool_use_id"), (None, {}))
+                tool_input = use.get("input", {})
+                command = tool_input.get("command")
+                path = tool_input.get("path")
+                if path and command == "view":
+                    stale = last_touch.get(path, -1) > use_index
+                    label = f"{'stale ' if stale else ''}view of {path}"
+                    priority = 0 if stale else 1
+                else:
+                    label = f"output of {command!r}" if command else "tool output"
+                    priority = 1
+                candidates.append((priority, index, block_index, label))
+            elif block.get("type") == "tool_use":
+                tool_input = block.get("input", {})
+                path = tool_input.get("path")
+                if "file_text" in tool_input:
+                    stale = last_touch.get(path, -1) > index
+                    candidates.append(
+                        (0 if stale else 1, index, block_index, f"file_text for {path}")
+                    )
+    candidates.sort(key=lambda candidate: (candidate[0], candidate[1]))
+    return candidates
+
+
+def _compact_block(block: Dict[str, Any], label: str) -> int:
+    """Replace a block's payload with a summary; return the chars saved"""
+    if block["type"] == "tool_use":
+        text = block["input"].get("file_text", "")
+        if len(text) < MIN_COMPACT_CHARS or text.startswith(COMPACTED_MARKER):
+            return 0
+        summary = summarize_text(text, label)
+        block["input"] = {**block["input"], "file_text": summary}
+        return len(text) - len(summary)
+
+    text = _result_text(block)
+    if text is None or len(text) < MIN_COMPACT_CHARS or text.startswith(COMPACTED_MARKER):
+        return 0
+    summary = summarize_text(text, label)
+    if "view" in label:
+        summary += " Use `view` again to see the current content."
+    block["content"] = [{"type": "text", "text": summary}]
+    return len(text) - len(summary)
+
+
+def compact_messages(
+    messages: List[Dict[str, Any]],
+    token_budget: int,
+    keep_recent: int = KEEP_RECENT_MESSAGES,
+) -> int:
+    """Compact old tool payloads in place until the history fits the budget.
+
+    Does nothing while the history is within `token_budget`. Otherwise
+    payloads are replaced, stale file content first and oldest first, until
+    the estimate drops to COMPACTION_TARGET_RATIO of the budget or nothing
+    compactable is left. Returns the estimated number of tokens saved.
+    """
+    tokens = estimate_tokens(messages)
+    if tokens <= token_budget:
+        return 0
+
+    target = int(token_budget * COMPACTION_TARGET_RATIO)
+    saved = 0
+    for _, index, block_index, label in _candidates(messages, keep_recent):
+        if tokens - saved <= target:
+            break
+        # Copy the message so dicts shared with earlier requests stay intact
+        message = messages[index] = {**messages[index]}
+        content = message["content"] = list(message["content"])
+        block = content[block_index] = {**content[block_index]}
+        saved += _compact_block(block, label) // CHARS_PER_TOKEN
+    return saved
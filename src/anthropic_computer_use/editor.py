@@ -0,0 +1,749 @@
+"""File access helpers used by EditorSession's text editor tool."""
+
+import codecs
+import mmap
+import os
+import re
+import tempfile
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+READ_CHUNK_SIZE = 1024 * 1024
+
+# Distance in bytes between LineIndex checkpoints; locating a line scans at
+# most about this much of the file
+INDEX_STRIDE = 64 * 1024
+
+# A `view` without view_range returns the whole file up to this size;
+# larger files, and ranged views, are returned a page at a time
+VIEW_MAX_BYTES = 256 * 1024
+VIEW_PAGE_LINES = 2000
+
+# With group commit, fsyncs of files written within this many seconds of
+# each other are done together by a background flush
+GROUP_COMMIT_INTERVAL = 0.05
+
+# Mode bits for new files; mkstemp would otherwise leave them 0600
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+# Content cache budget, and the largest file it holds
+CONTENT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+CONTENT_CACHE_MAX_FILE_BYTES = 4 * 1024 * 1024
+
+# Bytes read from the start of a file to tell text from binary
+SNIFF_BYTES = 8192
+
+# Share of control characters above which a file without NULs is binary
+MAX_CONTROL_RATIO = 0.3
+
+# Signatures of common binary formats, checked against the start of the file
+MAGIC_NUMBERS = [
+    (b"\x89PNG\r\n\x1a\n", "PNG image"),
+    (b"\xff\xd8\xff", "JPEG image"),
+    (b"GIF87a", "GIF image"),
+    (b"GIF89a", "GIF image"),
+    (b"%PDF-", "PDF document"),
+    (b"PK\x03\x04", "Zip archive"),
+    (b"\x1f\x8b", "gzip data"),
+    (b"BZh", "bzip2 data"),
+    (b"\xfd7zXZ\x00", "xz data"),
+    (b"7z\xbc\xaf\x27\x1c", "7-zip archive"),
+    (b"\x7fELF", "ELF executable"),
+    (b"\xca\xfe\xba\xbe", "Java class or Mach-O binary"),
+    (b"\x00asm", "WebAssembly module"),
+    (b"SQLite format 3\x00", "SQLite database"),
+]
+
+# Byte order marks, longest first, and the codecs that read what follows
+BYTE_ORDER_MARKS = [
+    (b"\xff\xfe\x00\x00", "utf-32-le"),
+    (b"\x00\x00\xfe\xff", "utf-32-be"),
+    (b"\xef\xbb\xbf", "utf-8"),
+    (b"\xff\xfe", "utf-16-le"),
+    (b"\xfe\xff", "utf-16-be"),
+]
+
+# Control characters that are normal in text: \b \t \n \f \r and escape
+TEXT_CONTROL_BYTES = b"\x08\t\n\x0c\r\x1b"
+
+# Resolved tool paths remembered by PathResolver
+MAX_RESOLVED_PATHS = 4096
+
+# Positions reported when old_str matches more than once
+MAX_REPORTED_MATCHES = 10
+
+# Directory listings go this many levels deep and stop after this many entries
+LISTING_DEPTH = 2
+MAX_LISTING_ENTRIES = 1000
+
+
+def file_stamp(st: os.stat_result) -> Tuple[int, int, int]:
+    """What has to match for cached facts about a file to still hold"""
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+class FileKind:
+    """What sniff_file() found out about a file.
+
+    For text, `encoding` is the codec for its content and `bom` the byte
+    order mark it starts with, if any. For binary files, `description`
+    names the format where it is recognized.
+    """
+
+    def __init__(
+        self,
+        binary: bool,
+        size: int,
+        encoding: Optional[str] = None,
+        bom: bytes = b"",
+        description: str = "",
+    ):
+        self.binary = binary
+        self.size = size
+        self.encoding = encoding
+        self.bom = bom
+        self.description = description
+
+    @property
+    def ascii_compatible(self) -> bool:
+        """Whether newlines and ASCII text are single bytes, as the line index assumes"""
+        return self.encoding in ("utf-8", "latin-1")
+
+    def summary(self, path: str) -> str:
+        return f"{path} is a binary file ({self.description}, {self.size} bytes); not shown"
+
+    def decode(self, data: bytes) -> str:
+        """Text of the whole file's content"""
+        return data[len(self.bom) :].decode(self.encoding, errors="replace")
+
+
+def sniff_file(path: str) -> FileKind:
+    """Tell text from binary, and find the encoding of text, from the file's start.
+
+    Reads at most SNIFF_BYTES. Files without a byte order mark are UTF-8
+    if that prefix decodes as UTF-8 and Latin-1 otherwise; Latin-1 maps
+    every byte, so edits round-trip exactly.
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        prefix = os.pread(f.fileno(), SNIFF_BYTES, 0)
+
+    for bom, encoding in BYTE_ORDER_MARKS:
+        if prefix.startswith(bom):
+            return FileKind(False, size, encoding, bom)
+    for magic, description in MAGIC_NUMBERS:
+        if prefix.startswith(magic):
+            return FileKind(True, size, description=description)
+    if b"\x00" in prefix:
+        return FileKind(True, size, description="data")
+    controls = len(prefix.translate(None, bytes(range(32, 256)) + TEXT_CONTROL_BYTES))
+    if prefix and controls / len(prefix) > MAX_CONTROL_RATIO:
+        return FileKind(True, size, description="data")
+
+    try:
+        # Not final: the prefix may end inside a multi-byte character
+        codecs.getincrementaldecoder("utf-8")().decode(prefix, final=size <= SNIFF_BYTES)
+    except UnicodeDecodeError:
+        return FileKind(False, size, "latin-1")
+    return FileKind(False, size, "utf-8")
+
+
+class TextLines:
+    """LineIndex's reading interface over already decoded text.
+
+    Used for text in encodings (UTF-16, UTF-32) whose newlines aren't
+    single bytes; read_lines() returns UTF-8.
+    """
+
+    def __init__(self, text: str):
+        self.lines = text.split("\n")
+        if self.lines[-1] == "":
+            self.lines.pop()
+
+    @property
+    def line_count(self) -> int:
+        return len(self.lines)
+
+    def read_lines(self, start: int, end: int) -> bytes:
+        selected = self.lines[start - 1 : None if end == -1 else end]
+        return "".join(line + "\n" for line in selected).encode()
+
+
+class PathResolver:
+    """Maps paths from tool calls to files under `root`, and keeps them there.
+
+    A leading /repo/ (the tool's view of the project) or `root` itself is
+    stripped, other absolute paths are taken as relative to `root`, and the
+    result is normalized; paths that still leave `root` through `..` are
+    rejected. That lexical step is cached per path. Symlinks can be planted
+    at any time (the bash tool shares the directory), so the real path is
+    checked against `root` on every call.
+    """
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        self.real_root = os.path.realpath(self.root)
+        self.resolved: Dict[str, str] = {}
+
+    def resolve(self, path: str) -> str:
+        resolved = self.resolved.get(path)
+        if resolved is None:
+            resolved = self._resolve(path)
+            if len(self.resolved) >= MAX_RESOLVED_PATHS:
+                self.resolved.clear()
+            self.resolved[path] = resolved
+        # Follows the symlinks among the parts that exist, so a new file is
+        # checked by where its nearest existing parent really is
+        real = os.path.realpath(resolved)
+        if real != self.real_root and not real.startswith(self.real_root + os.sep):
+            raise ValueError(f"Path {path} is outside the editor directory")
+        return resolved
+
+    def _resolve(self, path: str) -> str:
+        if path == self.root or path.startswith(self.root + os.sep):
+            relative = path[len(self.root) :]
+        elif path == "/repo" or path.startswith("/repo/"):
+            relative = path[len("/repo") :]
+        else:
+            relative = path
+        resolved = os.path.normpath(os.path.join(self.root, relative.lstrip("/")))
+        if resolved != self.root and not resolved.startswith(self.root + os.sep):
+            raise ValueError(f"Path {path} is outside the editor directory")
+        return resolved
+
+    def make_parent(self, path: str) -> None:
+        """Create the directory a file is about to be written to"""
+        # Not remembered: the directory may be removed behind our back
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+
+class LineIndex:
+    """Sparse map from line numbers to byte offsets in one file.
+
+    Keeps a checkpoint (line number, offset of that line's start) about every
+    INDEX_STRIDE bytes, so finding a line reads at most one stride of the
+    file instead of everything before it. Built with one sequential pass and
+    adjusted in place by apply_edit() when the file is edited.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lines: List[int] = [0]
+        self.offsets: List[int] = [0]
+        self.newlines = 0
+        self.size = 0
+        self.ends_with_newline = True
+        self.stamp: Optional[Tuple[int, int, int]] = None
+
+    @classmethod
+    def build(cls, path: str) -> "LineIndex":
+        index = cls(path)
+        with open(path, "rb") as f:
+            index.stamp = file_stamp(os.fstat(f.fileno()))
+            offset = 0
+            while True:
+                chunk = f.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                counted = 0
+                for start in range(0, len(chunk), INDEX_STRIDE):
+                    newline = chunk.find(b"\n", start, start + INDEX_STRIDE)
+                    if newline < 0:
+                        continue
+                    index.newlines += chunk.count(b"\n", counted, newline + 1)
+                    counted = newline + 1
+                    index.lines.append(index.newlines)
+                    index.offsets.append(offset + newline + 1)
+                index.newlines += chunk.count(b"\n", counted)
+                offset += len(chunk)
+                index.ends_with_newline = chunk.endswith(b"\n")
+        index.size = offset
+        return index
+
+    @property
+    def line_count(self) -> int:
+        """Number of lines, counting a final line without a newline"""
+        return self.newlines + (0 if self.ends_with_newline else 1)
+
+    def _locate(self, data: mmap.mmap, line: int, hint: Tuple[int, int] = (0, 0)) -> int:
+        """Byte offset where the 0-based `line` starts (the file size past the end)"""
+        if line > self.newlines:
+            return self.size
+        checkpoint = bisect_right(self.lines, line) - 1
+        known_line, offset = max((self.lines[checkpoint], self.offsets[checkpoint]), hint)
+        for _ in range(line - known_line):
+            offset = data.find(b"\n", offset) + 1
+        return offset
+
+    def line_at(self, data: Union[bytes, mmap.mmap], offset: int) -> int:
+        """1-based number of the line containing byte `offset`"""
+        checkpoint = bisect_right(self.offsets, offset) - 1
+        start = self.offsets[checkpoint]
+        return self.lines[checkpoint] + data[start:offset].count(b"\n") + 1
+
+    def line_offset(self, line: int) -> int:
+        """Byte offset where the 0-based `line` starts"""
+        if self.size == 0:
+            return 0
+        with open(self.path, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as data:
+            return self._locate(data, line)
+
+    def read_lines(self, start: int, end: int) -> bytes:
+        """Bytes of lines `start` to `end` (1-based, inclusive; -1 is the last line)"""
+        if self.size == 0:
+            return b""
+        with open(self.path, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as data:
+            first = self._locate(data, start - 1)
+            if end == -1 or end >= self.line_count:
+                return data[first : self.size]
+            return data[first : self._locate(data, end, (start - 1, first))]
+
+    def apply_edit(
+        self,
+        offset: int,
+        removed: int,
+        inserted: int,
+        line_delta: int,
+        stamp: Tuple[int, int, int],
+    ) -> None:
+        """Adjust for `removed` bytes at `offset` being replaced by `inserted` bytes.
+
+        `line_delta` is the change in the number of newlines and `stamp` the
+        file's stamp after the edit. Checkpoints inside the replaced bytes are
+        dropped; later ones are shifted.
+        """
+        end = offset + removed
+        old_size = self.size
+        keep = bisect_right(self.offsets, offset)
+        after = bisect_right(self.offsets, end)
+        self.lines[keep:] = [line + line_delta for line in self.lines[after:]]
+        self.offsets[keep:] = [
+            checkpoint + inserted - removed for checkpoint in self.offsets[after:]
+        ]
+        self.newlines += line_delta
+        self.size += inserted - removed
+        self.stamp = stamp
+        # Only an edit reaching the end of the file can change its last byte
+        if end >= old_size:
+            if self.size:
+                with open(self.path, "rb") as f:
+                    last = os.pread(f.fileno(), 1, self.size - 1)
+                self.ends_with_newline = last == b"\n"
+            else:
+                self.ends_with_newline = True
+
+
+def open_mmap(path: str) -> Optional[mmap.mmap]:
+    """Read-only map of a file, or None for an empty file (which can't be mapped)"""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def find_matches(
+    data: Union[bytes, mmap.mmap, None], needle: bytes, keep: int = MAX_REPORTED_MATCHES
+) -> Tuple[int, List[int]]:
+    """Count occurrences of `needle`, overlapping ones included.
+
+    Returns the count and the offsets of the first `keep` occurrences.
+    """
+    count = 0
+    matches: List[int] = []
+    position = data.find(needle) if data is not None else -1
+    while position >= 0:
+        count += 1
+        if count <= keep:
+            matches.append(position)
+        position = data.find(needle, position + 1)
+    return count, matches
+
+
+def _trie_regex(patterns: List[bytes]) -> bytes:
+    """Regex matching any of `patterns`, preferring the longest at a position.
+
+    The patterns are merged into a trie so that common prefixes are
+    matched once, instead of trying every pattern in turn at each position.
+    """
+    trie: Dict[Optional[int], Any] = {}
+    for pattern in patterns:
+        node = trie
+        for byte in pattern:
+            node = node.setdefault(byte, {})
+        node[None] = {}
+
+    def build(node: Dict[Optional[int], Any]) -> bytes:
+        literal = b""
+        # Follow chains without branches as one literal run
+        while len(node) == 1 and None not in node:
+            byte, node = next(iter(node.items()))
+            literal += bytes([byte])
+        branches = [
+            re.escape(bytes([byte])) + build(child)
+            for byte, child in node.items()
+            if byte is not None
+        ]
+        if not branches:
+            return re.escape(literal)
+        alternation = b"(?:" + b"|".join(branches) + b")"
+        # Optional (greedy) when a pattern can also end here
+        return re.escape(literal) + alternation + (b"?" if None in node else b"")
+
+    return build(trie)
+
+
+def scan_patterns(
+    data: Union[bytes, mmap.mmap, None], patterns: List[bytes], keep: int = MAX_REPORTED_MATCHES
+) -> List[Tuple[int, List[int]]]:
+    """find_matches() for several patterns with a single pass over `data`.
+
+    The patterns are compiled into one trie-shaped regex, which the regex
+    engine scans for in one pass; each search resumes one byte after the
+    previous match start, so overlapping matches are found. Where several
+    patterns match at one position the regex reports the longest; the
+    others are its prefixes and are credited from it.
+    """
+    results: List[Tuple[int, List[int]]] = [(0, []) for _ in patterns]
+    distinct = set(patterns)
+    if data is None or not distinct:
+        return results
+    regex = re.compile(_trie_regex(sorted(distinct)))
+    # Indexes of the patterns credited by a match of each distinct pattern
+    credited = {
+        longer: [index for index, pattern in enumerate(patterns) if longer.startswith(pattern)]
+        for longer in distinct
+    }
+    match = regex.search(data)
+    while match is not None:
+        for index in credited[match.group()]:
+            count, positions = results[index]
+            if count < keep:
+                positions.append(match.start())
+            results[index] = (count + 1, positions)
+        match = regex.search(data, match.start() + 1)
+    return results
+
+
+class CachedFile:
+    """Content of a file as of `stamp`; `text` is decoded on first use"""
+
+    def __init__(self, data: bytes, stamp: Tuple[int, int, int]):
+        self.data = data
+        self.stamp = stamp
+        self.text: Optional[str] = None
+        self.text_encoding: Optional[str] = None
+
+    @property
+    def size(self) -> int:
+        return len(self.data) + (len(self.text) if self.text is not None else 0)
+
+
+class ContentCache:
+    """LRU of file contents, capped at `max_bytes` in total.
+
+    Entries are checked against the file's stamp (mtime_ns, size, inode) on
+    every read, which costs a stat but no read or decode, and the editor's
+    own edits update them in place. Files over `max_file_bytes` are not
+    cached; large files are read through mmap and the line index instead.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = CONTENT_CACHE_MAX_BYTES,
+        max_file_bytes: int = CONTENT_CACHE_MAX_FILE_BYTES,
+    ):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.files: "OrderedDict[str, CachedFile]" = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def _entry(self, path: str) -> Optional[CachedFile]:
+        """The cached content of `path`, loaded if missing or stale"""
+        stamp = file_stamp(os.stat(path))
+        with self.lock:
+            entry = self.files.get(path)
+            if entry is not None and entry.stamp == stamp:
+                self.files.move_to_end(path)
+                return entry
+        if stamp[1] > self.max_file_bytes:
+            return None
+        with open(path, "rb") as f:
+            # Stamp the content actually read, in case the file just changed
+            entry = CachedFile(f.read(), file_stamp(os.fstat(f.fileno())))
+        self._store(path, entry)
+        return entry
+
+    def _store(self, path: str, entry: Optional[CachedFile]) -> None:
+        with self.lock:
+            previous = self.files.pop(path, None)
+            if previous is not None:
+                self.size -= previous.size
+            if entry is None or len(entry.data) > self.max_file_bytes:
+                return
+            self.files[path] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes:
+                _, evicted = self.files.popitem(last=False)
+                self.size -= evicted.size
+
+    def read(self, path: str) -> Optional[bytes]:
+        """Content of `path`, or None if it is too big to cache"""
+        entry = self._entry(path)
+        return entry.data if entry is not None else None
+
+    def read_text(self, path: str, kind: FileKind) -> str:
+        """Content of `path` decoded as `kind` says, invalid bytes replaced"""
+        entry = self._entry(path)
+        if entry is None:
+            with open(path, "rb") as f:
+                return kind.decode(f.read())
+        if entry.text is None or entry.text_encoding != kind.encoding:
+            text = kind.decode(entry.data)
+            with self.lock:
+                if self.files.get(path) is entry:
+                    self.size += len(text) - (len(entry.text) if entry.text is not None else 0)
+                entry.text = text
+                entry.text_encoding = kind.encoding
+        return entry.text
+
+    def put(self, path: str, data: bytes, stamp: Tuple[int, int, int]) -> None:
+        """Record content the editor just wrote"""
+        self._store(path, CachedFile(data, stamp))
+
+    def splice(
+        self, path: str, offset: int, removed: int, inserted: bytes, stamp: Tuple[int, int, int]
+    ) -> None:
+        """Apply an edit the editor just made to the cached content, if cached"""
+        with self.lock:
+            entry = self.files.get(path)
+        if entry is not None:
+            data = entry.data[:offset] + inserted + entry.data[offset + removed :]
+            self._store(path, CachedFile(data, stamp))
+
+    def discard(self, path: str) -> None:
+        self._store(path, None)
+
+
+def _copy_range(src: int, dst: int, offset: int, count: int) -> None:
+    """Copy `count` bytes at `offset` of file descriptor `src` to `dst`'s position"""
+    while count > 0:
+        if hasattr(os, "copy_file_range"):
+            try:
+                copied = os.copy_file_range(src, dst, count, offset)
+            except OSError:
+                copied = 0
+        else:
+            copied = 0
+        if not copied:
+            # Not supported here (e.g. across filesystems); fall back to read/write
+            chunk = os.pread(src, min(count, READ_CHUNK_SIZE), offset)
+            if not chunk:
+                raise EOFError(f"File shrank while being copied at offset {offset}")
+            copied = os.write(dst, chunk)
+        offset += copied
+        count -= copied
+
+
+def _write_all(fd: int, data: bytes) -> None:
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view) :]
+
+
+def _fsync_path(path: str, directory: bool = False) -> None:
+    fd = os.open(path, os.O_RDONLY | (os.O_DIRECTORY if directory else 0))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class FileWriter:
+    """The editor's one write path: temporary file, fsync, rename.
+
+    Each write goes to a temporary file next to the target which is renamed
+    over it, so a concurrent reader sees either the old or the new content.
+    By default the data is fsynced before the rename and the directory
+    entry after it, so a crash also leaves the old or the new content.
+
+    With group_commit the fsyncs are left to a background thread that
+    flushes every file written within GROUP_COMMIT_INTERVAL in one pass, so
+    a burst of edits does not wait on one fsync each. The rename still
+    happens in write(), since the bash tool must see the edit at once, so
+    until the next flush a crash can leave a file empty or truncated; call
+    flush() or close() to wait for durability.
+    """
+
+    def __init__(self, group_commit: bool = False, interval: float = GROUP_COMMIT_INTERVAL):
+        self.group_commit = group_commit
+        self.interval = interval
+        self.pending: Dict[str, None] = {}
+        self.condition = threading.Condition()
+        self.sync_lock = threading.Lock()
+        self.flusher: Optional[threading.Thread] = None
+        self.closed = False
+
+    def write(self, path: str, data: bytes) -> None:
+        """Replace the file at `path` with `data`"""
+        self._replace(path, lambda src, dst: _write_all(dst, data))
+
+    def splice(self, path: str, offset: int, removed: int, inserted: bytes) -> None:
+        """Replace `removed` bytes at `offset` with `inserted`.
+
+        The rest of the file is streamed around the change (in the kernel
+        where copy_file_range is available); it is never held in memory.
+        """
+        self.splice_many(path, [(offset, removed, inserted)])
+
+    def splice_many(self, path: str, hunks: List[Tuple[int, int, bytes]]) -> None:
+        """Apply several (offset, removed, inserted) splices in one pass.
+
+        Offsets refer to the current file; hunks must be sorted by offset
+        and must not overlap.
+        """
+
+        def fill(src: int, dst: int) -> None:
+            position = 0
+            for offset, removed, inserted in hunks:
+                _copy_range(src, dst, position, offset - position)
+                _write_all(dst, inserted)
+                position = offset + removed
+            _copy_range(src, dst, position, os.fstat(src).st_size - position)
+
+        self._replace(path, fill)
+
+    def remove(self, path: str) -> None:
+        """Delete the file at `path`"""
+        os.unlink(path)
+        if self.group_commit:
+            self._queue(path)
+        else:
+            _fsync_path(os.path.dirname(path), directory=True)
+
+    def _replace(self, path: str, fill: Callable[[Optional[int], int], None]) -> None:
+        """Write a temporary file with `fill(source fd or None, temp fd)` and rename it to `path`"""
+        directory, name = os.path.split(path)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f".{name}.", suffix=".tmp")
+        try:
+            try:
+                src = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                src = None
+                mode = 0o666 & ~UMASK
+            try:
+                if src is not None:
+                    mode = os.fstat(src).st_mode & 0o7777
+                fill(src, fd)
+            finally:
+                if src is not None:
+                    os.close(src)
+            os.fchmod(fd, mode)
+            if not self.group_commit:
+                os.fsync(fd)
+            os.close(fd)
+            fd = -1
+            os.replace(temp_path, path)
+        except BaseException:
+            if fd >= 0:
+                os.close(fd)
+            os.unlink(temp_path)
+            raise
+
+        if self.group_commit:
+            self._queue(path)
+        else:
+            _fsync_path(directory, directory=True)
+
+    def _queue(self, path: str) -> None:
+        with self.condition:
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+                self.flusher.start()
+            if not self.pending:
+                self.condition.notify()
+            self.pending[path] = None
+
+    def _flush_loop(self) -> None:
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                # Let the rest of the burst arrive, then sync it in one pass
+                self.condition.wait(self.interval)
+                paths = list(self.pending)
+                self.pending.clear()
+            self._sync(paths)
+
+    def _sync(self, paths: List[str]) -> None:
+        """fsync the files, then each of their directories once"""
+        with self.sync_lock:
+            for path in paths:
+                try:
+                    _fsync_path(path)
+                except FileNotFoundError:
+                    # Renamed or deleted since; nothing left to make durable
+                    pass
+            for directory in {os.path.dirname(path) for path in paths}:
+                _fsync_path(directory, directory=True)
+
+    def flush(self) -> None:
+        """Make every write so far durable"""
+        with self.condition:
+            paths = list(self.pending)
+            self.pending.clear()
+        # Also waits for a background flush that is still running
+        self._sync(paths)
+
+    def close(self) -> None:
+        """Flush and stop the background flusher"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.flusher is not None:
+            self.flusher.join()
+            self.flusher = None
+        self.flush()
+
+
+def number_lines(text: str, first_line: int) -> str:
+    """Format lines like `cat -n`, numbering from `first_line`"""
+    return "\n".join(
+        f"{number:6}\t{line}"
+        for number, line in enumerate(text.split("\n"), first_line)
+    )
+
+
+def list_directory(path: str) -> str:
+    """Files and directories under `path`, LISTING_DEPTH levels deep, skipping hidden ones"""
+    entries = []
+    pending = [(path, 0)]
+    while pending and len(entries) < MAX_LISTING_ENTRIES:
+        directory, depth = pending.pop()
+        try:
+            with os.scandir(directory) as scan:
+                children = sorted(
+                    (entry for entry in scan if not entry.name.startswith(".")),
+                    key=lambda entry: entry.name,
+                )
+        except OSError:
+            continue
+        for entry in children:
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if is_dir and depth + 1 < LISTING_DEPTH:
+                pending.append((entry.path, depth + 1))
+            entries.append(os.path.relpath(entry.path, path) + ("/" if is_dir else ""))
+    entries.sort()
+    listing = "\n".join(entries[:MAX_LISTING_ENTRIES])
+    if len(entries) >= MAX_LISTING_ENTRIES:
+        listing += f"\n[... listing stopped after {MAX_LISTING_ENTRIES} entries ...]"
+    return listing
@@ -0,0 +1,102 @@
+"""Undo history for the files EditorSession edits.
+
+Each edit is journaled as a reverse diff: where it happened, the length
+and checksum of the bytes it wrote, and the bytes it replaced. Undoing an
+edit splices the replaced bytes back, so undo costs the size of the edit
+rather than of the file, and the journal never holds whole file versions
+unless an edit replaced a whole file.
+"""
+
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from typing import List, Optional
+
+# Bytes of replaced content the journal keeps across all files
+JOURNAL_MAX_BYTES = int(os.environ.get("EDIT_JOURNAL_MAX_BYTES", 16 * 1024 * 1024))
+
+# Edits that can be undone per file
+JOURNAL_MAX_DEPTH = 100
+
+
+class JournalEntry:
+    """Reverse diff of one edit.
+
+    `removed` is None when the edit created the file, in which case undoing
+    it deletes the file again.
+    """
+
+    def __init__(self, offset: int, inserted: bytes, removed: Optional[bytes]):
+        self.offset = offset
+        self.inserted_length = len(inserted)
+        self.inserted_crc = zlib.crc32(inserted)
+        self.removed = removed
+
+    @property
+    def size(self) -> int:
+        return len(self.removed) if self.removed is not None else 0
+
+    def matches(self, current: bytes) -> bool:
+        """Whether `current`, read back at the edit's offset, is what the edit wrote"""
+        return len(current) == self.inserted_length and zlib.crc32(current) == self.inserted_crc
+
+
+class EditJournal:
+    """Per-file stacks of JournalEntry, bounded in bytes and depth.
+
+    Files are kept in least-recently-edited order; when the journal is over
+    JOURNAL_MAX_BYTES, the oldest entries of the least recently edited
+    files are dropped first. An edit that can't be journaled clears its
+    file's history, since older entries could no longer be applied.
+    """
+
+    def __init__(self, max_bytes: int = JOURNAL_MAX_BYTES, max_depth: int = JOURNAL_MAX_DEPTH):
+        self.max_bytes = max_bytes
+        self.max_depth = max_depth
+        self.files: "OrderedDict[str, List[JournalEntry]]" = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def record(self, path: str, offset: int, inserted: bytes, removed: Optional[bytes]) -> None:
+        """Journal that `removed` bytes at `offset` were replaced by `inserted`"""
+        entry = JournalEntry(offset, inserted, removed)
+        with self.lock:
+            if entry.size > self.max_bytes:
+                self._forget(path)
+                return
+            entries = self.files.setdefault(path, [])
+            self.files.move_to_end(path)
+            entries.append(entry)
+            self.size += entry.size
+            if len(entries) > self.max_depth:
+                self.size -= entries.pop(0).size
+            self._evict()
+
+    def _evict(self) -> None:
+        while self.size > self.max_bytes:
+            path, entries = next(iter(self.files.items()))
+            self.size -= entries.pop(0).size
+            if not entries:
+                del self.files[path]
+
+    def _forget(self, path: str) -> None:
+        for entry in self.files.pop(path, []):
+            self.size -= entry.size
+
+    def forget(self, path: str) -> None:
+        """Drop the history of a file"""
+        with self.lock:
+            self._forget(path)
+
+    def pop(self, path: str) -> Optional[JournalEntry]:
+        """Take the last edit of a file off the journal, if any"""
+        with self.lock:
+            entries = self.files.get(path)
+            if not entries:
+                return None
+            entry = entries.pop()
+            self.size -= entry.size
+            if not entries:
+                del self.files[path]
+            return entry
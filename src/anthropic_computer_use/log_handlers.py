@@ -0,0 +1,234 @@
+"""Logging pieces that keep session logging off the agent loop's hot path.
+
+Records are handed to a queue without being formatted; a background
+listener thread formats them and does the file and console I/O. Structured
+payloads (API responses, tool inputs) travel as the record's `data` and are
+only serialized by the JSONL file formatter, in that thread. The queue,
+thread and open files are shared by all sessions of the process.
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Any, Dict, MutableMapping, Optional, Tuple
+
+# Size-based rotation of each session log
+LOG_MAX_BYTES = 1024 * 1024
+LOG_BACKUP_COUNT = 5
+
+# Session log files kept open at once by the shared writer
+MAX_OPEN_LOG_FILES = int(os.environ.get("SESSION_LOG_MAX_OPEN_FILES", 64))
+
+
+def to_jsonable(value: Any) -> Any:
+    """Convert API objects (pydantic models) and containers to JSON-ready data"""
+    if hasattr(value, "model_dump"):
+        return value.model_dump(mode="json", exclude_none=True)
+    if isinstance(value, dict):
+        return {str(key): to_jsonable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_jsonable(item) for item in value]
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return str(value)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread.
+
+    The stock handler formats each record (and so serializes its arguments)
+    in the caller's thread before queueing it. Here the record is queued as
+    is; callers must not mutate objects passed as log arguments or `data`.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class JsonLineFormatter(logging.Formatter):
+    """One compact JSON object per record.
+
+    Fields: ts, session, level, prefix, event, message, and data when the
+    record carries structured data.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "session": record.name,
+            "level": record.levelname,
+            "prefix": getattr(record, "prefix", None),
+            "event": getattr(record, "event", None),
+            "message": record.getMessage(),
+        }
+        if getattr(record, "data", None) is not None:
+            entry["data"] = to_jsonable(record.data)
+        return json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+
+
+class ConsoleFormatter(logging.Formatter):
+    """Human-readable line for the console; structured data is left to the file"""
+
+    def __init__(self):
+        super().__init__(
+            "%(asctime)s - %(name)s - %(levelname)s - %(prefix)s - %(message)s"
+        )
+
+    def format(self, record: logging.LogRecord) -> str:
+        if not hasattr(record, "prefix"):
+            record.prefix = ""
+        return super().format(record)
+
+
+class SessionLogAdapter(logging.LoggerAdapter):
+    """LoggerAdapter that merges per-call `extra` (event, data) with its own.
+
+    The stock adapter replaces the caller's `extra` with the adapter's.
+    """
+
+    def process(
+        self, msg: Any, kwargs: MutableMapping[str, Any]
+    ) -> Tuple[Any, MutableMapping[str, Any]]:
+        kwargs["extra"] = {**self.extra, **kwargs.get("extra", {})}
+        return msg, kwargs
+
+
+class SessionFileRouter(logging.Handler):
+    """Writes each session's records to that session's log file.
+
+    Runs in the listener thread. Open files are kept in an LRU of at most
+    `max_open_files`; a file evicted from it is closed and reopened (in
+    append mode) when its session logs again, so the number of open file
+    descriptors stays bounded however many sessions are live.
+    """
+
+    def __init__(self, max_open_files: int, console_handler: logging.Handler):
+        super().__init__()
+        self.max_open_files = max_open_files
+        self.console_handler = console_handler
+        # session id -> (log path, echo to console), registered by SessionLogger
+        self.sessions: Dict[str, Tuple[str, bool]] = {}
+        self.open_files: "OrderedDict[str, logging.Handler]" = OrderedDict()
+        self.formatter = JsonLineFormatter()
+
+    def _file_handler(self, session_id: str, log_path: str) -> logging.Handler:
+        handler = self.open_files.get(session_id)
+        if handler is not None:
+            self.open_files.move_to_end(session_id)
+            return handler
+        while len(self.open_files) >= self.max_open_files:
+            _, evicted = self.open_files.popitem(last=False)
+            evicted.close()
+        handler = RotatingFileHandler(
+            log_path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+        )
+        handler.setFormatter(self.formatter)
+        self.open_files[session_id] = handler
+        return handler
+
+    def _close_session(self, session_id: str) -> None:
+        handler = self.open_files.pop(session_id, None)
+        if handler is not None:
+            handler.close()
+        self.sessions.pop(session_id, None)
+
+    def handle(self, record: logging.LogRecord) -> bool:
+        # Marker queued by SessionLogger.close() behind the session's records
+        closed = getattr(record, "close_session", None)
+        if closed is not None:
+            self._close_session(record.name)
+            closed.set()
+            return True
+
+        session = self.sessions.get(record.name)
+        if session is None:
+            return False
+        log_path, console = session
+        self._file_handler(record.name, log_path).handle(record)
+        if console:
+            self.console_handler.handle(record)
+        return True
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.handle(record)
+
+    def close(self) -> None:
+        for handler in self.open_files.values():
+            handler.close()
+        self.open_files.clear()
+        super().close()
+
+
+class SessionLogPool:
+    """Process-wide logging backend shared by all SessionLoggers.
+
+    One queue, one background writer thread and one console handler serve
+    every session, and open log files are capped by SessionFileRouter's LRU.
+    Creating and closing thousands of sessions therefore leaves memory and
+    file descriptor use flat.
+    """
+
+    _default: Optional["SessionLogPool"] = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, max_open_files: int = MAX_OPEN_LOG_FILES):
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(ConsoleFormatter())
+        self.router = SessionFileRouter(max_open_files, console_handler)
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.queue_handler = DeferredQueueHandler(self.queue)
+        self.listener = QueueListener(self.queue, self.router)
+        self.listener.start()
+        self.running = True
+
+    @classmethod
+    def default(cls) -> "SessionLogPool":
+        """The shared pool, started on first use and flushed at exit"""
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+                atexit.register(cls._default.shutdown)
+            return cls._default
+
+    @property
+    def backlog(self) -> int:
+        """Records queued but not yet written (approximate)"""
+        return self.queue.qsize()
+
+    def open(self, session_id: str, log_path: str, console: bool) -> logging.Logger:
+        """Register a session and return its logger.
+
+        The logger is created directly rather than with logging.getLogger,
+        which would keep every session's logger alive for the process lifetime.
+        """
+        self.router.sessions[session_id] = (log_path, console)
+        logger = logging.Logger(session_id, logging.DEBUG)
+        logger.addHandler(self.queue_handler)
+        logger.propagate = False
+        return logger
+
+    def close(self, logger: logging.Logger, timeout: Optional[float] = 5.0) -> None:
+        """Flush a session's queued records, close its file and detach its logger"""
+        closed = threading.Event()
+        logger.handle(
+            logger.makeRecord(
+                logger.name, logging.INFO, __file__, 0, "close", None, None,
+                extra={"close_session": closed},
+            )
+        )
+        logger.removeHandler(self.queue_handler)
+        if self.running:
+            closed.wait(timeout)
+
+    def shutdown(self) -> None:
+        """Write out everything queued and stop the writer thread"""
+        if self.running:
+            self.running = False
+            self.listener.stop()
+        self.router.close()
@@ -1,17 +1,53 @@
 import os
+import io
+import mmap
+import asyncio
 import anthropic
 import argparse
 import yaml
-import subprocess
 from datetime import datetime
 import uuid
-from typing import Dict, Any, List, Optional, Union
+from typing import Dict, Any, Awaitable, Callable, Iterable, List, Optional, Tuple, Union
 import traceback
 import sys
+import threading
+import time
 import logging
-from logging.handlers import RotatingFileHandler
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from . import prompts
+from .command_cache import CommandCache
+from .compaction import compact_messages
+from .editor import (
+    LISTING_DEPTH,
+    VIEW_MAX_BYTES,
+    VIEW_PAGE_LINES,
+    ContentCache,
+    FileKind,
+    FileWriter,
+    LineIndex,
+    PathResolver,
+    TextLines,
+    file_stamp,
+    find_matches,
+    list_directory,
+    number_lines,
+    open_mmap,
+    scan_patterns,
+    sniff_file,
+)
+from .journal import EditJournal
+from .matching import FUZZY_MAX_BYTES, MAX_CANDIDATE_LINES, find_candidates
+from .log_handlers import SessionLogAdapter, SessionLogPool
+from .snapshots import SNAPSHOTS_DIR, SnapshotStore
+from .shell import (
+    AsyncBashProcess,
+    BashProcess,
+    CommandResult,
+    ResourceUsage,
+    is_read_only_command,
+    runs_alike_in_clone,
+)
 
 # Load environment variables from .env file
 load_dotenv()
@@ -29,48 +65,262 @@ EDITOR_SYSTEM_PROMPT = os.environ.get(
     "EDITOR_SYSTEM_PROMPT", prompts.EDITOR_SYSTEM_PROMPT
 )
 
+# Default wall-clock limit for a single bash command, in seconds
+DEFAULT_COMMAND_TIMEOUT = float(os.environ.get("BASH_COMMAND_TIMEOUT", 300))
+
+# Bytes of each command's output streamed to the session log as it runs;
+# past this, only the bounded output in the tool result is logged
+STREAM_MAX_BYTES = int(os.environ.get("BASH_STREAM_MAX_BYTES", 1024 * 1024))
+
+# Queued log records above which output streaming waits for the log writer
+STREAM_MAX_BACKLOG = 256
+STREAM_BACKLOG_POLL_INTERVAL = 0.01
+
+# Upper bound on tool calls from one turn that run at the same time
+MAX_TOOL_WORKERS = 8
+
+# Default number of sessions run_sessions_async drives at the same time
+MAX_CONCURRENT_SESSIONS = 64
+
+# Model turns in one conversation, and turns in a row in which every tool
+# call failed, after which the agent loop gives up
+MAX_AGENT_TURNS = int(os.environ.get("MAX_AGENT_TURNS", 100))
+MAX_ERROR_TURNS = int(os.environ.get("MAX_ERROR_TURNS", 5))
+
+# Estimated history size, in tokens, above which old tool output is compacted
+DEFAULT_HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", 100_000))
+
+
+CACHE_CONTROL = {"type": "ephemeral"}
+
+# Client-side tool next to the text editor: many edits to one file in one call
+BATCH_EDIT_TOOL = {
+    "name": "batch_edit",
+    "description": (
+        "Apply several edits to one file in a single step. Each edit either replaces "
+        "old_str (which must occur exactly once) with new_str, or inserts new_str after "
+        "line insert_line (0 for the start of the file). Matches and line numbers refer "
+        "to the file before any of the edits. Either all edits are applied or none."
+    ),
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "path": {"type": "string"},
+            "edits": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "old_str": {"type": "string"},
+                        "new_str": {"type": "string"},
+                        "insert_line": {"type": "integer"},
+                    },
+                    "required": ["new_str"],
+                },
+            },
+        },
+        "required": ["path", "edits"],
+    },
+}
+
+
+def with_cache_breakpoints(
+    messages: List[Dict[str, Any]], count: int
+) -> List[Dict[str, Any]]:
+    """Return messages with a cache breakpoint on the last `count` user messages.
+
+    Only the marked messages are copied; the stored history is left untouched
+    so breakpoints do not pile up as the conversation grows.
+    """
+    marked = list(messages)
+    for index in range(len(marked) - 1, -1, -1):
+        if count == 0:
+            break
+        message = marked[index]
+        if message["role"] != "user" or not message["content"]:
+            continue
+        content = list(message["content"])
+        content[-1] = {**content[-1], "cache_control": CACHE_CONTROL}
+        marked[index] = {**message, "content": content}
+        count -= 1
+    return marked
+
+
+def format_tool_result(tool_call_id: str, result: Dict[str, Any]) -> Dict[str, Any]:
+    """Convert a handler result to match expected tool result format"""
+    is_error = False
+
+    if result.get("error"):
+        is_error = True
+        tool_result_content = [{"type": "text", "text": result["error"]}]
+    else:
+        tool_result_content = [{"type": "text", "text": result.get("content", "")}]
+
+    return {
+        "tool_call_id": tool_call_id,
+        "output": {
+            "type": "tool_result",
+            "content": tool_result_content,
+            "tool_use_id": tool_call_id,
+            "is_error": is_error,
+        },
+    }
+
+
+def _plan_waves(
+    items: List[Any], conflicts: Callable[[Any, Any], bool]
+) -> List[List[int]]:
+    """Group item indexes, in order, into waves of mutually independent items"""
+    waves: List[List[int]] = []
+    for index, item in enumerate(items):
+        if waves and not any(conflicts(item, items[j]) for j in waves[-1]):
+            waves[-1].append(index)
+        else:
+            waves.append([index])
+    return waves
+
+
+def run_in_waves(
+    items: List[Any],
+    handler: Callable[[Any, bool], Any],
+    conflicts: Callable[[Any, Any], bool],
+) -> List[Any]:
+    """Apply handler to every item and return the results in item order.
+
+    Items are grouped, in order, into waves of mutually independent items. A
+    wave runs on a thread pool, so it takes as long as its slowest item, and
+    waves run one after another so conflicting items keep their order. The
+    handler's second argument tells it whether it runs alongside others.
+    """
+    results: List[Any] = [None] * len(items)
+    for wave in _plan_waves(items, conflicts):
+        if len(wave) == 1:
+            results[wave[0]] = handler(items[wave[0]], False)
+            continue
+        with ThreadPoolExecutor(max_workers=min(len(wave), MAX_TOOL_WORKERS)) as pool:
+            futures = {i: pool.submit(handler, items[i], True) for i in wave}
+            for i, future in futures.items():
+                results[i] = future.result()
+    return results
+
+
+async def run_in_waves_async(
+    items: List[Any],
+    handler: Callable[[Any, bool], Awaitable[Any]],
+    conflicts: Callable[[Any, Any], bool],
+) -> List[Any]:
+    """asyncio version of run_in_waves: each wave is gathered on the event loop"""
+    results: List[Any] = [None] * len(items)
+    for wave in _plan_waves(items, conflicts):
+        concurrent = len(wave) > 1
+        wave_results = await asyncio.gather(
+            *(handler(items[i], concurrent) for i in wave)
+        )
+        for i, result in zip(wave, wave_results):
+            results[i] = result
+    return results
+
+
+async def run_sessions_async(
+    runs: Iterable[Awaitable[Any]], max_concurrency: int = MAX_CONCURRENT_SESSIONS
+) -> List[Any]:
+    """Drive many session runs on one event loop, at most max_concurrency at once.
+
+    `runs` are un-awaited calls such as `session.process_edit_async(prompt)`;
+    a coroutine does not start until it gets a slot. Results (or exceptions)
+    are returned in the order of `runs`.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def limited(run: Awaitable[Any]) -> Any:
+        async with semaphore:
+            return await run
+
+    return await asyncio.gather(
+        *(limited(run) for run in runs), return_exceptions=True
+    )
+
 
 class SessionLogger:
-    def __init__(self, session_id: str, sessions_dir: str):
+    def __init__(
+        self,
+        session_id: str,
+        sessions_dir: str,
+        console: bool = True,
+        pool: Optional[SessionLogPool] = None,
+    ):
+        """Set up logging for a session.
+
+        The session log is written as JSON lines to `<session_id>.jsonl`.
+        Logging calls only enqueue the record; the process-wide SessionLogPool
+        does the formatting and the file/console I/O in a background thread.
+        Call close() (or use the logger as a context manager) when the session
+        ends to flush its records and release its file.
+        """
         self.session_id = session_id
         self.sessions_dir = sessions_dir
+        self.console = console
+        self.pool = pool or SessionLogPool.default()
+        self.closed = False
         self.logger = self._setup_logging()
 
         # Initialize token counters
         self.total_input_tokens = 0
         self.total_output_tokens = 0
+        self.total_cache_creation_tokens = 0
+        self.total_cache_read_tokens = 0
+
+        # Resources used by the bash commands run, summed
+        self.commands_run = 0
+        self.command_usage = ResourceUsage()
+        self.usage_lock = threading.Lock()
 
     def _setup_logging(self) -> logging.Logger:
         """Configure logging for the session"""
-        log_formatter = logging.Formatter(
-            "%(asctime)s - %(name)s - %(levelname)s - %(prefix)s - %(message)s"
-        )
-        log_file = os.path.join(self.sessions_dir, f"{self.session_id}.log")
-
-        file_handler = RotatingFileHandler(
-            log_file, maxBytes=1024 * 1024, backupCount=5
-        )
-        file_handler.setFormatter(log_formatter)
-
-        console_handler = logging.StreamHandler()
-        console_handler.setFormatter(log_formatter)
-
-        logger = logging.getLogger(self.session_id)
-        logger.addHandler(file_handler)
-        logger.addHandler(console_handler)
-        logger.setLevel(logging.DEBUG)
-
-        return logger
-
-    def update_token_usage(self, input_tokens: int, output_tokens: int):
-        """Update the total token usage."""
+        log_file = os.path.join(self.sessions_dir, f"{self.session_id}.jsonl")
+        return self.pool.open(self.session_id, log_file, self.console)
+
+    def close(self) -> None:
+        """Flush the session's queued records and close its log file"""
+        if not self.closed:
+            self.closed = True
+            self.pool.close(self.logger)
+
+    def __enter__(self) -> "SessionLogger":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def update_token_usage(
+        self,
+        input_tokens: int,
+        output_tokens: int,
+        cache_creation_tokens: int = 0,
+        cache_read_tokens: int = 0,
+    ):
+        """Update the total token usage.
+
+        `input_tokens` excludes prompt-cache writes and reads, which the API
+        reports (and bills) separately.
+        """
         self.total_input_tokens += input_tokens
         self.total_output_tokens += output_tokens
+        self.total_cache_creation_tokens += cache_creation_tokens or 0
+        self.total_cache_read_tokens += cache_read_tokens or 0
+
+    def update_command_usage(self, usage: ResourceUsage) -> None:
+        """Add the resources a bash command used to the session totals"""
+        with self.usage_lock:
+            self.commands_run += 1
+            self.command_usage.add(usage)
 
     def log_total_cost(self):
         """Calculate and log the total cost based on token usage."""
         cost_per_million_input_tokens = 3.0  # $3.00 per million input tokens
         cost_per_million_output_tokens = 15.0  # $15.00 per million output tokens
+        cost_per_million_cache_write_tokens = 3.75  # $3.75 per million cache writes
+        cost_per_million_cache_read_tokens = 0.30  # $0.30 per million cache reads
 
         total_input_cost = (
             self.total_input_tokens / 1_000_000
@@ -78,7 +328,25 @@ class SessionLogger:
         total_output_cost = (
             self.total_output_tokens / 1_000_000
         ) * cost_per_million_output_tokens
-        total_cost = total_input_cost + total_output_cost
+        total_cache_write_cost = (
+            self.total_cache_creation_tokens / 1_000_000
+        ) * cost_per_million_cache_write_tokens
+        total_cache_read_cost = (
+            self.total_cache_read_tokens / 1_000_000
+        ) * cost_per_million_cache_read_tokens
+        total_cost = (
+            total_input_cost
+            + total_output_cost
+            + total_cache_write_cost
+            + total_cache_read_cost
+        )
+
+        # What the cached tokens would have cost as regular input tokens
+        uncached_cost = (
+            (self.total_cache_creation_tokens + self.total_cache_read_tokens)
+            / 1_000_000
+        ) * cost_per_million_input_tokens
+        cache_savings = uncached_cost - total_cache_write_cost - total_cache_read_cost
 
         prefix = "📊 session"
         self.logger.info(
@@ -87,24 +355,344 @@ class SessionLogger:
         self.logger.info(
             f"Total output tokens: {self.total_output_tokens}", extra={"prefix": prefix}
         )
+        self.logger.info(
+            f"Total cache write tokens: {self.total_cache_creation_tokens}",
+            extra={"prefix": prefix},
+        )
+        self.logger.info(
+            f"Total cache read tokens: {self.total_cache_read_tokens}",
+            extra={"prefix": prefix},
+        )
         self.logger.info(
             f"Total input cost: ${total_input_cost:.6f}", extra={"prefix": prefix}
         )
         self.logger.info(
             f"Total output cost: ${total_output_cost:.6f}", extra={"prefix": prefix}
         )
+        self.logger.info(
+            f"Total cache write cost: ${total_cache_write_cost:.6f}",
+            extra={"prefix": prefix},
+        )
+        self.logger.info(
+            f"Total cache read cost: ${total_cache_read_cost:.6f}",
+            extra={"prefix": prefix},
+        )
+        self.logger.info(
+            f"Prompt caching savings: ${cache_savings:.6f}", extra={"prefix": prefix}
+        )
         self.logger.info(f"Total cost: ${total_cost:.6f}", extra={"prefix": prefix})
+        summary = {
+            "input_tokens": self.total_input_tokens,
+            "output_tokens": self.total_output_tokens,
+            "cache_creation_input_tokens": self.total_cache_creation_tokens,
+            "cache_read_input_tokens": self.total_cache_read_tokens,
+            "cost": round(total_cost, 6),
+            "cache_savings": round(cache_savings, 6),
+        }
+        if self.commands_run:
+            self.logger.info(
+                f"Bash commands: {self.commands_run} "
+                f"({self.command_usage.summary()})",
+                extra={"prefix": prefix},
+            )
+            summary["commands"] = {"count": self.commands_run, **self.command_usage.as_dict()}
+        self.logger.info(
+            "Session summary",
+            extra={"prefix": prefix, "event": "session_summary", "data": summary},
+        )
+
+
+class AgentSession:
+    """Agent loop shared by EditorSession and BashSession.
+
+    Sends the conversation to the model, runs the tool calls in its reply and
+    returns the results, until the model stops asking for tools. Subclasses
+    set the tool definitions and system prompt and implement `_run_tool_call`
+    (and `_run_tool_call_async` for the asyncio loop).
+    """
+
+    model = "claude-3-5-sonnet-20241022"
+    max_tokens = 4096
+    betas = ["computer-use-2024-10-22", "prompt-caching-2024-07-31"]
+    # Mark the system prompt, tools and recent history as cacheable
+    prompt_caching = True
+    # Compact old tool output above this many history tokens; None disables
+    history_token_budget: Optional[int] = DEFAULT_HISTORY_TOKEN_BUDGET
+    # Stop after this many turns, or this many turns in a row of only errors
+    max_turns = MAX_AGENT_TURNS
+    max_error_turns = MAX_ERROR_TURNS
+    tool_name = ""
+    tools: List[Dict[str, Any]] = []
+    system_prompt = ""
+
+    client: anthropic.Anthropic
+    _async_client: Optional[anthropic.AsyncAnthropic] = None
+
+    def set_logger(self, session_logger: SessionLogger):
+        """Set the logger for the session and store the SessionLogger instance."""
+        self.session_logger = session_logger
+        self.logger = SessionLogAdapter(
+            self.session_logger.logger, {"prefix": self.log_prefix}
+        )
+
+    @property
+    def async_client(self) -> anthropic.AsyncAnthropic:
+        """AsyncAnthropic client, created on first use by the async loop.
+
+        Sessions driven from one event loop can share a client (and so its
+        connection pool) by assigning the same instance to each of them.
+        """
+        if self._async_client is None:
+            self._async_client = anthropic.AsyncAnthropic(
+                api_key=os.environ.get("ANTHROPIC_API_KEY")
+            )
+        return self._async_client
+
+    @async_client.setter
+    def async_client(self, client: anthropic.AsyncAnthropic) -> None:
+        self._async_client = client
+
+    def _start_conversation(self, prompt: str) -> None:
+        """Reset the conversation to the user's prompt"""
+        # Initial message with proper content structure
+        api_message = {
+            "role": "user",
+            "content": [{"type": "text", "text": prompt}],
+        }
+        self.messages = [api_message]
+        self.error_turns = 0
+
+        self.logger.info(
+            "User input: %s", prompt, extra={"event": "user_input", "data": api_message}
+        )
 
+    def _compact_history(self) -> None:
+        """Keep the history under history_token_budget before the next request"""
+        if self.history_token_budget is None:
+            return
+        saved = compact_messages(self.messages, self.history_token_budget)
+        if saved:
+            self.logger.info("Compacted history, saved about %d tokens", saved)
+
+    def _request_params(self) -> Dict[str, Any]:
+        """Arguments for the next messages.create call"""
+        if not self.prompt_caching:
+            return {
+                "model": self.model,
+                "max_tokens": self.max_tokens,
+                "messages": self.messages,
+                "tools": self.tools,
+                "system": self.system_prompt,
+                "betas": self.betas,
+            }
+
+        # Breakpoints after the tools and the system prompt cache the static
+        # prefix. The history gets a rolling breakpoint on the newest user
+        # message (written this turn) and one on the previous user message
+        # (written last turn, read now). That is the API's limit of four.
+        tools = self.tools[:-1] + [{**self.tools[-1], "cache_control": CACHE_CONTROL}]
+        system = [
+            {"type": "text", "text": self.system_prompt, "cache_control": CACHE_CONTROL}
+        ]
+        return {
+            "model": self.model,
+            "max_tokens": self.max_tokens,
+            "messages": with_cache_breakpoints(self.messages, count=2),
+            "tools": tools,
+            "system": system,
+            "betas": self.betas,
+        }
+
+    def _handle_response(self, response: Any) -> bool:
+        """Record a model response; return True if it asks for tool calls"""
+        # Extract token usage from the response
+        input_tokens = getattr(response.usage, "input_tokens", 0)
+        output_tokens = getattr(response.usage, "output_tokens", 0)
+        cache_creation_tokens = getattr(response.usage, "cache_creation_input_tokens", 0) or 0
+        cache_read_tokens = getattr(response.usage, "cache_read_input_tokens", 0) or 0
+        self.logger.info(
+            "API usage: input_tokens=%d, output_tokens=%d, "
+            "cache_creation_input_tokens=%d, cache_read_input_tokens=%d",
+            input_tokens,
+            output_tokens,
+            cache_creation_tokens,
+            cache_read_tokens,
+        )
+
+        # Update token counts in SessionLogger
+        self.session_logger.update_token_usage(
+            input_tokens, output_tokens, cache_creation_tokens, cache_read_tokens
+        )
+
+        # The response is only serialized by the log writer thread
+        self.logger.info(
+            "API response: stop_reason=%s",
+            response.stop_reason,
+            extra={"event": "api_response", "data": response},
+        )
+
+        # Convert response content to message params
+        response_content = []
+        for block in response.content:
+            if block.type == "text":
+                response_content.append({"type": "text", "text": block.text})
+            else:
+                response_content.append(block.model_dump())
+
+        # Add assistant response to messages
+        self.messages.append({"role": "assistant", "content": response_content})
+
+        if response.stop_reason != "tool_use":
+            # Print the assistant's final response
+            print(response.content[0].text)
+            return False
+        return True
+
+    def _add_tool_results(self, tool_results: List[Dict[str, Any]]) -> bool:
+        """Add tool results to the conversation; return False to stop the loop.
+
+        Failed calls are sent back like any other result, so the model sees
+        the error (and any suggestions in it) and can try again. The loop
+        only stops after max_error_turns turns in a row in which every call
+        failed.
+        """
+        # Add all tool results as one user message
+        if tool_results:
+            self.messages.append(
+                {
+                    "role": "user",
+                    "content": [result["output"] for result in tool_results],
+                }
+            )
 
-class EditorSession:
-    def __init__(self, session_id: Optional[str] = None):
-        """Initialize editor session with optional existing session ID"""
+            errors = [
+                result["output"]["content"]
+                for result in tool_results
+                if result["output"]["is_error"]
+            ]
+            for error in errors:
+                self.logger.error(f"Error: {error}")
+            if len(errors) < len(tool_results):
+                self.error_turns = 0
+            else:
+                self.error_turns += 1
+                if self.error_turns >= self.max_error_turns:
+                    self.logger.error(
+                        f"Stopping after {self.error_turns} turns in a row of failed tool calls"
+                    )
+                    return False
+        return True
+
+    def _select_tool_calls(self, content: List[Any]) -> List[Any]:
+        names = {tool["name"] for tool in self.tools}
+        return [
+            block
+            for block in content
+            if block.type == "tool_use" and block.name in names
+        ]
+
+    def _tool_calls_conflict(self, first: Any, second: Any) -> bool:
+        """Whether two tool calls must not run at the same time"""
+        return True
+
+    def process_tool_calls(
+        self, tool_calls: List[anthropic.types.ContentBlock]
+    ) -> List[Dict[str, Any]]:
+        """Process tool calls and return results"""
+        return run_in_waves(
+            self._select_tool_calls(tool_calls),
+            self._run_tool_call,
+            self._tool_calls_conflict,
+        )
+
+    async def process_tool_calls_async(
+        self, tool_calls: List[anthropic.types.ContentBlock]
+    ) -> List[Dict[str, Any]]:
+        """Process tool calls on the event loop and return results"""
+        return await run_in_waves_async(
+            self._select_tool_calls(tool_calls),
+            self._run_tool_call_async,
+            self._tool_calls_conflict,
+        )
+
+    def _run_loop(self, prompt: str) -> None:
+        self._start_conversation(prompt)
+
+        for _ in range(self.max_turns):
+            self._compact_history()
+            response = self.client.beta.messages.create(**self._request_params())
+            if not self._handle_response(response):
+                break
+
+            tool_results = self.process_tool_calls(response.content)
+            if not self._add_tool_results(tool_results):
+                break
+        else:
+            self.logger.error(f"Stopping after {self.max_turns} turns")
+
+        # After the execution loop, log the total cost
+        self.session_logger.log_total_cost()
+
+    async def _run_loop_async(self, prompt: str) -> None:
+        self._start_conversation(prompt)
+
+        for _ in range(self.max_turns):
+            self._compact_history()
+            response = await self.async_client.beta.messages.create(
+                **self._request_params()
+            )
+            if not self._handle_response(response):
+                break
+
+            tool_results = await self.process_tool_calls_async(response.content)
+            if not self._add_tool_results(tool_results):
+                break
+        else:
+            self.logger.error(f"Stopping after {self.max_turns} turns")
+
+        # After the execution loop, log the total cost
+        self.session_logger.log_total_cost()
+
+
+class EditorSession(AgentSession):
+    tool_name = "str_replace_editor"
+    tools = [{"type": "text_editor_20241022", "name": "str_replace_editor"}, BATCH_EDIT_TOOL]
+    system_prompt = EDITOR_SYSTEM_PROMPT
+
+    def __init__(
+        self,
+        session_id: Optional[str] = None,
+        group_commit: bool = False,
+        snapshots: Optional[SnapshotStore] = None,
+    ):
+        """Initialize editor session with optional existing session ID.
+
+        With group_commit, file writes are fsynced in batches by a background
+        thread instead of one by one; see FileWriter. With a snapshot store,
+        editor_dir is checkpointed at the start and after every turn.
+        """
         self.session_id = session_id or self._create_session_id()
         self.sessions_dir = SESSIONS_DIR
         self.editor_dir = EDITOR_DIR
         self.client = anthropic.Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
         self.messages = []
 
+        # Line indexes and contents of recently used files, by path
+        self.line_indexes: Dict[str, LineIndex] = {}
+        self.content_cache = ContentCache()
+        self.file_kinds: Dict[str, Tuple[Tuple[int, int, int], FileKind]] = {}
+
+        # All file writes go through here
+        self.writer = FileWriter(group_commit=group_commit)
+
+        # Reverse diffs of the session's edits, for undo_edit
+        self.journal = EditJournal()
+
+        # Checkpoint names, oldest first, and files written since the last one
+        self.snapshots = snapshots
+        self.checkpoints: List[str] = []
+        self.changed_paths = set()
+
         # Create editor directory if needed
         os.makedirs(self.editor_dir, exist_ok=True)
 
@@ -114,73 +702,377 @@ class EditorSession:
         # Set log prefix
         self.log_prefix = "📝 file_editor"
 
-    def set_logger(self, session_logger: SessionLogger):
-        """Set the logger for the session and store the SessionLogger instance."""
-        self.session_logger = session_logger
-        self.logger = logging.LoggerAdapter(
-            self.session_logger.logger, {"prefix": self.log_prefix}
-        )
-
     def _create_session_id(self) -> str:
         """Create a new session ID"""
         timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
         return f"{timestamp}-{uuid.uuid4().hex[:6]}"
 
+    @property
+    def editor_dir(self) -> str:
+        return self.paths.root
+
+    @editor_dir.setter
+    def editor_dir(self, directory: str) -> None:
+        self.paths = PathResolver(directory)
+
     def _get_editor_path(self, path: str) -> str:
         """Convert API path to local editor directory path"""
-        # Strip any leading /repo/ from the path
-        clean_path = path.replace("/repo/", "", 1)
-        # Join with editor_dir
-        full_path = os.path.join(self.editor_dir, clean_path)
-        # Create the directory structure if it doesn't exist
-        os.makedirs(os.path.dirname(full_path), exist_ok=True)
-        return full_path
-
-    def _handle_view(self, path: str, _: Dict[str, Any]) -> Dict[str, Any]:
+        return self.paths.resolve(path)
+
+    def _line_index(self, path: str) -> LineIndex:
+        """Line index of a file, rebuilt if the file changed behind our back"""
+        index = self.line_indexes.get(path)
+        if index is None or index.stamp != file_stamp(os.stat(path)):
+            index = self.line_indexes[path] = LineIndex.build(path)
+        return index
+
+    def _file_kind(self, path: str) -> FileKind:
+        """Whether a file is text or binary, and its encoding; sniffed once per version"""
+        stamp = file_stamp(os.stat(path))
+        known = self.file_kinds.get(path)
+        if known is not None and known[0] == stamp:
+            return known[1]
+        kind = sniff_file(path)
+        self.file_kinds[path] = (stamp, kind)
+        return kind
+
+    def _edit_error(self, path: str) -> Optional[Dict[str, Any]]:
+        """Error result for a file edits can't be applied to, else None"""
+        kind = self._file_kind(path)
+        if kind.binary:
+            return {"error": f"{path} is a binary file ({kind.description}); cannot edit it"}
+        if not kind.ascii_compatible:
+            return {
+                "error": f"{path} is {kind.encoding} text; "
+                "only UTF-8 and Latin-1 files can be edited"
+            }
+        return None
+
+    def _not_found(self, path: str, old_str: str, prefix: str = "") -> Dict[str, Any]:
+        """Error result for an old_str missing from a file, with its closest regions"""
+        error = f"{prefix}old_str not found in file"
+        kind = self._file_kind(path)
+        if kind.size > FUZZY_MAX_BYTES:
+            return {"error": error}
+        if self.content_cache.read(path) is not None:
+            lines = self.content_cache.read_text(path, kind).split("\n")
+            candidates = find_candidates(lines, old_str)
+        else:
+            # Stream the lines of files too big to cache
+            with open(path, "rb") as raw:
+                raw.seek(len(kind.bom))
+                f = io.TextIOWrapper(raw, encoding=kind.encoding, errors="replace", newline="")
+                candidates = find_candidates((line.rstrip("\n") for line in f), old_str)
+        if not candidates:
+            return {"error": error}
+
+        index = self._line_index(path)
+        error += ". Closest matches:"
+        for candidate in candidates:
+            last = min(candidate.end, index.line_count, candidate.start + MAX_CANDIDATE_LINES - 1)
+            snippet = index.read_lines(candidate.start, last).decode(kind.encoding, errors="replace")
+            if snippet.endswith("\n"):
+                snippet = snippet[:-1]
+            error += f"\n\nlines {candidate.start}-{last} ({candidate.reason}):\n"
+            error += number_lines(snippet, candidate.start)
+        return {"error": error}
+
+    def _edited(
+        self,
+        path: str,
+        index: LineIndex,
+        offset: int,
+        removed: int,
+        inserted: bytes,
+        line_delta: int,
+    ) -> None:
+        """Bring the line index and content cache up to date after a splice"""
+        stamp = file_stamp(os.stat(path))
+        index.apply_edit(offset, removed, len(inserted), line_delta, stamp)
+        self.content_cache.splice(path, offset, removed, inserted, stamp)
+        self.changed_paths.add(path)
+
+    def _handle_view(self, path: str, tool_call: Dict[str, Any]) -> Dict[str, Any]:
         """Handle view command"""
-        editor_path = self._get_editor_path(path)
-        if os.path.exists(editor_path):
-            with open(editor_path, "r") as f:
-                return {"content": f.read()}
-        return {"error": f"File {editor_path} does not exist"}
+        if os.path.isdir(path):
+            return {
+                "content": f"Files and directories up to {LISTING_DEPTH} levels deep "
+                f"in {path}, excluding hidden items:\n{list_directory(path)}"
+            }
+        if not os.path.exists(path):
+            return {"error": f"File {path} does not exist"}
+        kind = self._file_kind(path)
+        if kind.binary:
+            return {"content": kind.summary(path)}
+        view_range = tool_call.get("view_range")
+        if view_range is None and kind.size <= VIEW_MAX_BYTES:
+            return {"content": self.content_cache.read_text(path, kind)}
+        # Large files are paged rather than sent whole
+        return self._view_lines(path, view_range or [1, -1], kind)
+
+    def _view_lines(self, path: str, view_range: Any, kind: FileKind) -> Dict[str, Any]:
+        """Numbered lines of a view_range, at most one page of them"""
+        if (
+            not isinstance(view_range, list)
+            or len(view_range) != 2
+            or not all(isinstance(number, int) for number in view_range)
+        ):
+            return {"error": "view_range must be a list of two line numbers"}
+        if kind.ascii_compatible:
+            lines = self._line_index(path)
+            encoding = kind.encoding
+        else:
+            lines = TextLines(self.content_cache.read_text(path, kind))
+            encoding = "utf-8"
+        total = lines.line_count
+        start, end = view_range
+        if start < 1 or start > max(total, 1) or (end != -1 and end < start):
+            return {"error": f"Invalid view_range {view_range}: the file has {total} lines"}
+        if total == 0:
+            return {"content": ""}
+
+        wanted = total if end == -1 else min(end, total)
+        last = min(wanted, start + VIEW_PAGE_LINES - 1)
+        data = lines.read_lines(start, last)
+        if start == 1 and kind.ascii_compatible:
+            data = data[len(kind.bom) :]
+        if len(data) > VIEW_MAX_BYTES:
+            # Cut the page at a line boundary, or inside a single huge line
+            cut = data.rfind(b"\n", 0, VIEW_MAX_BYTES) + 1 or VIEW_MAX_BYTES
+            last = start + max(data.count(b"\n", 0, cut) - 1, 0)
+            data = data[:cut]
+        text = data.decode(encoding, errors="replace")
+        if text.endswith("\n"):
+            text = text[:-1]
+
+        content = f"Here's the result of running `cat -n` on {path}:\n"
+        content += number_lines(text, start)
+        if last < wanted:
+            content += (
+                f"\n[Showing lines {start}-{last} of {total}. "
+                f"Use view_range [{last + 1}, {wanted}] to see more.]"
+            )
+        return {"content": content}
 
     def _handle_create(self, path: str, tool_call: Dict[str, Any]) -> Dict[str, Any]:
         """Handle create command"""
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, "w") as f:
-            f.write(tool_call["file_text"])
+        self.paths.make_parent(path)
+        content = tool_call["file_text"].encode()
+        existed = os.path.exists(path)
+        previous = None
+        if existed and os.path.getsize(path) <= self.journal.max_bytes:
+            with open(path, "rb") as f:
+                previous = f.read()
+
+        self.writer.write(path, content)
+        self.line_indexes.pop(path, None)
+        self.content_cache.put(path, content, file_stamp(os.stat(path)))
+        self.changed_paths.add(path)
+        if existed and previous is None:
+            # Too big to journal, so earlier edits can't be undone either
+            self.journal.forget(path)
+        else:
+            self.journal.record(path, 0, content, previous)
         return {"content": f"File created at {path}"}
 
     def _handle_str_replace(
         self, path: str, tool_call: Dict[str, Any]
     ) -> Dict[str, Any]:
         """Handle str_replace command"""
-        with open(path, "r") as f:
-            content = f.read()
-        if tool_call["old_str"] not in content:
-            return {"error": "old_str not found in file"}
-        new_content = content.replace(
-            tool_call["old_str"], tool_call.get("new_str", "")
+        error = self._edit_error(path)
+        if error:
+            return error
+        encoding = self._file_kind(path).encoding
+        old = tool_call["old_str"].encode(encoding)
+        if not old:
+            return {"error": "old_str must not be empty"}
+        new = tool_call.get("new_str", "").encode(encoding)
+
+        # Search the content as bytes: from the cache for small files,
+        # through a memory map (nothing decoded or copied) for large ones
+        index = self._line_index(path)
+        data = self.content_cache.read(path)
+        if data is None:
+            data = open_mmap(path)
+        try:
+            count, matches = find_matches(data, old)
+            if count > 1:
+                lines = ", ".join(str(index.line_at(data, match)) for match in matches)
+                return {
+                    "error": f"old_str matches {count} times in the file "
+                    f"(lines {lines}); include more context to make it unique"
+                }
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+        if not count:
+            return self._not_found(path, tool_call["old_str"])
+
+        self.writer.splice(path, matches[0], len(old), new)
+        self.journal.record(path, matches[0], new, old)
+        self._edited(
+            path, index, matches[0], len(old), new, new.count(b"\n") - old.count(b"\n")
         )
-        with open(path, "w") as f:
-            f.write(new_content)
         return {"content": "File updated successfully"}
 
     def _handle_insert(self, path: str, tool_call: Dict[str, Any]) -> Dict[str, Any]:
         """Handle insert command"""
-        with open(path, "r") as f:
-            lines = f.readlines()
-        insert_line = tool_call["insert_line"]
-        if insert_line > len(lines):
+        error = self._edit_error(path)
+        if error:
+            return error
+        index = self._line_index(path)
+        insert_line = tool_call.get("insert_line")
+        if not isinstance(insert_line, int) or insert_line < 0:
+            return {"error": "insert_line must be a line number from 0 (the start of the file)"}
+        if insert_line > index.line_count:
             return {"error": "insert_line beyond file length"}
-        lines.insert(insert_line, tool_call["new_str"] + "\n")
-        with open(path, "w") as f:
-            f.writelines(lines)
+        offset = index.line_offset(insert_line)
+        inserted = (tool_call["new_str"] + "\n").encode(self._file_kind(path).encoding)
+        if offset == index.size and not index.ends_with_newline:
+            # Start a new line rather than extending the unterminated last one
+            inserted = b"\n" + inserted
+        self.writer.splice(path, offset, 0, inserted)
+        self.journal.record(path, offset, inserted, b"")
+        self._edited(path, index, offset, 0, inserted, inserted.count(b"\n"))
         return {"content": "Content inserted successfully"}
 
+    def _handle_undo_edit(self, path: str, _: Dict[str, Any]) -> Dict[str, Any]:
+        """Handle undo_edit command"""
+        entry = self.journal.pop(path)
+        if entry is None:
+            return {"error": f"No edit to undo for {path}"}
+        index = self._line_index(path)
+        with open(path, "rb") as f:
+            current = os.pread(f.fileno(), entry.inserted_length, entry.offset)
+        if not entry.matches(current):
+            self.journal.forget(path)
+            return {"error": f"{path} was changed outside the editor; cannot undo"}
+
+        if entry.removed is None:
+            # The edit created the file
+            self.writer.remove(path)
+            self.line_indexes.pop(path, None)
+            self.content_cache.discard(path)
+            self.changed_paths.add(path)
+        else:
+            self.writer.splice(path, entry.offset, entry.inserted_length, entry.removed)
+            self._edited(
+                path,
+                index,
+                entry.offset,
+                entry.inserted_length,
+                entry.removed,
+                entry.removed.count(b"\n") - current.count(b"\n"),
+            )
+        return {"content": f"Last edit to {path} undone successfully"}
+
+    def batch_edit(self, path: str, edits: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Apply several edits to one file with one scan and one write, all or none.
+
+        Each edit is {"old_str", "new_str"} to replace a unique match, or
+        {"insert_line", "new_str"} to insert after a line. Matches and line
+        numbers refer to the file before the batch. Undone as one edit.
+        """
+        try:
+            return self._apply_edits(self._get_editor_path(path), edits)
+        except Exception as e:
+            self.logger.error(f"Error in batch_edit: {str(e)}")
+            return {"error": str(e)}
+
+    def _apply_edits(self, path: str, edits: List[Dict[str, Any]]) -> Dict[str, Any]:
+        if not edits:
+            return {"error": "No edits given"}
+        if not os.path.isfile(path):
+            return {"error": f"File {path} does not exist"}
+        error = self._edit_error(path)
+        if error:
+            return error
+        encoding = self._file_kind(path).encoding
+        index = self._line_index(path)
+        replacements = [
+            (number, edit["old_str"].encode(encoding))
+            for number, edit in enumerate(edits, 1)
+            if "old_str" in edit
+        ]
+        for number, old in replacements:
+            if not old:
+                return {"error": f"Edit {number}: old_str must not be empty"}
+
+        data = self.content_cache.read(path)
+        if data is None:
+            data = open_mmap(path)
+        try:
+            # (offset, bytes removed, bytes inserted, edit number)
+            hunks = []
+            matches = scan_patterns(data, [old for _, old in replacements])
+            for (number, old), (count, positions) in zip(replacements, matches):
+                if count == 0:
+                    return self._not_found(path, edits[number - 1]["old_str"], f"Edit {number}: ")
+                if count > 1:
+                    lines = ", ".join(str(index.line_at(data, match)) for match in positions)
+                    return {
+                        "error": f"Edit {number}: old_str matches {count} times in the file "
+                        f"(lines {lines}); include more context to make it unique"
+                    }
+                new = edits[number - 1].get("new_str", "").encode(encoding)
+                hunks.append((positions[0], len(old), new, number))
+
+            for number, edit in enumerate(edits, 1):
+                if "old_str" in edit:
+                    continue
+                line = edit.get("insert_line")
+                if not isinstance(line, int) or not 0 <= line <= index.line_count:
+                    return {"error": f"Edit {number}: needs old_str or a valid insert_line"}
+                offset = index.line_offset(line)
+                inserted = (edit.get("new_str", "") + "\n").encode(encoding)
+                if offset == index.size and not index.ends_with_newline:
+                    inserted = b"\n" + inserted
+                hunks.append((offset, 0, inserted, number))
+
+            # Inserts go before a replacement starting at the same offset
+            hunks.sort(key=lambda hunk: (hunk[0], hunk[1] > 0, hunk[3]))
+            for previous, hunk in zip(hunks, hunks[1:]):
+                if hunk[0] < previous[0] + previous[1]:
+                    return {"error": f"Edits {previous[3]} and {hunk[3]} overlap"}
+            start = hunks[0][0]
+            end = hunks[-1][0] + hunks[-1][1]
+            old_span = bytes(data[start:end]) if data is not None else b""
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+        self.writer.splice_many(path, [hunk[:3] for hunk in hunks])
+
+        # Journal and index the batch as one edit spanning all hunks
+        pieces = []
+        position = start
+        for offset, removed, inserted, _ in hunks:
+            pieces.append(old_span[position - start : offset - start])
+            pieces.append(inserted)
+            position = offset + removed
+        new_span = b"".join(pieces)
+        self.journal.record(path, start, new_span, old_span)
+        self._edited(
+            path,
+            index,
+            start,
+            end - start,
+            new_span,
+            new_span.count(b"\n") - old_span.count(b"\n"),
+        )
+        return {"content": f"Applied {len(edits)} edits to {path}"}
+
+    def handle_batch_edit_tool(self, tool_call: Dict[str, Any]) -> Dict[str, Any]:
+        """Handle batch_edit tool calls"""
+        if not isinstance(tool_call.get("path"), str) or not isinstance(
+            tool_call.get("edits"), list
+        ):
+            return {"error": "Missing required fields"}
+        return self.batch_edit(tool_call["path"], tool_call["edits"])
+
     def log_to_session(self, data: Dict[str, Any], section: str) -> None:
         """Log data to session log file"""
-        self.logger.info(f"{section}: {data}")
+        self.logger.info("%s", section, extra={"event": section, "data": data})
 
     def handle_text_editor_tool(self, tool_call: Dict[str, Any]) -> Dict[str, Any]:
         """Handle text editor tool calls"""
@@ -189,7 +1081,6 @@ class EditorSession:
             if not all(key in tool_call for key in ["command", "path"]):
                 return {"error": "Missing required fields"}
 
-            # Get path and ensure directory exists
             path = self._get_editor_path(tool_call["path"])
 
             handlers = {
@@ -197,6 +1088,7 @@ class EditorSession:
                 "create": self._handle_create,
                 "str_replace": self._handle_str_replace,
                 "insert": self._handle_insert,
+                "undo_edit": self._handle_undo_edit,
             }
 
             handler = handlers.get(command)
@@ -209,134 +1101,219 @@ class EditorSession:
             self.logger.error(f"Error in handle_text_editor_tool: {str(e)}")
             return {"error": str(e)}
 
+    def _tool_calls_conflict(self, first: Any, second: Any) -> bool:
+        """Two editor calls conflict if they touch the same file and one writes it"""
+        if first.input.get("command") == "view" and second.input.get("command") == "view":
+            return False
+        try:
+            return self._get_editor_path(first.input.get("path", "")) == self._get_editor_path(
+                second.input.get("path", "")
+            )
+        except ValueError:
+            # A path outside editor_dir fails on its own; keep it out of the way
+            return True
+
+    def checkpoint(self) -> Optional[str]:
+        """Snapshot editor_dir and return the checkpoint's name.
+
+        The first checkpoint of a session stores the whole directory; later
+        ones store only the files the session wrote since the previous one.
+        Returns None without a snapshot store.
+        """
+        if self.snapshots is None:
+            return None
+        if self.checkpoints and not self.changed_paths:
+            return self.checkpoints[-1]
+        changed, self.changed_paths = self.changed_paths, set()
+        if self.checkpoints:
+            changes = self.snapshots.changes(self.editor_dir, changed)
+            parent = self.checkpoints[-1]
+        else:
+            changes = self.snapshots.scan(self.editor_dir)
+            parent = None
+
+        name = f"{self.session_id}/{len(self.checkpoints):04d}"
+        self.snapshots.save(name, changes, parent)
+        self.checkpoints.append(name)
+        self.logger.info(
+            "Checkpoint %s: %d files",
+            name,
+            len(changes),
+            extra={"event": "checkpoint", "data": {"name": name, "files": len(changes)}},
+        )
+        return name
+
+    def restore_checkpoint(self, name: str) -> None:
+        """Put editor_dir back in the state recorded by checkpoint `name`"""
+        # Copies: links into the live directory would be shared with other files
+        changed = self.snapshots.restore(
+            self.snapshots.load(name), self.editor_dir, link=False
+        )
+        self.changed_paths.update(changed)
+        # Journaled offsets don't apply to the restored files
+        self.journal = EditJournal()
+        self.line_indexes.clear()
+
+    def branch(self, name: str, editor_dir: str) -> "EditorSession":
+        """A new session working on a copy of checkpoint `name` in `editor_dir`.
+
+        Files are hard-linked from this session's directory where the
+        content matches, so branching costs little more than the metadata.
+        Edits that rewrite a file in place (`>>`, truncate) show up in both.
+        """
+        session = EditorSession(group_commit=self.writer.group_commit, snapshots=self.snapshots)
+        session.editor_dir = editor_dir
+        self.snapshots.restore(self.snapshots.load(name), editor_dir)
+        session.checkpoints.append(name)
+        return session
+
     def process_tool_calls(
         self, tool_calls: List[anthropic.types.ContentBlock]
     ) -> List[Dict[str, Any]]:
-        """Process tool calls and return results"""
-        results = []
+        """Process tool calls, then checkpoint what they changed"""
+        results = super().process_tool_calls(tool_calls)
+        self.checkpoint()
+        return results
 
-        for tool_call in tool_calls:
-            if tool_call.type == "tool_use" and tool_call.name == "str_replace_editor":
+    async def process_tool_calls_async(
+        self, tool_calls: List[anthropic.types.ContentBlock]
+    ) -> List[Dict[str, Any]]:
+        """Async version of process_tool_calls"""
+        results = await super().process_tool_calls_async(tool_calls)
+        await asyncio.to_thread(self.checkpoint)
+        return results
 
-                # Log the keys and first 20 characters of the values of the tool_call
-                for key, value in tool_call.input.items():
-                    truncated_value = str(value)[:20] + (
-                        "..." if len(str(value)) > 20 else ""
-                    )
-                    self.logger.info(
-                        f"Tool call key: {key}, Value (truncated): {truncated_value}"
-                    )
+    def _run_tool_call(self, tool_call: Any, _: bool) -> Dict[str, Any]:
+        """Run one editor tool call and return it in tool result format"""
+        # Log the command and path; the full input goes to the JSONL file only
+        self.logger.info(
+            "Tool call: %s %s",
+            tool_call.input.get("command", tool_call.name),
+            tool_call.input.get("path"),
+            extra={"event": "tool_call", "data": tool_call.input},
+        )
 
-                result = self.handle_text_editor_tool(tool_call.input)
-                # Convert result to match expected tool result format
-                is_error = False
-
-                if result.get("error"):
-                    is_error = True
-                    tool_result_content = [{"type": "text", "text": result["error"]}]
-                else:
-                    tool_result_content = [
-                        {"type": "text", "text": result.get("content", "")}
-                    ]
-
-                results.append(
-                    {
-                        "tool_call_id": tool_call.id,
-                        "output": {
-                            "type": "tool_result",
-                            "content": tool_result_content,
-                            "tool_use_id": tool_call.id,
-                            "is_error": is_error,
-                        },
-                    }
-                )
+        if tool_call.name == BATCH_EDIT_TOOL["name"]:
+            result = self.handle_batch_edit_tool(tool_call.input)
+        else:
+            result = self.handle_text_editor_tool(tool_call.input)
+        return format_tool_result(tool_call.id, result)
 
-        return results
+    async def _run_tool_call_async(self, tool_call: Any, _: bool) -> Dict[str, Any]:
+        """Run one editor tool call without blocking the event loop"""
+        return await asyncio.to_thread(self._run_tool_call, tool_call, True)
 
     def process_edit(self, edit_prompt: str) -> None:
         """Main method to process editing prompts"""
         try:
-            # Initial message with proper content structure
-            api_message = {
-                "role": "user",
-                "content": [{"type": "text", "text": edit_prompt}],
-            }
-            self.messages = [api_message]
-
-            self.logger.info(f"User input: {api_message}")
-
-            while True:
-                response = self.client.beta.messages.create(
-                    model="claude-3-5-sonnet-20241022",
-                    max_tokens=4096,
-                    messages=self.messages,
-                    tools=[
-                        {"type": "text_editor_20241022", "name": "str_replace_editor"}
-                    ],
-                    system=EDITOR_SYSTEM_PROMPT,
-                    betas=["computer-use-2024-10-22"],
-                )
-
-                # Extract token usage from the response
-                input_tokens = getattr(response.usage, "input_tokens", 0)
-                output_tokens = getattr(response.usage, "output_tokens", 0)
-                self.logger.info(
-                    f"API usage: input_tokens={input_tokens}, output_tokens={output_tokens}"
-                )
-
-                # Update token counts in SessionLogger
-                self.session_logger.update_token_usage(input_tokens, output_tokens)
-
-                self.logger.info(f"API response: {response.model_dump()}")
-
-                # Convert response content to message params
-                response_content = []
-                for block in response.content:
-                    if block.type == "text":
-                        response_content.append({"type": "text", "text": block.text})
-                    else:
-                        response_content.append(block.model_dump())
-
-                # Add assistant response to messages
-                self.messages.append({"role": "assistant", "content": response_content})
-
-                if response.stop_reason != "tool_use":
-                    print(response.content[0].text)
-                    break
-
-                tool_results = self.process_tool_calls(response.content)
-
-                # Add tool results as user message
-                if tool_results:
-                    self.messages.append(
-                        {"role": "user", "content": [tool_results[0]["output"]]}
-                    )
-
-                    if tool_results[0]["output"]["is_error"]:
-                        self.logger.error(
-                            f"Error: {tool_results[0]['output']['content']}"
-                        )
-                        break
-
-            # After the execution loop, log the total cost
-            self.session_logger.log_total_cost()
-
+            self.checkpoint()
+            self._run_loop(edit_prompt)
         except Exception as e:
             self.logger.error(f"Error in process_edit: {str(e)}")
             self.logger.error(traceback.format_exc())
             raise
 
+    async def process_edit_async(self, edit_prompt: str) -> None:
+        """Async version of process_edit, built on AsyncAnthropic"""
+        try:
+            await asyncio.to_thread(self.checkpoint)
+            await self._run_loop_async(edit_prompt)
+        except Exception as e:
+            self.logger.error(f"Error in process_edit_async: {str(e)}")
+            self.logger.error(traceback.format_exc())
+            raise
 
-class BashSession:
-    def __init__(self, session_id: Optional[str] = None, no_agi: bool = False):
-        """Initialize Bash session with optional existing session ID"""
+    def close(self) -> None:
+        """Wait until every file written by the session is on disk"""
+        self.writer.close()
+
+
+class OutputStreamer:
+    """Forwards a command's output to the session log, and so the console, as it runs.
+
+    Each block of whole lines read from the shell becomes one log record.
+    While the log writer is more than STREAM_MAX_BACKLOG records behind,
+    the streamer waits, so the shell's pipes fill up and the command blocks
+    instead of its output piling up in the log queue. Streaming stops after
+    `max_bytes`; the tool result still has the (bounded) full output.
+    """
+
+    def __init__(self, session: "BashSession", command: str, max_bytes: int = STREAM_MAX_BYTES):
+        self.logger = session.logger
+        self.pool = session.session_logger.pool
+        self.command = command
+        self.max_bytes = max_bytes
+        self.streamed_bytes = 0
+        self.truncated = False
+
+    def _log(self, stream: str, data: bytes) -> bool:
+        """Log a block of output; False once past max_bytes"""
+        if self.truncated:
+            return False
+        if self.streamed_bytes + len(data) > self.max_bytes:
+            self.truncated = True
+            self.logger.info(
+                "Output of '%s' is over %d bytes; no longer streaming it",
+                self.command[:20],
+                self.max_bytes,
+                extra={"event": "command_output_stream_stopped"},
+            )
+            return False
+        self.streamed_bytes += len(data)
+        self.logger.log(
+            logging.ERROR if stream == "stderr" else logging.INFO,
+            "%s",
+            data.decode(errors="replace").rstrip("\n"),
+            extra={"event": f"command_{stream}_stream"},
+        )
+        return True
+
+    def __call__(self, stream: str, data: bytes) -> None:
+        if self._log(stream, data):
+            while self.pool.backlog > STREAM_MAX_BACKLOG:
+                time.sleep(STREAM_BACKLOG_POLL_INTERVAL)
+
+    async def stream_async(self, stream: str, data: bytes) -> None:
+        if self._log(stream, data):
+            while self.pool.backlog > STREAM_MAX_BACKLOG:
+                await asyncio.sleep(STREAM_BACKLOG_POLL_INTERVAL)
+
+
+class BashSession(AgentSession):
+    tool_name = "bash"
+    tools = [{"type": "bash_20241022", "name": "bash"}]
+    system_prompt = BASH_SYSTEM_PROMPT
+
+    def __init__(
+        self,
+        session_id: Optional[str] = None,
+        no_agi: bool = False,
+        command_timeout: Optional[float] = DEFAULT_COMMAND_TIMEOUT,
+        session_timeout: Optional[float] = None,
+        command_cpu_limit: Optional[float] = None,
+        session_cpu_limit: Optional[float] = None,
+        cache_commands: bool = False,
+        stream_output: bool = True,
+    ):
+        """Initialize Bash session with optional existing session ID.
+
+        Timeouts and CPU limits are in seconds; None disables a budget. A
+        tool call may pass its own `timeout`, which still cannot exceed what
+        is left of the session budget. With `cache_commands`, read-only
+        commands whose inputs haven't changed are answered from a cache.
+        With `stream_output`, command output is logged as it arrives rather
+        than when the command finishes.
+        """
         self.session_id = session_id or self._create_session_id()
         self.sessions_dir = SESSIONS_DIR
         self.client = anthropic.Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
         self.messages = []
 
-        # Initialize a persistent environment dictionary for subprocesses
-        self.environment = os.environ.copy()
+        # Long-lived bash process, started lazily on the first command, which
+        # inherits our environment and tracks what commands change in it.
+        # The async loop uses its own asyncio-driven shell.
+        self.bash = BashProcess()
+        self.async_bash = AsyncBashProcess()
 
         # Initialize logger placeholder
         self.logger = None
@@ -347,12 +1324,17 @@ class BashSession:
         # Store the no_agi flag
         self.no_agi = no_agi
 
-    def set_logger(self, session_logger: SessionLogger):
-        """Set the logger for the session and store the SessionLogger instance."""
-        self.session_logger = session_logger
-        self.logger = logging.LoggerAdapter(
-            session_logger.logger, {"prefix": self.log_prefix}
-        )
+        # Wall-clock and CPU budgets, and what has been used of them so far
+        self.command_timeout = command_timeout
+        self.session_timeout = session_timeout
+        self.command_cpu_limit = command_cpu_limit
+        self.session_cpu_limit = session_cpu_limit
+        self.wall_time_used = 0.0
+        self.cpu_time_used = 0.0
+        self.budget_lock = threading.Lock()
+
+        self.command_cache = CommandCache() if cache_commands else None
+        self.stream_output = stream_output
 
     def _create_session_id(self) -> str:
         """Create a new session ID"""
@@ -360,173 +1342,318 @@ class BashSession:
         # return f"{timestamp}-{uuid.uuid4().hex[:6]}"
         return f"{timestamp}"
 
-    def _handle_bash_command(self, tool_call: Dict[str, Any]) -> Dict[str, Any]:
-        """Handle bash command execution"""
-        try:
-            command = tool_call.get("command")
-            restart = tool_call.get("restart", False)
-
-            if restart:
-                self.environment = os.environ.copy()  # Reset the environment
-                self.logger.info("Bash session restarted.")
-                return {"content": "Bash session restarted."}
-
-            if not command:
-                self.logger.error("No command provided to execute.")
-                return {"error": "No command provided to execute."}
-
-            # Check if no_agi is enabled
-            if self.no_agi:
-                self.logger.info(f"Mock executing bash command: {command}")
-                return {"content": "in mock mode, command did not run"}
+    def _command_budget(
+        self, tool_call: Dict[str, Any]
+    ) -> Tuple[Optional[float], Optional[float]]:
+        """Return the (timeout, cpu_limit) for a command, bounded by the session budget"""
+        timeout = tool_call.get("timeout", self.command_timeout)
+        if self.session_timeout is not None:
+            remaining = self.session_timeout - self.wall_time_used
+            timeout = remaining if timeout is None else min(timeout, remaining)
+
+        cpu_limit = self.command_cpu_limit
+        if self.session_cpu_limit is not None:
+            remaining = self.session_cpu_limit - self.cpu_time_used
+            cpu_limit = remaining if cpu_limit is None else min(cpu_limit, remaining)
+
+        return timeout, cpu_limit
+
+    def _check_command(self, tool_call: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Return a result for a command that must not run, or None if it may"""
+        command = tool_call.get("command")
+
+        if not command:
+            self.logger.error("No command provided to execute.")
+            return {"error": "No command provided to execute."}
+
+        # Check if no_agi is enabled
+        if self.no_agi:
+            self.logger.info("Mock executing bash command: %s", command)
+            return {"content": "in mock mode, command did not run"}
+
+        timeout, cpu_limit = self._command_budget(tool_call)
+        if (timeout is not None and timeout <= 0) or (
+            cpu_limit is not None and cpu_limit <= 0
+        ):
+            self.logger.error("Session time budget exhausted.")
+            return {"error": "Session time budget exhausted, command did not run."}
+
+        # Log the command being executed
+        self.logger.info("Executing bash command: %s", command)
+        return None
+
+    def _command_result(
+        self,
+        command: str,
+        result: CommandResult,
+        timeout: Optional[float],
+        cpu_limit: Optional[float],
+        streamer: Optional[OutputStreamer] = None,
+    ) -> Dict[str, Any]:
+        """Account for a finished command and convert it to a handler result"""
+        with self.budget_lock:
+            self.wall_time_used += result.duration
+            self.cpu_time_used += result.cpu_seconds or 0.0
+        if result.usage is not None:
+            self.session_logger.update_command_usage(result.usage)
+            self.logger.info(
+                "Command resources: %s",
+                result.usage.summary(),
+                extra={
+                    "event": "command_usage",
+                    "data": {"command": command, **result.usage.as_dict()},
+                },
+            )
 
-            # Log the command being executed
-            self.logger.info(f"Executing bash command: {command}")
+        output = result.stdout.strip()
+        error_output = result.stderr.strip()
 
-            # Execute the command in a subprocess
-            result = subprocess.run(
+        # Log the outputs, unless they were all streamed to the log already
+        streamed = streamer is not None and not streamer.truncated
+        if streamed:
+            if not result.timed_out:
+                self.logger.info(
+                    "Command finished with exit code %s",
+                    result.returncode,
+                    extra={"event": "command_finished"},
+                )
+        elif output:
+            self.logger.info(
+                "Command output:\n\n```output for '%s...'\n%s\n```",
+                command[:20],
+                output,
+                extra={"event": "command_output"},
+            )
+        if error_output and not streamed:
+            self.logger.error(
+                "Command error output:\n\n```error for '%s'\n%s\n```",
                 command,
-                shell=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                env=self.environment,
-                text=True,
-                executable="/bin/bash",
+                error_output,
+                extra={"event": "command_error_output"},
             )
 
-            output = result.stdout.strip()
-            error_output = result.stderr.strip()
+        if result.timed_out:
+            return self._timeout_result(result, timeout, cpu_limit)
+
+        if result.returncode != 0:
+            error_message = error_output or "Command execution failed."
+            return {"error": error_message}
+
+        return {"content": output}
+
+    def _cached_command(
+        self, command: str, cwd: str, env: Dict[str, Optional[str]]
+    ) -> Tuple[Optional[CommandResult], Any]:
+        """A still valid cached result for a command, else the watch to cache it with"""
+        if self.command_cache is None:
+            return None, None
+        cached = self.command_cache.get(command, cwd, env)
+        if cached is not None:
+            self.logger.info(
+                "Command result served from cache: %s", command, extra={"event": "command_cache_hit"}
+            )
+            return cached, None
+        return None, self.command_cache.watch(command, cwd)
 
-            # Log the outputs
-            if output:
-                self.logger.info(
-                    f"Command output:\n\n```output for '{command[:20]}...'\n{output}\n```"
-                )
-            if error_output:
-                self.logger.error(
-                    f"Command error output:\n\n```error for '{command}'\n{error_output}\n```"
-                )
+    def _handle_bash_command(
+        self, tool_call: Dict[str, Any], bash: Optional[BashProcess] = None
+    ) -> Dict[str, Any]:
+        """Handle bash command execution, in the session's shell unless `bash` is given"""
+        bash = bash or self.bash
+        try:
+            if tool_call.get("restart", False):
+                self.bash.restart(reset=True)
+                if self.command_cache is not None:
+                    self.command_cache.clear()
+                self.logger.info("Bash session restarted.")
+                return {"content": "Bash session restarted."}
 
-            if result.returncode != 0:
-                error_message = error_output or "Command execution failed."
-                return {"error": error_message}
+            rejection = self._check_command(tool_call)
+            if rejection is not None:
+                return rejection
 
-            return {"content": output}
+            # Execute the command in the persistent bash process
+            command = tool_call["command"]
+            timeout, cpu_limit = self._command_budget(tool_call)
+            cwd = bash.cwd or os.getcwd()
+            env = dict(bash.state.env_changes)
+            cached, watch = self._cached_command(command, cwd, env)
+            if cached is not None:
+                return self._command_result(command, cached, timeout, cpu_limit)
+            streamer = OutputStreamer(self, command) if self.stream_output else None
+            result = bash.run(command, timeout=timeout, cpu_limit=cpu_limit, on_output=streamer)
+            if self.command_cache is not None:
+                self.command_cache.record(command, cwd, env, watch, result)
+            return self._command_result(command, result, timeout, cpu_limit, streamer)
 
         except Exception as e:
             self.logger.error(f"Error in _handle_bash_command: {str(e)}")
             self.logger.error(traceback.format_exc())
             return {"error": str(e)}
 
-    def process_tool_calls(
-        self, tool_calls: List[anthropic.types.ContentBlock]
-    ) -> List[Dict[str, Any]]:
-        """Process tool calls and return results"""
-        results = []
-
-        for tool_call in tool_calls:
-            if tool_call.type == "tool_use" and tool_call.name == "bash":
-                self.logger.info(f"Bash tool call input: {tool_call.input}")
-
-                result = self._handle_bash_command(tool_call.input)
-
-                # Convert result to match expected tool result format
-                is_error = False
-
-                if result.get("error"):
-                    is_error = True
-                    tool_result_content = [{"type": "text", "text": result["error"]}]
-                else:
-                    tool_result_content = [
-                        {"type": "text", "text": result.get("content", "")}
-                    ]
-
-                results.append(
-                    {
-                        "tool_call_id": tool_call.id,
-                        "output": {
-                            "type": "tool_result",
-                            "content": tool_result_content,
-                            "tool_use_id": tool_call.id,
-                            "is_error": is_error,
-                        },
-                    }
-                )
-
-        return results
-
-    def process_bash_command(self, bash_prompt: str) -> None:
-        """Main method to process bash commands via the assistant"""
+    async def _handle_bash_command_async(
+        self, tool_call: Dict[str, Any], bash: Optional[AsyncBashProcess] = None
+    ) -> Dict[str, Any]:
+        """Async version of _handle_bash_command, using the session's AsyncBashProcess"""
+        bash = bash or self.async_bash
         try:
-            # Initial message with proper content structure
-            api_message = {
-                "role": "user",
-                "content": [{"type": "text", "text": bash_prompt}],
-            }
-            self.messages = [api_message]
-
-            self.logger.info(f"User input: {api_message}")
-
-            while True:
-                response = self.client.beta.messages.create(
-                    model="claude-3-5-sonnet-20241022",
-                    max_tokens=4096,
-                    messages=self.messages,
-                    tools=[{"type": "bash_20241022", "name": "bash"}],
-                    system=BASH_SYSTEM_PROMPT,
-                    betas=["computer-use-2024-10-22"],
-                )
+            if tool_call.get("restart", False):
+                await self.async_bash.restart(reset=True)
+                if self.command_cache is not None:
+                    self.command_cache.clear()
+                self.logger.info("Bash session restarted.")
+                return {"content": "Bash session restarted."}
 
-                # Extract token usage from the response
-                input_tokens = getattr(response.usage, "input_tokens", 0)
-                output_tokens = getattr(response.usage, "output_tokens", 0)
-                self.logger.info(
-                    f"API usage: input_tokens={input_tokens}, output_tokens={output_tokens}"
-                )
+            rejection = self._check_command(tool_call)
+            if rejection is not None:
+                return rejection
 
-                # Update token counts in SessionLogger
-                self.session_logger.update_token_usage(input_tokens, output_tokens)
+            command = tool_call["command"]
+            timeout, cpu_limit = self._command_budget(tool_call)
+            cwd = bash.cwd or os.getcwd()
+            env = dict(bash.state.env_changes)
+            cached, watch = None, None
+            if self.command_cache is not None:
+                # Stats and scans whole trees; keep it off the event loop
+                cached, watch = await asyncio.to_thread(self._cached_command, command, cwd, env)
+            if cached is not None:
+                return self._command_result(command, cached, timeout, cpu_limit)
+            streamer = OutputStreamer(self, command) if self.stream_output else None
+            result = await bash.run(
+                command,
+                timeout=timeout,
+                cpu_limit=cpu_limit,
+                on_output=streamer.stream_async if streamer else None,
+            )
+            if self.command_cache is not None:
+                self.command_cache.record(command, cwd, env, watch, result)
+            return self._command_result(command, result, timeout, cpu_limit, streamer)
 
-                self.logger.info(f"API response: {response.model_dump()}")
+        except Exception as e:
+            self.logger.error(f"Error in _handle_bash_command_async: {str(e)}")
+            self.logger.error(traceback.format_exc())
+            return {"error": str(e)}
 
-                # Convert response content to message params
-                response_content = []
-                for block in response.content:
-                    if block.type == "text":
-                        response_content.append({"type": "text", "text": block.text})
-                    else:
-                        response_content.append(block.model_dump())
+    def _timeout_result(
+        self, result: CommandResult, timeout: Optional[float], cpu_limit: Optional[float]
+    ) -> Dict[str, Any]:
+        """Build the tool result for a command that was killed for exceeding a budget"""
+        if result.timed_out == "cpu":
+            reason = f"Command exceeded its CPU limit of {cpu_limit:.1f}s"
+        else:
+            reason = f"Command timed out after {timeout:.1f}s"
+        used = f"{result.duration:.1f}s wall"
+        if result.cpu_seconds is not None:
+            used += f", {result.cpu_seconds:.1f}s CPU"
+        message = (
+            f"{reason} ({used} used) and was killed. The bash session was restarted "
+            "in the same working directory and environment, but other shell state "
+            "such as functions and unexported variables was reset."
+        )
+        self.logger.error(
+            message,
+            extra={
+                "event": "command_timeout",
+                "data": {
+                    "timed_out": result.timed_out,
+                    "duration": round(result.duration, 3),
+                    "cpu_seconds": (
+                        round(result.cpu_seconds, 3) if result.cpu_seconds is not None else None
+                    ),
+                    "timeout": timeout,
+                    "cpu_limit": cpu_limit,
+                },
+            },
+        )
 
-                # Add assistant response to messages
-                self.messages.append({"role": "assistant", "content": response_content})
+        parts = [message]
+        if result.stdout.strip():
+            parts.append(f"Partial output:\n{result.stdout.strip()}")
+        if result.stderr.strip():
+            parts.append(f"Partial error output:\n{result.stderr.strip()}")
+
+        return {"error": "\n\n".join(parts)}
+
+    def _runs_in_clone(self, tool_call: Any) -> bool:
+        """Whether a call can run in a throwaway shell with the same result"""
+        command = tool_call.input.get("command") or ""
+        return (
+            is_read_only_command(command)
+            and runs_alike_in_clone(command, self.bash.state)
+            and runs_alike_in_clone(command, self.async_bash.state)
+        )
 
-                if response.stop_reason != "tool_use":
-                    # Print the assistant's final response
-                    print(response.content[0].text)
-                    break
+    def _tool_calls_conflict(self, first: Any, second: Any) -> bool:
+        """Only read-only commands that run alike in a clone may run alongside each other"""
+        return not (self._runs_in_clone(first) and self._runs_in_clone(second))
 
-                tool_results = self.process_tool_calls(response.content)
+    def _run_tool_call(self, tool_call: Any, concurrent: bool) -> Dict[str, Any]:
+        """Run one bash tool call and return it in tool result format"""
+        self.logger.info(
+            "Bash tool call input: %s",
+            tool_call.input,
+            extra={"event": "tool_call", "data": tool_call.input},
+        )
 
-                # Add tool results as user message
-                if tool_results:
-                    self.messages.append(
-                        {"role": "user", "content": [tool_results[0]["output"]]}
-                    )
+        if concurrent and not tool_call.input.get("restart"):
+            # The persistent shell runs one command at a time, so concurrent
+            # read-only commands each get a throwaway shell in the same state
+            bash = self.bash.clone()
+            try:
+                result = self._handle_bash_command(tool_call.input, bash)
+            finally:
+                bash.stop()
+        else:
+            result = self._handle_bash_command(tool_call.input)
+
+        return format_tool_result(tool_call.id, result)
+
+    async def _run_tool_call_async(self, tool_call: Any, concurrent: bool) -> Dict[str, Any]:
+        """Run one bash tool call on the event loop"""
+        self.logger.info(
+            "Bash tool call input: %s",
+            tool_call.input,
+            extra={"event": "tool_call", "data": tool_call.input},
+        )
 
-                    if tool_results[0]["output"]["is_error"]:
-                        self.logger.error(
-                            f"Error: {tool_results[0]['output']['content']}"
-                        )
-                        break
+        if concurrent and not tool_call.input.get("restart"):
+            bash = self.async_bash.clone()
+            try:
+                result = await self._handle_bash_command_async(tool_call.input, bash)
+            finally:
+                await bash.stop()
+        else:
+            result = await self._handle_bash_command_async(tool_call.input)
 
-            # After the execution loop, log the total cost
-            self.session_logger.log_total_cost()
+        return format_tool_result(tool_call.id, result)
 
+    def process_bash_command(self, bash_prompt: str) -> None:
+        """Main method to process bash commands via the assistant"""
+        try:
+            self._run_loop(bash_prompt)
         except Exception as e:
             self.logger.error(f"Error in process_bash_command: {str(e)}")
             self.logger.error(traceback.format_exc())
             raise
 
+    async def process_bash_command_async(self, bash_prompt: str) -> None:
+        """Async version of process_bash_command, built on AsyncAnthropic"""
+        try:
+            await self._run_loop_async(bash_prompt)
+        except Exception as e:
+            self.logger.error(f"Error in process_bash_command_async: {str(e)}")
+            self.logger.error(traceback.format_exc())
+            raise
+
+    def close(self) -> None:
+        """Stop the persistent bash process"""
+        self.bash.stop()
+
+    async def aclose(self) -> None:
+        """Stop the bash processes used by the sync and the async loop"""
+        self.bash.stop()
+        await self.async_bash.stop()
+
 
 def main():
     """Main entry point"""
@@ -540,25 +1667,89 @@ def main():
         action="store_true",
         help="When set, commands will not be executed, but will return 'command ran'.",
     )
+    parser.add_argument(
+        "--command-timeout",
+        type=float,
+        default=DEFAULT_COMMAND_TIMEOUT,
+        help="Wall-clock limit in seconds for each bash command.",
+    )
+    parser.add_argument(
+        "--session-timeout",
+        type=float,
+        help="Total wall-clock budget in seconds for all bash commands.",
+    )
+    parser.add_argument(
+        "--cpu-limit",
+        type=float,
+        help="CPU time limit in seconds for each bash command.",
+    )
+    parser.add_argument(
+        "--session-cpu-limit",
+        type=float,
+        help="Total CPU time budget in seconds for all bash commands.",
+    )
+    parser.add_argument(
+        "--cache-commands",
+        action="store_true",
+        help="Reuse results of read-only bash commands whose inputs haven't changed.",
+    )
+    parser.add_argument(
+        "--history-budget",
+        type=int,
+        default=DEFAULT_HISTORY_TOKEN_BUDGET,
+        help="Estimated history size in tokens above which old tool output is compacted.",
+    )
+    parser.add_argument(
+        "--group-commit",
+        action="store_true",
+        help=(
+            "Batch the fsyncs of editor writes instead of syncing each one; "
+            "a crash may then leave the latest writes truncated."
+        ),
+    )
+    parser.add_argument(
+        "--snapshots",
+        action="store_true",
+        help=f"Checkpoint the editor directory after every turn, in {SNAPSHOTS_DIR}.",
+    )
     args = parser.parse_args()
 
     # Create a shared session ID
     session_id = datetime.now().strftime("%Y%m%d-%H%M%S") + "-" + uuid.uuid4().hex[:6]
-    # Create a single SessionLogger instance
-    session_logger = SessionLogger(session_id, SESSIONS_DIR)
-
-    if args.mode == "editor":
-        session = EditorSession(session_id=session_id)
-        # Pass the logger via setter method
-        session.set_logger(session_logger)
-        print(f"Session ID: {session.session_id}")
-        session.process_edit(args.prompt)
-    elif args.mode == "bash":
-        session = BashSession(session_id=session_id, no_agi=args.no_agi)
-        # Pass the logger via setter method
-        session.set_logger(session_logger)
-        print(f"Session ID: {session.session_id}")
-        session.process_bash_command(args.prompt)
+    # Create a single SessionLogger instance; closing it flushes the log
+    with SessionLogger(session_id, SESSIONS_DIR) as session_logger:
+        if args.mode == "editor":
+            session = EditorSession(
+                session_id=session_id,
+                group_commit=args.group_commit,
+                snapshots=SnapshotStore() if args.snapshots else None,
+            )
+            session.history_token_budget = args.history_budget
+            # Pass the logger via setter method
+            session.set_logger(session_logger)
+            print(f"Session ID: {session.session_id}")
+            try:
+                session.process_edit(args.prompt)
+            finally:
+                session.close()
+        elif args.mode == "bash":
+            session = BashSession(
+                session_id=session_id,
+                no_agi=args.no_agi,
+                command_timeout=args.command_timeout,
+                session_timeout=args.session_timeout,
+                command_cpu_limit=args.cpu_limit,
+                session_cpu_limit=args.session_cpu_limit,
+                cache_commands=args.cache_commands,
+            )
+            session.history_token_budget = args.history_budget
+            # Pass the logger via setter method
+            session.set_logger(session_logger)
+            print(f"Session ID: {session.session_id}")
+            try:
+                session.process_bash_command(args.prompt)
+            finally:
+                session.close()
 
 
 if __name__ == "__main__":
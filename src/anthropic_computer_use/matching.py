@@ -0,0 +1,128 @@
+"""Find where an old_str that doesn't match a file was probably meant to go.
+
+When str_replace misses, the model usually has the right lines with the
+wrong indentation or spacing, or a slightly outdated copy of them. Rather
+than make it view the whole file again, the miss is answered with the
+closest regions of the file.
+
+Lines are compared by a whitespace-normalized form. One pass over the
+file records the lines whose normalized form occurs in old_str; each such
+line votes for the region start it implies, and the regions with the most
+votes win. When no line matches even after normalization, lines sharing
+the most words with old_str are ranked by similarity instead.
+"""
+
+import difflib
+import heapq
+import re
+from typing import Dict, Iterable, List, Set, Tuple
+
+# Files larger than this are not searched for near misses
+FUZZY_MAX_BYTES = 16 * 1024 * 1024
+
+# Regions suggested per miss
+MAX_CANDIDATES = 3
+
+# Lines of each suggested region shown in the error
+MAX_CANDIDATE_LINES = 20
+
+# Lines shortlisted by shared words before ranking by similarity, and the
+# similarity below which a region is not worth suggesting
+MAX_SHORTLIST = 50
+MIN_SIMILARITY = 0.5
+
+WORD = re.compile(r"\w+")
+
+
+class Candidate:
+    """Lines `start`-`end` (1-based, inclusive) of the file, and why they were picked"""
+
+    def __init__(self, start: int, end: int, score: float, reason: str):
+        self.start = start
+        self.end = end
+        self.score = score
+        self.reason = reason
+
+
+def normalize(line: str) -> str:
+    """A line with leading, trailing and repeated whitespace removed"""
+    return " ".join(line.split())
+
+
+def find_candidates(
+    lines: Iterable[str], old_str: str, limit: int = MAX_CANDIDATES
+) -> List[Candidate]:
+    """The regions of `lines` (the file, in order) most like `old_str`, best first"""
+    wanted = [normalize(line) for line in old_str.split("\n")]
+    while wanted and not wanted[-1]:
+        wanted.pop()
+    # Normalized line -> positions in old_str; blank lines don't vote
+    positions: Dict[str, List[int]] = {}
+    for position, line in enumerate(wanted):
+        if line:
+            positions.setdefault(line, []).append(position)
+    if not positions:
+        return []
+    voters = sum(len(found) for found in positions.values())
+    words = set(WORD.findall(old_str))
+
+    votes: Dict[int, Set[int]] = {}
+    shortlist: List[Tuple[int, int, str]] = []
+    for number, line in enumerate(lines, 1):
+        normalized = normalize(line)
+        for position in positions.get(normalized, ()):
+            votes.setdefault(number - position, set()).add(position)
+        if not votes and words:
+            shared = len(words.intersection(WORD.findall(normalized)))
+            if shared:
+                # Keep the lines sharing the most words with old_str
+                entry = (shared, -number, normalized)
+                if len(shortlist) < MAX_SHORTLIST:
+                    heapq.heappush(shortlist, entry)
+                elif entry > shortlist[0]:
+                    heapq.heapreplace(shortlist, entry)
+
+    if votes:
+        ranked = sorted(votes.items(), key=lambda item: (-len(item[1]), item[0]))
+        candidates = []
+        for start, matched in ranked[:limit]:
+            if len(matched) == voters:
+                reason = "matches except for whitespace"
+            else:
+                reason = f"{len(matched)} of {voters} lines match"
+            start = max(start, 1)
+            end = start + len(wanted) - 1
+            candidates.append(Candidate(start, end, len(matched) / voters, reason))
+        return candidates
+    return _similar_regions(shortlist, wanted, limit)
+
+
+def _similar_regions(
+    shortlist: List[Tuple[int, int, str]], wanted: List[str], limit: int
+) -> List[Candidate]:
+    """Rank shortlisted lines by similarity to their closest line of old_str"""
+    scored = []
+    for _, negative_number, line in shortlist:
+        matcher = difflib.SequenceMatcher(None, line)
+        best_ratio, best_position = 0.0, 0
+        for position, wanted_line in enumerate(wanted):
+            matcher.set_seq2(wanted_line)
+            if matcher.quick_ratio() > best_ratio:
+                ratio = matcher.ratio()
+                if ratio > best_ratio:
+                    best_ratio, best_position = ratio, position
+        if best_ratio >= MIN_SIMILARITY:
+            scored.append((best_ratio, -negative_number - best_position))
+
+    candidates = []
+    seen = set()
+    for ratio, start in sorted(scored, key=lambda item: (-item[0], item[1])):
+        start = max(start, 1)
+        if start in seen:
+            continue
+        seen.add(start)
+        end = start + len(wanted) - 1
+        candidates.append(Candidate(start, end, ratio, f"{ratio:.0%} similar"))
+        if len(candidates) == limit:
+            break
+    return candidates
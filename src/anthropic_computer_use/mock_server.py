@@ -0,0 +1,175 @@
+"""Local stand-in for the Anthropic Messages API that replays recorded responses.
+
+Responses come from the `api_response` events of session logs in
+`sessions/`, or from any list of message dicts. Point the client at it with
+`ANTHROPIC_BASE_URL` (or `base_url=`) to run the agent loop with no network:
+
+    python -m anthropic_computer_use.mock_server sessions/<session_id>.jsonl
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8765 uv run main "..." --mode bash
+"""
+
+import argparse
+import ast
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+RESPONSE_MARKER = "API response: "
+USER_INPUT_MARKER = "User input: "
+
+
+def load_session_log(log_path: str) -> Dict[str, Any]:
+    """Read the prompt and the recorded API responses from a session log.
+
+    Reads JSONL session logs, and the older text logs whose lines hold
+    repr'd dicts. Returns {"prompt": str or None, "responses": [dicts]}.
+    """
+    prompt = None
+    responses = []
+    with open(log_path, encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("{"):
+                entry = json.loads(line)
+                if entry.get("event") == "api_response":
+                    responses.append(entry["data"])
+                elif prompt is None and entry.get("event") == "user_input":
+                    prompt = entry["data"]["content"][0]["text"]
+            elif RESPONSE_MARKER in line:
+                text = line.split(RESPONSE_MARKER, 1)[1].strip()
+                responses.append(ast.literal_eval(text))
+            elif prompt is None and USER_INPUT_MARKER in line:
+                message = ast.literal_eval(line.split(USER_INPUT_MARKER, 1)[1].strip())
+                prompt = message["content"][0]["text"]
+    return {"prompt": prompt, "responses": responses}
+
+
+class MockAnthropicServer:
+    """Serve recorded responses to POST /v1/messages, one per request, in order.
+
+    With `loop=True` the responses are replayed again from the start once
+    they run out, e.g. for load tests. Otherwise further requests get an
+    API-style error.
+    """
+
+    def __init__(
+        self,
+        responses: List[Dict[str, Any]],
+        host: str = "127.0.0.1",
+        port: int = 0,
+        loop: bool = False,
+    ):
+        self.responses = responses
+        self.loop = loop
+        self.requests: List[Dict[str, Any]] = []
+        self._next = 0
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def next_response(self, request: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            self.requests.append(request)
+            if self._next >= len(self.responses):
+                if not self.loop or not self.responses:
+                    return None
+                self._next = 0
+            response = self.responses[self._next]
+            self._next += 1
+            return response
+
+    def reset(self) -> None:
+        """Replay from the first response again"""
+        with self._lock:
+            self._next = 0
+            self.requests.clear()
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in separate writes; without this, Nagle
+            # plus delayed ACKs add ~40ms to every response
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                length = int(self.headers.get("content-length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if self.path.split("?")[0] != "/v1/messages":
+                    return self._send(404, _error("not_found_error", self.path))
+                response = server.next_response(body)
+                if response is None:
+                    return self._send(
+                        400, _error("invalid_request_error", "No recorded responses left")
+                    )
+                self._send(200, response)
+
+            def _send(self, status: int, payload: Dict[str, Any]) -> None:
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("content-type", "application/json")
+                self.send_header("content-length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> "MockAnthropicServer":
+        """Serve in a background thread"""
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self) -> "MockAnthropicServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+def _error(error_type: str, message: str) -> Dict[str, Any]:
+    return {"type": "error", "error": {"type": error_type, "message": message}}
+
+
+def main():
+    """Replay a session log until interrupted"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("log", help="Session log to replay")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--loop", action="store_true", help="Start over when the responses run out"
+    )
+    args = parser.parse_args()
+
+    recorded = load_session_log(args.log)
+    server = MockAnthropicServer(
+        recorded["responses"], host=args.host, port=args.port, loop=args.loop
+    )
+    print(f"Replaying {len(recorded['responses'])} responses on {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
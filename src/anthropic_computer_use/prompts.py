@@ -45,9 +45,11 @@ Explanation: The -p flag creates parent directories if needed and doesn't error
 
 EDITOR_SYSTEM_PROMPT = """You are a helpful assistant that helps users edit text files. You have access to the following tools:
 
-1. view: View file contents
-   Input: {"command": "view", "path": "string"}
+1. view: View file contents, or list a directory
+   Input: {"command": "view", "path": "string", "view_range": [start_line, end_line]}
    Output: File contents or error
+   view_range is optional; an end_line of -1 means the end of the file.
+   Large files are shown a page of numbered lines at a time
 
 2. create: Create a new file
    Input: {"command": "create", "path": "string", "file_text": "string"}
@@ -61,6 +63,15 @@ EDITOR_SYSTEM_PROMPT = """You are a helpful assistant that helps users edit text
    Input: {"command": "insert", "path": "string", "insert_line": number, "new_str": "string"}
    Output: Success message or error
 
+5. undo_edit: Revert the last edit made to a file
+   Input: {"command": "undo_edit", "path": "string"}
+   Output: Success message or error
+
+6. batch_edit (separate tool): Apply many replacements and inserts to one file at once
+   Input: {"path": "string", "edits": [{"old_str": "string", "new_str": "string"}, {"insert_line": number, "new_str": "string"}]}
+   Output: Success message or error; nothing is changed if any edit fails
+   Prefer it over repeated str_replace calls when changing several places in a file
+
 Guidelines:
 1. File operations:
    - Always check if files exist before modifying
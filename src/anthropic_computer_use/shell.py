@@ -0,0 +1,1110 @@
+"""Persistent bash process used by BashSession to run tool commands."""
+
+import asyncio
+import inspect
+import os
+import shlex
+import signal
+import selectors
+import subprocess
+import time
+import uuid
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+BASH_ARGS = ["/bin/bash", "--noprofile", "--norc"]
+
+READ_CHUNK_SIZE = 64 * 1024
+
+# Bytes of output kept from the start and the end of each stream
+OUTPUT_HEAD_BYTES = 16 * 1024
+OUTPUT_TAIL_BYTES = 16 * 1024
+
+# Longest partial line held back while streaming output; longer lines are
+# streamed in pieces
+STREAM_MAX_LINE_BYTES = 64 * 1024
+
+# Receives ("stdout" or "stderr", whole lines of output) as a command runs.
+# The async shell awaits what it returns, if anything.
+OutputCallback = Callable[[str, bytes], Any]
+
+# How often CPU and memory use are sampled while a command runs: first
+# after FIRST_SAMPLE_INTERVAL, then at twice the previous interval, up to
+# CPU_POLL_INTERVAL
+FIRST_SAMPLE_INTERVAL = 0.05
+CPU_POLL_INTERVAL = 0.5
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def _proc_stat_fields(pid: Any) -> Optional[List[bytes]]:
+    """Fields of /proc/<pid>/stat after the parenthesised command name, from `state`"""
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    return stat[stat.rfind(b")") + 2 :].split()
+
+
+def _children(pid: str) -> List[str]:
+    """Child pids of every thread of a process"""
+    try:
+        tasks = os.listdir(f"/proc/{pid}/task")
+    except OSError:
+        return []
+    children: List[str] = []
+    for task in tasks:
+        try:
+            with open(f"/proc/{pid}/task/{task}/children", "rb") as f:
+                children.extend(child.decode() for child in f.read().split())
+        except OSError:
+            pass
+    return children
+
+
+def _group_members(pgid: int) -> Iterable[List[bytes]]:
+    """/proc stat fields of the processes in a group led by `pgid`.
+
+    Walks the leader's descendants, so the cost grows with the size of the
+    command rather than of the machine. Members that were reparented away
+    from the leader (orphans, daemons) are missed, though still killed with
+    the group. Kernels without task children lists get a scan of all of /proc.
+    """
+    if os.path.exists(f"/proc/{pgid}/task/{pgid}/children"):
+        pending = [str(pgid)]
+        while pending:
+            pid = pending.pop()
+            fields = _proc_stat_fields(pid)
+            if fields is None:
+                continue
+            if int(fields[2]) == pgid:
+                yield fields
+            pending.extend(_children(pid))
+        return
+    for name in os.listdir("/proc"):
+        if name.isdigit():
+            fields = _proc_stat_fields(name)
+            if fields is not None and int(fields[2]) == pgid:
+                yield fields
+
+
+def group_usage(pgid: int) -> Optional[Tuple[float, int]]:
+    """CPU seconds (user + sys, including reaped children) and resident bytes of a process group.
+
+    Reads /proc, so it returns None where that is not available.
+    """
+    if not os.path.isdir("/proc"):
+        return None
+    ticks = 0
+    rss_pages = 0
+    for fields in _group_members(pgid):
+        ticks += sum(int(value) for value in fields[11:15])
+        rss_pages += int(fields[21])
+    return ticks / CLOCK_TICKS, rss_pages * PAGE_SIZE
+
+
+def group_cpu_seconds(pgid: int) -> Optional[float]:
+    """Total CPU time (user + sys, including reaped children) of a process group"""
+    usage = group_usage(pgid)
+    return usage[0] if usage is not None else None
+
+
+def process_counters(pid: int) -> Optional[Tuple[float, float, Optional[int], Optional[int]]]:
+    """User and sys CPU seconds, and storage bytes read and written, of a process.
+
+    Reaped children are included: the kernel adds a child's CPU time and I/O
+    to its parent's when the parent waits for it. The I/O counts are None
+    without I/O accounting (or permission to read it).
+    """
+    fields = _proc_stat_fields(pid)
+    if fields is None:
+        return None
+    user = (int(fields[11]) + int(fields[13])) / CLOCK_TICKS
+    system = (int(fields[12]) + int(fields[14])) / CLOCK_TICKS
+    io: Dict[str, int] = {}
+    try:
+        with open(f"/proc/{pid}/io", "rb") as f:
+            for line in f:
+                name, _, value = line.partition(b":")
+                io[name.decode()] = int(value)
+    except (OSError, ValueError):
+        pass
+    return user, system, io.get("read_bytes"), io.get("write_bytes")
+
+
+def _format_bytes(count: int) -> str:
+    size = float(count)
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024 or unit == "GiB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{count} B"
+
+
+class ResourceUsage:
+    """Resources used by a command, or summed over several.
+
+    CPU and I/O come from the shell's /proc counters, which include the
+    children it waited for. Peak RSS is the largest resident size of the
+    shell's process group seen while sampling, so commands shorter than
+    FIRST_SAMPLE_INTERVAL have none. Anything that couldn't be measured is
+    None.
+    """
+
+    def __init__(
+        self,
+        wall_seconds: float = 0.0,
+        user_seconds: Optional[float] = None,
+        sys_seconds: Optional[float] = None,
+        peak_rss_bytes: Optional[int] = None,
+        read_bytes: Optional[int] = None,
+        write_bytes: Optional[int] = None,
+    ):
+        self.wall_seconds = wall_seconds
+        self.user_seconds = user_seconds
+        self.sys_seconds = sys_seconds
+        self.peak_rss_bytes = peak_rss_bytes
+        self.read_bytes = read_bytes
+        self.write_bytes = write_bytes
+
+    def add(self, other: "ResourceUsage") -> None:
+        """Add another command's usage to this total; peak RSS takes the maximum"""
+
+        def plus(mine: Any, theirs: Any) -> Any:
+            if theirs is None:
+                return mine
+            return theirs if mine is None else mine + theirs
+
+        self.wall_seconds += other.wall_seconds
+        self.user_seconds = plus(self.user_seconds, other.user_seconds)
+        self.sys_seconds = plus(self.sys_seconds, other.sys_seconds)
+        self.read_bytes = plus(self.read_bytes, other.read_bytes)
+        self.write_bytes = plus(self.write_bytes, other.write_bytes)
+        if other.peak_rss_bytes is not None:
+            self.peak_rss_bytes = max(self.peak_rss_bytes or 0, other.peak_rss_bytes)
+
+    def as_dict(self) -> Dict[str, Any]:
+        def seconds(value: Optional[float]) -> Optional[float]:
+            return round(value, 3) if value is not None else None
+
+        return {
+            "wall_seconds": seconds(self.wall_seconds),
+            "user_seconds": seconds(self.user_seconds),
+            "sys_seconds": seconds(self.sys_seconds),
+            "peak_rss_bytes": self.peak_rss_bytes,
+            "read_bytes": self.read_bytes,
+            "write_bytes": self.write_bytes,
+        }
+
+    def summary(self) -> str:
+        """One line for the console, e.g. `wall 1.20s, user 0.80s, ...`"""
+        parts = [f"wall {self.wall_seconds:.2f}s"]
+        if self.user_seconds is not None:
+            parts.append(f"user {self.user_seconds:.2f}s, sys {self.sys_seconds:.2f}s")
+        if self.peak_rss_bytes is not None:
+            parts.append(f"peak RSS {_format_bytes(self.peak_rss_bytes)}")
+        if self.read_bytes is not None and self.write_bytes is not None:
+            parts.append(
+                f"read {_format_bytes(self.read_bytes)}, "
+                f"written {_format_bytes(self.write_bytes)}"
+            )
+        return ", ".join(parts)
+
+
+def command_usage(
+    before: Optional[Tuple[float, float, Optional[int], Optional[int]]],
+    after: Optional[Tuple[float, float, Optional[int], Optional[int]]],
+    duration: float,
+    peak_rss: Optional[int],
+) -> ResourceUsage:
+    """ResourceUsage from the shell's process_counters before and after a command"""
+    usage = ResourceUsage(duration, peak_rss_bytes=peak_rss)
+    if before is not None and after is not None:
+        usage.user_seconds = after[0] - before[0]
+        usage.sys_seconds = after[1] - before[1]
+        if before[2] is not None and after[2] is not None:
+            usage.read_bytes = after[2] - before[2]
+            usage.write_bytes = after[3] - before[3]
+    return usage
+
+
+# Programs that only read state. Anything else, including `cd` and `export`
+# which change the shell itself, is treated as mutating.
+READ_ONLY_PROGRAMS = {
+    "cat", "cut", "date", "df", "diff", "du", "echo", "file", "find", "grep",
+    "head", "id", "ls", "md5sum", "printenv", "pwd", "rg", "sha256sum", "sleep",
+    "sort", "stat", "tail", "tree", "true", "uname", "uniq", "wc", "which",
+    "whoami",
+}
+READ_ONLY_GIT_COMMANDS = {"blame", "diff", "log", "ls-files", "show", "status"}
+UNSAFE_FIND_ACTIONS = {
+    "-delete", "-exec", "-execdir", "-fls", "-fprint", "-fprint0", "-fprintf", "-ok", "-okdir",
+}
+# Options that make an otherwise read-only program write files, run other
+# programs or never finish: single letters are matched inside bundles of
+# short options (`sort -ro out`), the rest as prefixes of long options
+MUTATING_OPTIONS = {
+    "file": ("C", "--compile"),
+    "git": ("--output", "--ext-diff"),
+    "rg": ("--pre",),
+    "sort": ("o", "--output", "--compress-program"),
+    "tail": ("f", "F", "--follow"),
+    "tree": ("o",),
+}
+SQLITE_READ_ONLY_PREFIXES = (".schema", ".tables", ".indexes", "select", "pragma table_info")
+
+
+def _options(words: List[str]) -> Tuple[str, List[str], List[str]]:
+    """Short option letters, long options and other arguments of a command's words"""
+    letters = ""
+    long_options: List[str] = []
+    arguments: List[str] = []
+    for index, word in enumerate(words[1:], 1):
+        if word == "--":
+            arguments.extend(words[index + 1 :])
+            break
+        if word.startswith("--"):
+            long_options.append(word)
+        elif word.startswith("-") and word != "-":
+            letters += word[1:]
+        else:
+            arguments.append(word)
+    return letters, long_options, arguments
+
+
+def _is_read_only_segment(words: List[str]) -> bool:
+    program = os.path.basename(words[0])
+    letters, long_options, arguments = _options(words)
+    for option in MUTATING_OPTIONS.get(program, ()):
+        if option.startswith("--"):
+            if any(word.startswith(option) for word in long_options):
+                return False
+        elif option in letters:
+            return False
+    if program == "git":
+        # Global options (-C, -c, --git-dir, ...) can change what any
+        # subcommand does, so the subcommand must come first
+        return len(words) > 1 and words[1] in READ_ONLY_GIT_COMMANDS
+    if program == "sqlite3":
+        args = [word for word in words[1:] if not word.startswith("-")]
+        if len(args) != 2 or ";" in args[1].strip().rstrip(";"):
+            return False
+        return args[1].strip().lower().startswith(SQLITE_READ_ONLY_PREFIXES)
+    if program == "find":
+        return not UNSAFE_FIND_ACTIONS.intersection(words)
+    if program == "uniq":
+        # `uniq in out` writes out
+        return len(arguments) < 2
+    if program == "date":
+        # Only `date +FORMAT` is safe; `date -s` and `date STRING` set the clock
+        return all(word.startswith("+") for word in words[1:])
+    return program in READ_ONLY_PROGRAMS
+
+
+def split_command(command: str) -> Optional[List[List[str]]]:
+    """Split a pipeline or `&&`/`||`/`;` list into the words of each part.
+
+    Returns None when the command has anything beyond simple words: any
+    redirection, substitution, subshell or background job.
+    """
+    try:
+        lexer = shlex.shlex(command, posix=True, punctuation_chars=True)
+        lexer.whitespace_split = True
+        tokens = list(lexer)
+    except ValueError:
+        return None
+    if not tokens or any(c in command for c in ("`", "$(", "<(", ">(")):
+        return None
+
+    segments: List[List[str]] = [[]]
+    for token in tokens:
+        if token in ("|", "&&", "||", ";"):
+            segments.append([])
+        elif token and set(token) <= set("|&;<>()"):
+            # Redirections, background jobs and subshells
+            return None
+        else:
+            segments[-1].append(token)
+    return segments
+
+
+def has_expansions(command: str, globs: bool = True) -> bool:
+    """Whether bash would expand anything in a command before running it.
+
+    Parameter and command substitutions count wherever they aren't single
+    quoted; with `globs`, so do unquoted glob, brace and tilde characters.
+    """
+    quote = None
+    escaped = False
+    for char in command:
+        if escaped:
+            escaped = False
+        elif quote == "'":
+            if char == "'":
+                quote = None
+        elif char == "\\":
+            escaped = True
+        elif char in "$`":
+            return True
+        elif quote == '"':
+            if char == '"':
+                quote = None
+        elif char in "'\"":
+            quote = char
+        elif globs and char in "*?[{~":
+            return True
+    return False
+
+
+def is_read_only_command(command: str) -> bool:
+    """Conservatively decide whether a command only reads state.
+
+    Pipelines and `&&`/`||`/`;` lists qualify when every part does. Any
+    redirection, substitution, background job or variable assignment makes the
+    command count as mutating.
+    """
+    segments = split_command(command)
+    if segments is None:
+        return False
+    for words in segments:
+        if not words or "=" in words[0]:
+            return False
+        if not _is_read_only_segment(words):
+            return False
+    return True
+
+
+def runs_alike_in_clone(command: str, state: "ShellState") -> bool:
+    """Whether a read-only command gives the same result in a clone of the shell.
+
+    A clone only has the shell's working directory, exported variables and
+    `set` options. Commands that expand anything (unexported variables, globs
+    under shopt options) or call a function or alias the shell defined must
+    run in the shell itself.
+    """
+    if has_expansions(command):
+        return False
+    segments = split_command(command)
+    if segments is None:
+        return False
+    return not any(words and words[0] in state.defined_names for words in segments)
+
+
+# Variables bash maintains itself, which are not part of the tracked state
+SHELL_OWNED_VARIABLES = {"OLDPWD", "PWD", "SHLVL", "_"}
+
+
+def _tracked_variable(name: str) -> bool:
+    # Names bash can't export or unset are left alone
+    return name.isidentifier() and name not in SHELL_OWNED_VARIABLES
+
+
+class ShellState:
+    """Working directory and environment of a shell, as a diff from ours.
+
+    After each command that may change them, the shell reports its $PWD,
+    `env -0`, the names of its functions and aliases, and `set +o`. Only the
+    variables that differ from os.environ are kept, and a fresh shell (after
+    a timeout, or a throwaway one for a concurrent command) gets them back
+    with a few `export`/`unset` lines, a `cd` and the `set` options, so no
+    environment dict is ever built to start a shell. Functions, aliases and
+    unexported variables are not carried over.
+    """
+
+    def __init__(self, cwd: Optional[str] = None):
+        self.initial_cwd = cwd
+        self.cwd = cwd
+        # Variable -> value, or None for a variable the shell unset
+        self.env_changes: Dict[str, Optional[str]] = {}
+        # Functions and aliases the shell defined, and its `set +o` output
+        self.defined_names: Set[str] = set()
+        self.options = b""
+        self.last_report = b""
+
+    def copy(self) -> "ShellState":
+        state = ShellState(self.initial_cwd)
+        state.cwd = self.cwd
+        state.env_changes = dict(self.env_changes)
+        state.defined_names = set(self.defined_names)
+        state.options = self.options
+        state.last_report = self.last_report
+        return state
+
+    def reset(self) -> None:
+        """Forget everything commands changed"""
+        self.cwd = self.initial_cwd
+        self.env_changes = {}
+        self.defined_names = set()
+        self.options = b""
+        self.last_report = b""
+
+    def update(self, report: bytes) -> None:
+        """Apply a `$PWD NUL env -0 NUL names NUL set +o` report from the shell"""
+        if report == self.last_report:
+            return
+        self.last_report = report
+        cwd, _, rest = report.partition(b"\0")
+        self.cwd = os.fsdecode(cwd)
+        # env -0 ends every variable with a NUL, so an empty item follows it
+        if rest.startswith(b"\0"):
+            env, rest = b"", rest[1:]
+        else:
+            env, _, rest = rest.partition(b"\0\0")
+        names, _, options = rest.partition(b"\0")
+        self.defined_names = set(os.fsdecode(names).split())
+        self.options = options
+        if not env:
+            # env itself failed; keep the variables we knew
+            return
+        seen = set()
+        changes: Dict[str, Optional[str]] = {}
+        for item in env.split(b"\0"):
+            name, sep, value = item.partition(b"=")
+            if not sep:
+                continue
+            name = os.fsdecode(name)
+            seen.add(name)
+            if _tracked_variable(name) and os.environ.get(name) != os.fsdecode(value):
+                changes[name] = os.fsdecode(value)
+        for name in os.environ:
+            if name not in seen and _tracked_variable(name):
+                changes[name] = None
+        self.env_changes = changes
+
+    def restore_script(self) -> bytes:
+        """Commands that bring a fresh shell to this state"""
+        lines = []
+        for name, value in self.env_changes.items():
+            if value is None:
+                lines.append(f"unset {name}")
+            else:
+                lines.append(f"export {name}={shlex.quote(value)}")
+        if self.cwd is not None and self.cwd != self.initial_cwd:
+            lines.append(f"cd {shlex.quote(self.cwd)} 2>/dev/null")
+        # Last, so that errexit can't end the shell on a failed cd
+        return os.fsencode("".join(f"{line}\n" for line in lines)) + self.options
+
+
+class CommandResult:
+    """Outcome of a command run by BashProcess"""
+
+    def __init__(
+        self,
+        stdout: str,
+        stderr: str,
+        returncode: Optional[int],
+        duration: float,
+        cpu_seconds: Optional[float] = None,
+        timed_out: Optional[str] = None,
+        usage: Optional[ResourceUsage] = None,
+    ):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = returncode
+        self.duration = duration
+        self.cpu_seconds = cpu_seconds
+        # "wall" or "cpu" when the command was killed for exceeding a budget
+        self.timed_out = timed_out
+        self.usage = usage
+
+
+class OutputBuffer:
+    """Bounded capture of a byte stream: the first N and last M bytes.
+
+    Everything in between is counted but dropped, so memory use does not grow
+    with the amount of output a command produces.
+    """
+
+    def __init__(self, head_size: int = OUTPUT_HEAD_BYTES, tail_size: int = OUTPUT_TAIL_BYTES):
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self.head = bytearray()
+        self.tail = bytearray(tail_size)
+        self.tail_pos = 0  # Next write position in the tail ring
+        self.tail_len = 0
+        self.total_bytes = 0
+
+    @property
+    def truncated(self) -> bool:
+        return self.total_bytes > len(self.head) + self.tail_len
+
+    def write(self, data: bytes) -> None:
+        """Append data, keeping only the head and the tail"""
+        self.total_bytes += len(data)
+        if len(self.head) < self.head_size:
+            room = self.head_size - len(self.head)
+            self.head += data[:room]
+            data = data[room:]
+        if not data or not self.tail_size:
+            return
+        # Only the last tail_size bytes of data can survive
+        data = data[-self.tail_size :]
+        first = min(len(data), self.tail_size - self.tail_pos)
+        self.tail[self.tail_pos : self.tail_pos + first] = data[:first]
+        self.tail[: len(data) - first] = data[first:]
+        self.tail_pos = (self.tail_pos + len(data)) % self.tail_size
+        self.tail_len = min(self.tail_size, self.tail_len + len(data))
+
+    def _tail_bytes(self) -> bytes:
+        if self.tail_len < self.tail_size:
+            return bytes(self.tail[: self.tail_len])
+        return bytes(self.tail[self.tail_pos :] + self.tail[: self.tail_pos])
+
+    def getvalue(self) -> str:
+        """Decode the captured output, marking where bytes were dropped"""
+        head = self.head.decode(errors="replace")
+        tail = self._tail_bytes().decode(errors="replace")
+        if not self.truncated:
+            return head + tail
+        omitted = self.total_bytes - len(self.head) - self.tail_len
+        return (
+            f"{head}\n[... {omitted} bytes omitted, "
+            f"{self.total_bytes} bytes total ...]\n{tail}"
+        )
+
+
+class StreamCapture:
+    """Splits one of the shell's output streams at the command's sentinel.
+
+    Bytes before the sentinel go to a bounded OutputBuffer; the rest of the
+    sentinel line (the trailer) is kept separately. An end of a read that could
+    be the start of a sentinel is held back in `pending`, so a sentinel split
+    across two reads is still found.
+
+    With `stream_lines`, feed() and close() also return the output that
+    completes lines, for streaming; the last partial line is held back in
+    `partial` until its newline or the end of the output arrives.
+    """
+
+    def __init__(
+        self,
+        sentinel: bytes,
+        head_bytes: int,
+        tail_bytes: int,
+        trailer_end: bytes = b"\n",
+        name: str = "",
+        stream_lines: bool = False,
+    ):
+        self.sentinel = sentinel
+        self.buffer = OutputBuffer(head_bytes, tail_bytes)
+        self.pending = b""
+        self.trailer: Optional[bytes] = None
+        # What the trailer ends with; longer than a newline when it carries
+        # a shell state report, which may contain newlines itself
+        self.trailer_end = trailer_end
+        self.name = name
+        self.stream_lines = stream_lines
+        self.partial = b""
+
+    @property
+    def done(self) -> bool:
+        """Whether the full sentinel line has been read"""
+        return self.trailer is not None and self.trailer.endswith(self.trailer_end)
+
+    def _write(self, data: bytes) -> bytes:
+        self.buffer.write(data)
+        if not self.stream_lines:
+            return b""
+        data = self.partial + data
+        cut = data.rfind(b"\n") + 1
+        if not cut and len(data) > STREAM_MAX_LINE_BYTES:
+            cut = len(data)
+        self.partial = data[cut:]
+        return data[:cut]
+
+    def _end(self) -> bytes:
+        partial, self.partial = self.partial, b""
+        return partial
+
+    def _sentinel_prefix(self, data: bytes) -> int:
+        """Length of the longest end of `data` that could start a sentinel"""
+        index = data.find(self.sentinel[:1], max(0, len(data) - len(self.sentinel) + 1))
+        while index != -1:
+            if self.sentinel.startswith(data[index:]):
+                return len(data) - index
+            index = data.find(self.sentinel[:1], index + 1)
+        return 0
+
+    def feed(self, chunk: bytes) -> bytes:
+        """Take a chunk read from the stream; return the output ready to stream"""
+        if self.trailer is not None:
+            self.trailer += chunk
+            return b""
+        data = self.pending + chunk
+        index = data.find(self.sentinel)
+        if index == -1:
+            keep = self._sentinel_prefix(data)
+            self.pending = data[len(data) - keep :]
+            return self._write(data[: len(data) - keep])
+        self.pending = b""
+        self.trailer = data[index + len(self.sentinel) :]
+        return self._write(data[:index]) + self._end()
+
+    def close(self) -> bytes:
+        """Flush held-back bytes once no sentinel can arrive any more"""
+        pending, self.pending = self.pending, b""
+        return self._write(pending) + self._end()
+
+
+class BashProcess:
+    """A long-lived /bin/bash coprocess that runs commands framed by sentinels.
+
+    Commands are written to the shell's stdin and evaluated in the shell itself,
+    so `cd`, exported variables and shell functions persist between calls.
+    After each command the shell prints a unique sentinel (followed by the exit
+    code) on stdout and stderr, which tells us where the command's output ends.
+    Commands that aren't read-only also report the working directory and
+    environment, kept in `state` so a replacement shell can start from them.
+    """
+
+    def __init__(
+        self,
+        env: Optional[Dict[str, str]] = None,
+        cwd: Optional[str] = None,
+        head_bytes: int = OUTPUT_HEAD_BYTES,
+        tail_bytes: int = OUTPUT_TAIL_BYTES,
+    ):
+        self.env = env
+        self.initial_cwd = cwd
+        self.state = ShellState(cwd)
+        self.head_bytes = head_bytes
+        self.tail_bytes = tail_bytes
+        self.process: Optional[subprocess.Popen] = None
+        self.sentinel = f"__BASH_DONE_{uuid.uuid4().hex}__"
+
+    @property
+    def is_running(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    @property
+    def cwd(self) -> Optional[str]:
+        """The shell's current working directory, if known"""
+        return self.state.cwd
+
+    def start(self) -> None:
+        """Start the bash process if it is not already running"""
+        if self.is_running:
+            return
+        # Reap a shell that exited on its own before starting a new one
+        self.stop()
+        self.process = subprocess.Popen(
+            BASH_ARGS,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=self.env,
+            cwd=self.initial_cwd,
+            start_new_session=True,
+        )
+        restore = self.state.restore_script()
+        if restore:
+            self.process.stdin.write(restore)
+            self.process.stdin.flush()
+
+    def stop(self) -> None:
+        """Terminate the bash process and everything it started"""
+        if self.process is None:
+            return
+        kill_group(self.process.pid)
+        self.process.wait()
+        for stream in (self.process.stdin, self.process.stdout, self.process.stderr):
+            if stream:
+                stream.close()
+        self.process = None
+
+    def restart(self, reset: bool = False) -> None:
+        """Replace the bash process with a fresh one, in a fresh state if `reset`"""
+        self.stop()
+        if reset:
+            self.state.reset()
+        self.start()
+
+    def clone(self) -> "BashProcess":
+        """A separate shell, not yet started, in this shell's current state"""
+        bash = BashProcess(self.env, self.initial_cwd, self.head_bytes, self.tail_bytes)
+        bash.state = self.state.copy()
+        return bash
+
+    def run(
+        self,
+        command: str,
+        timeout: Optional[float] = None,
+        cpu_limit: Optional[float] = None,
+        on_output: Optional[OutputCallback] = None,
+    ) -> CommandResult:
+        """Run a command in the shell.
+
+        If the command runs longer than `timeout` seconds of wall-clock time or
+        uses more than `cpu_limit` seconds of CPU, the shell's whole process
+        group is killed and the partial output is returned with `timed_out`
+        set. The next command then starts on a fresh shell.
+
+        `on_output` is called with the output, in whole lines, as it arrives.
+        The pipes aren't read while it runs, so a slow consumer slows the
+        command down rather than letting output pile up in memory.
+        """
+        report_state = not is_read_only_command(command)
+        script = wrap_command(command, self.sentinel, report_state)
+        self.start()
+        counters = process_counters(self.process.pid)
+        try:
+            self.process.stdin.write(script)
+            self.process.stdin.flush()
+        except BrokenPipeError:
+            # The shell died since the last command; retry on a fresh one
+            self.restart()
+            counters = process_counters(self.process.pid)
+            self.process.stdin.write(script)
+            self.process.stdin.flush()
+        process = self.process
+        captures = make_captures(
+            (process.stdout, process.stderr),
+            self.sentinel,
+            self.head_bytes,
+            self.tail_bytes,
+            report_state,
+            on_output is not None,
+        )
+        timed_out = None
+
+        started = time.monotonic()
+        deadline = started + timeout if timeout is not None else None
+        # The process group is sampled for peak memory and the CPU budget
+        # where /proc is available
+        sampling = counters is not None
+        cpu_start = group_cpu_seconds(process.pid) if sampling and cpu_limit is not None else None
+        if cpu_start is None:
+            cpu_limit = None
+        peak_rss = None
+        sample_interval = FIRST_SAMPLE_INTERVAL
+        next_sample = started + sample_interval
+
+        with selectors.DefaultSelector() as selector:
+            for stream in captures:
+                selector.register(stream, selectors.EVENT_READ)
+
+            while selector.get_map():
+                wait = max(0.0, next_sample - time.monotonic()) if sampling else None
+                if deadline is not None:
+                    remaining = max(0.0, deadline - time.monotonic())
+                    wait = remaining if wait is None else min(wait, remaining)
+
+                events = selector.select(wait)
+
+                now = time.monotonic()
+                if deadline is not None and now >= deadline:
+                    timed_out = "wall"
+                elif sampling and now >= next_sample:
+                    sample_interval = min(sample_interval * 2, CPU_POLL_INTERVAL)
+                    next_sample = now + sample_interval
+                    cpu, rss = group_usage(process.pid)
+                    peak_rss = max(peak_rss or 0, rss)
+                    if cpu_limit is not None and cpu - cpu_start > cpu_limit:
+                        timed_out = "cpu"
+                if timed_out:
+                    break
+
+                for key, _ in events:
+                    capture = captures[key.fileobj]
+                    chunk = os.read(key.fd, READ_CHUNK_SIZE)
+                    if chunk:
+                        lines = capture.feed(chunk)
+                    else:
+                        # The shell exited (e.g. the command ran `exit`)
+                        lines = capture.close()
+                    if lines:
+                        on_output(capture.name, lines)
+                    if not chunk or capture.done:
+                        selector.unregister(key.fileobj)
+
+        if on_output is not None:
+            # Output cut short by a timeout ends without a newline
+            for capture in captures.values():
+                lines = capture.close()
+                if lines:
+                    on_output(capture.name, lines)
+
+        duration = time.monotonic() - started
+        cpu_seconds = None
+        if cpu_start is not None and process.poll() is None:
+            cpu_seconds = group_cpu_seconds(process.pid) - cpu_start
+
+        stdout_capture = captures[process.stdout]
+        after = None
+        if timed_out:
+            returncode = None
+            self.stop()
+        elif stdout_capture.done:
+            returncode = read_trailer(stdout_capture, self.state)
+            after = process_counters(process.pid)
+        else:
+            returncode = process.wait()
+            self.stop()
+
+        usage = command_usage(counters, after, duration, peak_rss)
+        return finish_result(
+            captures.values(), returncode, duration, cpu_seconds, timed_out, usage
+        )
+
+
+class AsyncBashProcess:
+    """asyncio counterpart of BashProcess, for the async agent loop.
+
+    Uses the same sentinel framing, bounded capture and budgets, but waits on
+    the shell's pipes without blocking the event loop, so one loop can drive
+    the shells of many sessions.
+    """
+
+    def __init__(
+        self,
+        env: Optional[Dict[str, str]] = None,
+        cwd: Optional[str] = None,
+        head_bytes: int = OUTPUT_HEAD_BYTES,
+        tail_bytes: int = OUTPUT_TAIL_BYTES,
+    ):
+        self.env = env
+        self.initial_cwd = cwd
+        self.state = ShellState(cwd)
+        self.head_bytes = head_bytes
+        self.tail_bytes = tail_bytes
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.sentinel = f"__BASH_DONE_{uuid.uuid4().hex}__"
+
+    @property
+    def is_running(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    @property
+    def cwd(self) -> Optional[str]:
+        """The shell's current working directory, if known"""
+        return self.state.cwd
+
+    async def start(self) -> None:
+        """Start the bash process if it is not already running"""
+        if self.is_running:
+            return
+        await self.stop()
+        self.process = await asyncio.create_subprocess_exec(
+            *BASH_ARGS,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=self.env,
+            cwd=self.initial_cwd,
+            start_new_session=True,
+        )
+        restore = self.state.restore_script()
+        if restore:
+            self.process.stdin.write(restore)
+            await self.process.stdin.drain()
+
+    async def stop(self) -> None:
+        """Terminate the bash process and everything it started"""
+        if self.process is None:
+            return
+        kill_group(self.process.pid)
+        await self.process.wait()
+        self.process = None
+
+    async def restart(self, reset: bool = False) -> None:
+        """Replace the bash process with a fresh one, in a fresh state if `reset`"""
+        await self.stop()
+        if reset:
+            self.state.reset()
+        await self.start()
+
+    def clone(self) -> "AsyncBashProcess":
+        """A separate shell, not yet started, in this shell's current state"""
+        bash = AsyncBashProcess(self.env, self.initial_cwd, self.head_bytes, self.tail_bytes)
+        bash.state = self.state.copy()
+        return bash
+
+    async def run(
+        self,
+        command: str,
+        timeout: Optional[float] = None,
+        cpu_limit: Optional[float] = None,
+        on_output: Optional[OutputCallback] = None,
+    ) -> CommandResult:
+        """Run a command in the shell; see BashProcess.run"""
+        report_state = not is_read_only_command(command)
+        script = wrap_command(command, self.sentinel, report_state)
+        await self.start()
+        counters = process_counters(self.process.pid)
+        try:
+            self.process.stdin.write(script)
+            await self.process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            await self.restart()
+            counters = process_counters(self.process.pid)
+            self.process.stdin.write(script)
+            await self.process.stdin.drain()
+        process = self.process
+        captures = make_captures(
+            (process.stdout, process.stderr),
+            self.sentinel,
+            self.head_bytes,
+            self.tail_bytes,
+            report_state,
+            on_output is not None,
+        )
+
+        async def deliver(capture: StreamCapture, lines: bytes) -> None:
+            if lines:
+                delivered = on_output(capture.name, lines)
+                if inspect.isawaitable(delivered):
+                    await delivered
+
+        async def pump(stream: asyncio.StreamReader, capture: StreamCapture) -> None:
+            while not capture.done:
+                chunk = await stream.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    await deliver(capture, capture.close())
+                    return
+                await deliver(capture, capture.feed(chunk))
+
+        peak_rss = None
+
+        async def sample(cpu_start: Optional[float]) -> None:
+            """Track peak memory; return once the group is over its CPU budget"""
+            nonlocal peak_rss
+            interval = FIRST_SAMPLE_INTERVAL
+            while True:
+                await asyncio.sleep(interval)
+                interval = min(interval * 2, CPU_POLL_INTERVAL)
+                # /proc reads can block; keep them off the event loop
+                cpu, rss = await asyncio.to_thread(group_usage, process.pid)
+                peak_rss = max(peak_rss or 0, rss)
+                if cpu_start is not None and cpu - cpu_start > cpu_limit:
+                    return
+
+        started = time.monotonic()
+        reader = asyncio.gather(*(pump(stream, c) for stream, c in captures.items()))
+        waiters = {reader}
+        sampling = counters is not None
+        cpu_start = None
+        if sampling and cpu_limit is not None:
+            cpu_start = await asyncio.to_thread(group_cpu_seconds, process.pid)
+        if sampling:
+            waiters.add(asyncio.ensure_future(sample(cpu_start)))
+
+        done, _ = await asyncio.wait(
+            waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+        )
+        timed_out = None
+        if reader not in done:
+            timed_out = "cpu" if done else "wall"
+        for waiter in waiters:
+            waiter.cancel()
+        # Collect the cancelled waiters so their cancellation is not reported
+        await asyncio.gather(*waiters, return_exceptions=True)
+        if on_output is not None:
+            for capture in captures.values():
+                await deliver(capture, capture.close())
+
+        duration = time.monotonic() - started
+        cpu_seconds = None
+        if cpu_start is not None and process.returncode is None:
+            cpu_seconds = await asyncio.to_thread(group_cpu_seconds, process.pid) - cpu_start
+
+        stdout_capture = captures[process.stdout]
+        after = None
+        if timed_out:
+            returncode = None
+            await self.stop()
+        elif stdout_capture.done:
+            returncode = read_trailer(stdout_capture, self.state)
+            after = process_counters(process.pid)
+        else:
+            returncode = await process.wait()
+            await self.stop()
+
+        usage = command_usage(counters, after, duration, peak_rss)
+        return finish_result(
+            captures.values(), returncode, duration, cpu_seconds, timed_out, usage
+        )
+
+
+def kill_group(pgid: int) -> None:
+    """Kill a process group, ignoring one that is already gone"""
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def wrap_command(command: str, sentinel: str, report_state: bool = False) -> bytes:
+    """Frame a command so its end (and exit code) can be found in the output.
+
+    With `report_state`, the exit code line is followed by the shell's
+    working directory, environment, function and alias names and `set`
+    options, NUL-separated, and the sentinel again.
+    """
+    # eval keeps state changes in this shell, and a syntax error in the
+    # command only fails the eval instead of desynchronizing the framing.
+    # stdin is /dev/null so commands cannot swallow the protocol stream.
+    script = (
+        f"eval {shlex.quote(command)} < /dev/null\n"
+        f"printf '{sentinel}%d\\n' $?\n"
+    )
+    if report_state:
+        script += (
+            f"printf '%s\\0' \"$PWD\"; command -p env -0; printf '\\0'; "
+            "compgen -A function -A alias 2>/dev/null; printf '\\0'; set +o; "
+            f"printf '{sentinel}\\n'\n"
+        )
+    script += f"printf '{sentinel}\\n' >&2\n"
+    return script.encode()
+
+
+def make_captures(
+    streams: Iterable[Any],
+    sentinel: str,
+    head_bytes: int,
+    tail_bytes: int,
+    report_state: bool,
+    stream_lines: bool = False,
+) -> Dict[Any, StreamCapture]:
+    """StreamCaptures for a command's stdout and stderr, framed as wrap_command does"""
+    stdout, stderr = streams
+    stdout_end = f"{sentinel}\n".encode() if report_state else b"\n"
+    return {
+        stdout: StreamCapture(
+            sentinel.encode(), head_bytes, tail_bytes, stdout_end, "stdout", stream_lines
+        ),
+        stderr: StreamCapture(
+            sentinel.encode(), head_bytes, tail_bytes, b"\n", "stderr", stream_lines
+        ),
+    }
+
+
+def read_trailer(capture: StreamCapture, state: ShellState) -> int:
+    """Exit code from a finished stdout trailer, applying any state report to `state`"""
+    code, _, report = capture.trailer.partition(b"\n")
+    if report:
+        state.update(report[: -len(capture.trailer_end)])
+    return int(code.strip() or 0)
+
+
+def finish_result(
+    captures: Iterable[StreamCapture],
+    returncode: Optional[int],
+    duration: float,
+    cpu_seconds: Optional[float],
+    timed_out: Optional[str],
+    usage: Optional[ResourceUsage] = None,
+) -> CommandResult:
+    """Build the CommandResult from the stdout and stderr captures"""
+    stdout, stderr = captures
+    for capture in (stdout, stderr):
+        capture.close()
+    return CommandResult(
+        stdout=stdout.buffer.getvalue(),
+        stderr=stderr.buffer.getvalue(),
+        returncode=returncode,
+        duration=duration,
+        cpu_seconds=cpu_seconds,
+        timed_out=timed_out,
+        usage=usage,
+    )
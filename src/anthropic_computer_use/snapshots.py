@@ -0,0 +1,231 @@
+"""Content-addressed snapshots of an editor directory.
+
+File contents are stored once, as zlib-compressed blobs named by their
+SHA-256, under `objects/`. A checkpoint is a manifest listing only the
+files that changed since its parent checkpoint (relative path -> hash,
+mode, size, or None for a deleted file), so checkpointing costs O(changed
+files). Restoring a checkpoint into a directory only touches files whose
+content differs, and hard-links files whose content is already on disk
+in another tree instead of writing them again.
+"""
+
+import hashlib
+import json
+import os
+import stat
+import tempfile
+import threading
+import zlib
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from .editor import READ_CHUNK_SIZE, file_stamp
+
+SNAPSHOTS_DIR = os.path.join(os.getcwd(), "snapshots")
+
+BLOB_COMPRESSION_LEVEL = 6
+
+# Manifest entry: [sha256 hex, mode, size]
+Manifest = Dict[str, Optional[List[Any]]]
+
+
+def _write_atomically(path: str, chunks: Iterable[bytes]) -> None:
+    directory = os.path.dirname(path)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+class SnapshotStore:
+    """Blobs and checkpoint manifests under `store_dir`.
+
+    Knows the (stamp, hash) of every file it has stored or restored, so
+    unchanged files are never re-read, and files whose content is already
+    on disk can be hard-linked. Editor writes replace files by rename, so a
+    hard-linked copy is not affected by later edits to the other one, but
+    `>>`, truncate and in-place editors would change both. Links are
+    therefore only made from another tree, never within the one restored;
+    restore(link=False) always copies.
+    """
+
+    def __init__(self, store_dir: str = SNAPSHOTS_DIR):
+        self.store_dir = store_dir
+        self.objects_dir = os.path.join(store_dir, "objects")
+        self.manifests_dir = os.path.join(store_dir, "manifests")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.manifests_dir, exist_ok=True)
+        # Absolute path -> (file stamp, sha256) of files seen with known
+        # content, and the reverse map from sha256 to those paths
+        self.known: Dict[str, Tuple[Tuple[int, int, int], str]] = {}
+        self.paths_by_digest: Dict[str, Set[str]] = {}
+        self.lock = threading.Lock()
+
+    def _remember(self, path: str, stamp: Tuple[int, int, int], digest: str) -> None:
+        with self.lock:
+            previous = self.known.get(path)
+            if previous is not None:
+                self.paths_by_digest[previous[1]].discard(path)
+            self.known[path] = (stamp, digest)
+            self.paths_by_digest.setdefault(digest, set()).add(path)
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.objects_dir, digest[:2], digest[2:])
+
+    def put_file(self, path: str) -> List[Any]:
+        """Store a file's content if new; return its manifest entry"""
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno())
+            stamp = file_stamp(st)
+            mode = stat.S_IMODE(st.st_mode)
+            known = self.known.get(path)
+            if known is not None and known[0] == stamp:
+                return [known[1], mode, st.st_size]
+
+            # Hash and compress in one pass; the blob is dropped if it exists
+            digest = hashlib.sha256()
+            compressor = zlib.compressobj(BLOB_COMPRESSION_LEVEL)
+            compressed = []
+            while True:
+                chunk = f.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                compressed.append(compressor.compress(chunk))
+            compressed.append(compressor.flush())
+
+        hexdigest = digest.hexdigest()
+        object_path = self._object_path(hexdigest)
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            _write_atomically(object_path, compressed)
+        self._remember(path, stamp, hexdigest)
+        return [hexdigest, mode, st.st_size]
+
+    def scan(self, root: str) -> Manifest:
+        """Manifest of every regular file under `root`, hidden files excluded"""
+        manifest: Manifest = {}
+        for directory, dirs, files in os.walk(root):
+            dirs[:] = [name for name in dirs if not name.startswith(".")]
+            for name in files:
+                path = os.path.join(directory, name)
+                if name.startswith(".") or not os.path.isfile(path):
+                    continue
+                manifest[os.path.relpath(path, root)] = self.put_file(path)
+        return manifest
+
+    def changes(self, root: str, paths: Iterable[str]) -> Manifest:
+        """Manifest entries for the given files under `root` (None if deleted)"""
+        manifest: Manifest = {}
+        for path in paths:
+            relative = os.path.relpath(path, root)
+            manifest[relative] = self.put_file(path) if os.path.isfile(path) else None
+        return manifest
+
+    def save(self, name: str, changes: Manifest, parent: Optional[str]) -> None:
+        """Write checkpoint `name` as `changes` on top of checkpoint `parent`"""
+        path = os.path.join(self.manifests_dir, f"{name}.json")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps({"parent": parent, "changes": changes}, sort_keys=True)
+        _write_atomically(path, [data.encode()])
+
+    def load(self, name: str) -> Manifest:
+        """Full manifest of checkpoint `name`, following its parents"""
+        chain = []
+        current: Optional[str] = name
+        while current is not None:
+            with open(os.path.join(self.manifests_dir, f"{current}.json"), encoding="utf-8") as f:
+                checkpoint = json.load(f)
+            chain.append(checkpoint["changes"])
+            current = checkpoint["parent"]
+        manifest: Manifest = {}
+        for changes in reversed(chain):
+            manifest.update(changes)
+        return {path: entry for path, entry in manifest.items() if entry is not None}
+
+    def _content_on_disk(
+        self, digest: str, outside: str, used: Set[str]
+    ) -> Optional[str]:
+        """A file outside directory `outside` and not in `used` holding `digest`'s content"""
+        prefix = os.path.join(os.path.abspath(outside), "")
+        with self.lock:
+            candidates = [
+                (path, self.known[path][0])
+                for path in self.paths_by_digest.get(digest, ())
+                if path not in used and not os.path.abspath(path).startswith(prefix)
+            ]
+        for path, stamp in candidates:
+            try:
+                if file_stamp(os.stat(path)) == stamp:
+                    return path
+            except FileNotFoundError:
+                pass
+        return None
+
+    def restore(self, manifest: Manifest, root: str, link: bool = True) -> List[str]:
+        """Make `root` match `manifest`; return the absolute paths that changed.
+
+        With `link`, files are hard-linked from another tree where possible.
+        Hidden files are left alone, like in scan().
+        """
+        changed = []
+        current = self.scan(root) if os.path.isdir(root) else {}
+        for relative in current.keys() - manifest.keys():
+            path = os.path.join(root, relative)
+            os.unlink(path)
+            changed.append(path)
+
+        by_digest: Dict[str, List[str]] = {}
+        for relative, (digest, mode, _) in manifest.items():
+            if current.get(relative, [None, None])[:2] == [digest, mode]:
+                continue
+            by_digest.setdefault(digest, []).append(relative)
+
+        # Each source is linked once, so no two restored files share an inode
+        used: Set[str] = set()
+        for digest, relatives in by_digest.items():
+            for relative in relatives:
+                path = os.path.join(root, relative)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                mode = manifest[relative][1]
+                source = self._content_on_disk(digest, root, used) if link else None
+                if source is not None:
+                    used.add(source)
+                if not (source is not None and self._link(source, path, mode)):
+                    self._checkout(digest, path, mode)
+                self._remember(path, file_stamp(os.stat(path)), digest)
+                changed.append(path)
+        return changed
+
+    def _link(self, source: str, path: str, mode: int) -> bool:
+        """Hard-link `source` to `path`; False if that isn't possible"""
+        if source == path or stat.S_IMODE(os.stat(source).st_mode) != mode:
+            return False
+        temp_path = os.path.join(
+            os.path.dirname(path), f".{os.path.basename(path)}.{os.getpid()}.link"
+        )
+        try:
+            os.link(source, temp_path)
+        except OSError:
+            # e.g. a different filesystem
+            return False
+        os.replace(temp_path, path)
+        return True
+
+    def _checkout(self, digest: str, path: str, mode: int) -> None:
+        def chunks():
+            decompressor = zlib.decompressobj()
+            with open(self._object_path(digest), "rb") as f:
+                while True:
+                    chunk = f.read(READ_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield decompressor.decompress(chunk)
+            yield decompressor.flush()
+
+        _write_atomically(path, chunks())
+        os.chmod(path, mode)